@@ -0,0 +1,271 @@
+from collections import OrderedDict
+from copy import copy
+from threading import Lock
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from rapidsms.models import Backend, Connection
+from .metrics import registry
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class LRUCache(object):
+    """
+    Simple thread safe, bounded, least recently used cache, whose entries can optionally expire
+    after a number of seconds.  Keeps track of how many lookups hit and missed so we can see
+    whether it is pulling its weight.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+
+            # reinsert it so it is now the most recently used
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl if ttl else None)
+
+            # evict our least recently used entries
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return dict(size=len(self.entries), max_size=self.size,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class ResolutionCache(object):
+    """
+    Process local cache of the Backends and Connection ids used when adding messages.  These
+    almost never change, so there is no need to hit the database for them for every message.
+
+    Only the ids of connections are cached, messages load their connection from the database when
+    they need it, so nobody is ever handed a stale connection.  Entries are evicted whenever a Backend
+    or Connection is saved or deleted in this process, and expire after ROUTER_RESOLUTION_CACHE_TTL
+    seconds (default 60), which bounds how long changes made by other processes go unnoticed.  If
+    ROUTER_RESOLUTION_CACHE is set to the name of a Django cache, lookups will also be shared through
+    that cache so that all our processes benefit from each other's lookups.
+    """
+    def __init__(self, size=None):
+        if size is None:
+            size = getattr(settings, 'ROUTER_RESOLUTION_CACHE_SIZE', 5000)
+
+        self.backends = LRUCache(size)
+        self.connections = LRUCache(size)
+
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def shared_cache(self):
+        """
+        Returns the Django cache we share our lookups through, if any
+        """
+        alias = getattr(settings, 'ROUTER_RESOLUTION_CACHE', None)
+        if not alias:
+            return None
+
+        from django.core.cache import get_cache
+        return get_cache(alias)
+
+    @classmethod
+    def backend_key(cls, name):
+        return 'httprouter:backend:%s' % name
+
+    @classmethod
+    def connection_key(cls, backend_id, identity):
+        return 'httprouter:connection:%d:%s' % (backend_id, identity)
+
+    def ttl(self):
+        return getattr(settings, 'ROUTER_RESOLUTION_CACHE_TTL', 60)
+
+    def _lookup(self, local, key):
+        value = local.get(key)
+
+        if value is None:
+            shared = self.shared_cache()
+            if shared:
+                value = shared.get(key)
+                if value is not None:
+                    self.shared_hits += 1
+                    local.set(key, value, self.ttl())
+                else:
+                    self.shared_misses += 1
+
+        # hand out copies, apps are free to play with the objects they are given
+        if value is not None:
+            value = copy(value)
+
+        return value
+
+    def _store(self, local, key, value):
+        local.set(key, value, self.ttl())
+
+        shared = self.shared_cache()
+        if shared:
+            shared.set(key, value, self.ttl())
+
+    def _evict(self, local, key):
+        local.delete(key)
+
+        shared = self.shared_cache()
+        if shared:
+            shared.delete(key)
+
+    def get_backend(self, name):
+        """
+        Returns the backend with the passed in name, creating it if necessary
+        """
+        key = ResolutionCache.backend_key(name)
+        backend = self._lookup(self.backends, key)
+        if backend is None:
+            backend, created = Backend.objects.get_or_create(name=name)
+
+            # we only cache backends that we know are committed, one we just created could
+            # still be rolled back by our caller
+            if not created:
+                self._store(self.backends, key, backend)
+
+        return backend
+
+    def get_connection_id(self, backend, identity):
+        """
+        Returns the id of the connection for the passed in backend and identity, creating it if necessary
+        """
+        key = ResolutionCache.connection_key(backend.pk, identity)
+        connection_id = self._lookup(self.connections, key)
+        if connection_id is None:
+            connection_id = Connection.objects.filter(backend=backend, identity=identity).values_list('pk', flat=True)
+
+            # if not found, create it, again we don't cache it until we see it again
+            if not connection_id:
+                connection_id = Connection.objects.create(backend=backend, identity=identity).pk
+            else:
+                connection_id = connection_id[0]
+                self._store(self.connections, key, connection_id)
+
+        return connection_id
+
+    def get_connection_ids(self, backend, identities):
+        """
+        Bulk version of get_connection_id, returns a dict of identity to connection id for all the
+        passed in identities, looking up all the ones we don't know about in a single query and
+        creating any that are missing.
+        """
+        found = dict()
+        missing = set()
+        for identity in identities:
+            if identity in found or identity in missing:
+                continue
+
+            connection_id = self._lookup(self.connections, ResolutionCache.connection_key(backend.pk, identity))
+            if connection_id is None:
+                missing.add(identity)
+            else:
+                found[identity] = connection_id
+
+        if missing:
+            for connection_id, identity in Connection.objects.filter(backend=backend, identity__in=missing).values_list('pk', 'identity'):
+                self._store(self.connections, ResolutionCache.connection_key(backend.pk, identity), connection_id)
+                found[identity] = connection_id
+                missing.discard(identity)
+
+        # whatever is left over is new to us
+        for identity in missing:
+            found[identity] = Connection.objects.create(backend=backend, identity=identity).pk
+
+        return found
+
+    def evict_backend(self, backend):
+        self._evict(self.backends, ResolutionCache.backend_key(backend.name))
+
+    def evict_connection(self, connection):
+        self._evict(self.connections, ResolutionCache.connection_key(connection.backend_id, connection.identity))
+
+    def clear(self):
+        self.backends.clear()
+        self.connections.clear()
+
+    def stats(self):
+        return dict(backends=self.backends.stats(),
+                    connections=self.connections.stats(),
+                    shared_hits=self.shared_hits,
+                    shared_misses=self.shared_misses)
+
+# our process wide cache
+resolution_cache = ResolutionCache()
+
+def evict_backend(sender, instance, **kwargs):
+    resolution_cache.evict_backend(instance)
+
+    # our connections are keyed by backend, play it safe and drop them all
+    resolution_cache.connections.clear()
+
+def evict_connection(sender, instance, **kwargs):
+    resolution_cache.evict_connection(instance)
+
+    # a brand new connection can't be cached under any other key
+    if kwargs.get('created', False):
+        return
+
+    # but an existing one may have just changed identity, so drop whatever we have for its primary key
+    with resolution_cache.connections.lock:
+        stale = [key for key, (connection_id, expires) in resolution_cache.connections.entries.items() if connection_id == instance.pk]
+
+    for key in stale:
+        resolution_cache._evict(resolution_cache.connections, key)
+
+post_save.connect(evict_backend, sender=Backend, dispatch_uid='httprouter_evict_backend_save')
+post_delete.connect(evict_backend, sender=Backend, dispatch_uid='httprouter_evict_backend_delete')
+post_save.connect(evict_connection, sender=Connection, dispatch_uid='httprouter_evict_connection_save')
+post_delete.connect(evict_connection, sender=Connection, dispatch_uid='httprouter_evict_connection_delete')
+
+def cache_lookups():
+    stats = []
+    for name, lru in (('backend', resolution_cache.backends), ('connection', resolution_cache.connections)):
+        stats.append((dict(cache=name, result='hit'), lru.hits))
+        stats.append((dict(cache=name, result='miss'), lru.misses))
+    return stats
+
+def cache_evictions():
+    return [(dict(cache=name), lru.evictions)
+            for name, lru in (('backend', resolution_cache.backends), ('connection', resolution_cache.connections))]
+
+registry.counter('httprouter_resolution_cache_lookups_total', "Lookups made in our backend and connection cache", cache_lookups)
+registry.counter('httprouter_resolution_cache_evictions_total', "Entries evicted from our backend and connection cache", cache_evictions)
@@ -0,0 +1,141 @@
+from django.conf import settings
+from django.db import connection
+from threading import Lock, Timer
+
+from .metrics import registry
+
+import atexit
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DeliveryBuffer(object):
+    """
+    Collects delivery reports and marks their messages as delivered in bulk.  With a window of 0
+    reports are applied as they come in, otherwise they are held for up to window seconds, or until
+    size are waiting, and then flushed together, so a steady stream of delivery reports turns into a
+    handful of updates instead of one per message.
+
+    Messages are stamped with the time their report came in, to the second, so messages reported in
+    the same second are marked with a single update.
+    """
+    def __init__(self, window=0, size=1000):
+        self.window = window
+        self.size = size
+
+        self.pending = dict()
+        self.count = 0
+        self.timer = None
+        self.lock = Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(window=getattr(settings, 'ROUTER_DELIVERED_FLUSH_WINDOW', 0),
+                   size=getattr(settings, 'ROUTER_DELIVERED_FLUSH_SIZE', 1000))
+
+    def add(self, message_ids, delivered=None):
+        """
+        Adds delivery reports for the passed in message ids, returns the number of messages marked as
+        delivered right away, which is 0 if they were buffered.
+        """
+        if delivered is None:
+            delivered = datetime.datetime.now()
+        delivered = delivered.replace(microsecond=0)
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return 0
+
+        if self.window <= 0:
+            return self.mark(delivered, message_ids)
+
+        with self.lock:
+            self.pending.setdefault(delivered, set()).update(message_ids)
+            self.count += len(message_ids)
+            full = self.count >= self.size
+
+            if not full and self.timer is None:
+                self.timer = Timer(self.window, self.flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+
+        return self.flush() if full else 0
+
+    def flush(self):
+        """
+        Marks all our buffered messages as delivered, returns how many were
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = dict()
+            self.count = 0
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        marked = 0
+        for delivered, message_ids in sorted(pending.items()):
+            marked += self.mark(delivered, sorted(message_ids))
+        return marked
+
+    def flush_later(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception("Error marking buffered messages as delivered")
+        finally:
+            # we don't want to hang on to a database connection between flushes
+            connection.close()
+
+    def mark(self, delivered, message_ids):
+        from .router import get_router
+        return get_router().mark_delivered_many(message_ids, delivered)
+
+# our process wide buffer, built from our settings the first time it is used
+delivery_buffer = None
+delivery_buffer_lock = Lock()
+
+def get_delivery_buffer():
+    global delivery_buffer
+    if delivery_buffer is None:
+        with delivery_buffer_lock:
+            if delivery_buffer is None:
+                delivery_buffer = DeliveryBuffer.from_settings()
+    return delivery_buffer
+
+def reset_delivery_buffer():
+    """
+    Flushes anything waiting in our buffer, then rebuilds it from our current settings
+    """
+    global delivery_buffer
+    with delivery_buffer_lock:
+        old, delivery_buffer = delivery_buffer, DeliveryBuffer.from_settings()
+
+    if old is not None:
+        old.flush()
+    return delivery_buffer
+
+def flush_delivery_buffer():
+    """
+    Flushes anything waiting in our buffer, run as our process exits so reports aren't lost on a clean
+    shutdown.  Reports still waiting when a process is killed outright are lost all the same.
+    """
+    if delivery_buffer is None:
+        return 0
+
+    try:
+        return delivery_buffer.flush()
+    except Exception as e:
+        logger.exception("Error marking buffered messages as delivered on exit")
+        return 0
+
+atexit.register(flush_delivery_buffer)
+
+def pending_stats():
+    if delivery_buffer is None:
+        return []
+    return [(dict(), delivery_buffer.count)]
+
+registry.gauge('httprouter_delivered_pending', "Delivery reports waiting to be flushed", pending_stats)
@@ -0,0 +1,291 @@
+from django.conf import settings
+from threading import Lock
+from StringIO import StringIO
+from urllib import addinfourl
+from urlparse import urlsplit, urljoin
+
+from .metrics import registry
+
+import httplib
+import urllib2
+import select
+import socket
+import time
+import os
+
+USER_AGENT = 'Python-urllib/%s' % urllib2.__version__
+
+# how many redirects we follow for a single request, as urllib2 does
+MAX_REDIRECTS = 10
+
+class HTTPConnectionPool(object):
+    """
+    Thread safe pool of keep-alive HTTP connections, keyed by scheme, host and port.  Sending
+    every message through a fresh connection means a new TCP connection (and TLS handshake) to
+    the same Kannel for every message, instead we hand connections back to the pool once their
+    response has been read and reuse them for the next request to the same host.
+
+    size:          the maximum number of idle connections kept per host
+    timeout:       the default socket timeout for requests, in seconds
+    idle_timeout:  idle connections older than this many seconds are closed instead of reused
+    """
+    def __init__(self, size=10, timeout=15, idle_timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+
+        self.lock = Lock()
+        self.reset()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(size=getattr(settings, 'ROUTER_HTTP_POOL_SIZE', 10),
+                   timeout=getattr(settings, 'ROUTER_HTTP_TIMEOUT', 15),
+                   idle_timeout=getattr(settings, 'ROUTER_HTTP_IDLE_TIMEOUT', 30))
+
+    def reset(self):
+        """
+        Forgets about all our connections, closing any idle ones
+        """
+        with self.lock:
+            for connections in getattr(self, 'idle', dict()).values():
+                for connection, last_used in connections:
+                    connection.close()
+
+            # idle connections per host, most recently used last
+            self.idle = dict()
+
+            # number of connections currently handed out, per host
+            self.active = dict()
+
+            self.requests = dict()
+            self.reused = dict()
+            self.pid = os.getpid()
+
+    def check_pid(self):
+        # connections can't be shared with a process we were forked into, start fresh there
+        if self.pid != os.getpid():
+            with self.lock:
+                self.idle = dict()
+                self.active = dict()
+                self.pid = os.getpid()
+
+    def evict_idle(self, now=None):
+        """
+        Closes all connections which have been idle for longer than our idle timeout
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            for key, connections in self.idle.items():
+                fresh = [(c, last_used) for c, last_used in connections if now - last_used < self.idle_timeout]
+                for connection, last_used in connections:
+                    if now - last_used >= self.idle_timeout:
+                        connection.close()
+                self.idle[key] = fresh
+
+    def acquire(self, key, timeout):
+        """
+        Returns a (connection, reused) tuple for the passed in (scheme, host, port) key
+        """
+        self.check_pid()
+        self.evict_idle()
+
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.active[key] = self.active.get(key, 0) + 1
+
+            # skip over any idle connections the server has since closed
+            dropped = []
+            connection = None
+            connections = self.idle.get(key)
+            while connections:
+                connection = connections.pop()[0]
+                if not connection_dropped(connection):
+                    break
+                dropped.append(connection)
+                connection = None
+
+            reused = connection is not None
+            if reused:
+                self.reused[key] = self.reused.get(key, 0) + 1
+
+        for stale in dropped:
+            stale.close()
+
+        if connection is None:
+            scheme, host, port = key
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(host, port, timeout=timeout)
+            else:
+                connection = httplib.HTTPConnection(host, port, timeout=timeout)
+
+        # make sure our timeout applies to whatever this request is
+        connection.timeout = timeout
+        if connection.sock:
+            connection.sock.settimeout(timeout)
+
+        return connection, reused
+
+    def release(self, key, connection, reusable=True):
+        """
+        Hands a connection back to the pool, it is closed instead if it can't be reused or we
+        already have enough idle connections to this host.
+        """
+        with self.lock:
+            self.active[key] = self.active.get(key, 1) - 1
+
+            connections = self.idle.setdefault(key, [])
+            if reusable and connection.sock and len(connections) < self.size:
+                connections.append((connection, time.time()))
+                connection = None
+
+        if connection:
+            connection.close()
+
+    def request(self, key, method, path, data, headers, timeout):
+        """
+        Makes a single request, returning the response and its body.  If a reused connection turns
+        out to have been closed by the server, the request is retried once on a fresh connection, but
+        only when we know the server never saw it: either we couldn't send it at all, or the server hung
+        up without a word.  Timeouts, and any other errors once our request is sent, are never retried,
+        as our backend may well have accepted the message already.
+        """
+        connection, reused = self.acquire(key, timeout)
+        try:
+            sent = False
+            try:
+                connection.request(method, path, data, headers)
+                sent = True
+                response = connection.getresponse()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error), e:
+                if not reused or isinstance(e, socket.timeout) or (sent and not closed_without_response(e)):
+                    raise
+
+                # the server hung up on our idle connection, try again on a new one
+                connection.close()
+                self.release(key, connection, False)
+                connection, reused = self.acquire(key, timeout)
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+
+            body = response.read()
+        except:
+            connection.close()
+            self.release(key, connection, False)
+            raise
+
+        reusable = not response.will_close
+        self.release(key, connection, reusable)
+        return response, body
+
+    def urlopen(self, url, data=None, timeout=None, redirects=0):
+        """
+        Drop in replacement for urllib2.urlopen which reuses our pooled connections.  Just like
+        urlopen, a POST is made when data is passed in, urllib2.HTTPError is raised for error
+        responses and urllib2.URLError when we can't reach the server at all.
+
+        Redirects are followed the way urlopen follows them, by GETting their location without our
+        data, our original url is never requested again.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            return urllib2.urlopen(url, data, timeout)
+
+        port = parts.port or (httplib.HTTPS_PORT if parts.scheme == 'https' else httplib.HTTP_PORT)
+        key = (parts.scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = {'User-Agent': USER_AGENT}
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            response, body = self.request(key, method, path, data, headers, timeout)
+        except (httplib.HTTPException, socket.error), e:
+            raise urllib2.URLError(e)
+
+        # a 307 asks for our POST to be made again elsewhere, which could send our message twice
+        location = response.getheader('location') or response.getheader('uri')
+        if response.status in (301, 302, 303, 307) and location and redirects < MAX_REDIRECTS and \
+           (response.status != 307 or data is None):
+            return self.urlopen(urljoin(url, location), None, timeout, redirects + 1)
+
+        if response.status < 200 or response.status >= 300:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+
+        return addinfourl(StringIO(body), response.msg, url, response.status)
+
+    def stats(self):
+        """
+        Returns a dict of stats for each host we've connected to, keyed by (scheme, host, port)
+        """
+        stats = dict()
+        with self.lock:
+            for key in set(self.requests.keys()) | set(self.idle.keys()):
+                requests = self.requests.get(key, 0)
+                reused = self.reused.get(key, 0)
+                idle = len(self.idle.get(key, []))
+                stats[key] = dict(requests=requests, reused=reused,
+                                  reuse_ratio=float(reused) / requests if requests else 0.0,
+                                  idle=idle, open=idle + self.active.get(key, 0))
+        return stats
+
+def connection_dropped(connection):
+    """
+    Returns whether the server has closed the passed in idle connection, which makes its socket readable
+    """
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+def closed_without_response(e):
+    """
+    Returns whether the passed in error means the server closed our connection without reading our request,
+    in which case httplib sees an empty status line
+    """
+    return isinstance(e, httplib.BadStatusLine) and e.line in ('', repr(''))
+
+# our process wide pool, built from our settings the first time it is used
+http_pool = None
+
+def get_http_pool():
+    global http_pool
+    if http_pool is None:
+        http_pool = HTTPConnectionPool.from_settings()
+    return http_pool
+
+def reset_http_pool():
+    """
+    Closes all our idle connections and rebuilds our pool from our current settings
+    """
+    global http_pool
+    if http_pool:
+        http_pool.reset()
+    http_pool = HTTPConnectionPool.from_settings()
+    return http_pool
+
+def pool_stats(field):
+    def stats():
+        if http_pool is None:
+            return []
+        return [(dict(host="%s://%s:%d" % key), values[field]) for key, values in sorted(http_pool.stats().items())]
+    return stats
+
+registry.counter('httprouter_http_pool_requests_total', "Requests made through our HTTP connection pool", pool_stats('requests'))
+registry.counter('httprouter_http_pool_reused_total', "Requests which reused a pooled keep-alive connection", pool_stats('reused'))
+registry.gauge('httprouter_http_pool_reuse_ratio', "Fraction of requests which reused a pooled connection", pool_stats('reuse_ratio'))
+registry.gauge('httprouter_http_pool_open_connections', "Sockets currently open to each host, idle or in use", pool_stats('open'))
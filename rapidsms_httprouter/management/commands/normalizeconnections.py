@@ -11,10 +11,16 @@ from datetime import datetime
 import traceback
 
 class Command(BaseCommand):
-    help = 'Normalizes all connections in the database, removing everything except digits.'
+    help = 'Normalizes all connections in the database, removing everything except digits and applying our country rules.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--merge', action='store_true', dest='merge', default=False,
+                    help='Merge connections which normalize to an existing connection into it, instead of skipping them'),
+    )
 
     def handle(self, *files, **options):
         connection = connections[DEFAULT_DB_ALIAS]
+        merge = options.get('merge', False)
 
         # Start transaction management. All fixtures are installed in a
         # single transaction to ensure that all references are resolved.
@@ -22,28 +28,55 @@ class Command(BaseCommand):
         transaction.enter_transaction_management()
         transaction.managed(True)
 
+        remapped = merged = skipped = 0
+
         # for every connection
-        for connection in Connection.objects.all():
+        for connection in Connection.objects.all().select_related('backend').iterator():
             # try normalizing the number
-            normalized = HttpRouter.normalize_number(connection.identity)
+            normalized = HttpRouter.normalize_number(connection.identity, connection.backend.name)
 
             # if it is different, then we changed it, first check to see
-            # if there is a connection that is identical.  In that case we don't
-            # change anything, it is too difficult to know who might have a reference
-            # to this connection in the system to remap.
+            # if there is a connection that is identical.  In that case we only
+            # change anything if asked to merge the two, repointing everything
+            # which references this connection to the existing one.
             if normalized != connection.identity:
                 collision = Connection.objects.filter(identity=normalized, backend=connection.backend)
 
                 # no collision!  Ok, we can just save our new identity
                 if not collision:
                     print "remapping %s to %s" % (connection.identity, normalized)
-                    
+
                     connection.identity = normalized
                     connection.save()
+                    remapped += 1
+
+                elif merge:
+                    print "merging %s into %s" % (connection.identity, normalized)
+                    merge_connection(connection, collision[0])
+                    merged += 1
 
                 else:
                     print "skipping %s, collision" % (connection.identity)
+                    skipped += 1
 
         transaction.commit()
+        transaction.leave_transaction_management()
+
+        print "remapped %d connections, merged %d and skipped %d which collided" % (remapped, merged, skipped)
+        if skipped:
+            print "run again with --merge to merge those into the connections they collided with"
+
+def merge_connection(duplicate, connection):
+    """
+    Repoints everything referencing the passed in duplicate connection, its messages first of all, to the
+    passed in connection, then deletes the duplicate.  The contact of the duplicate is kept if the connection
+    has none.
+    """
+    for related in Connection._meta.get_all_related_objects():
+        related.model._base_manager.filter(**{related.field.name: duplicate}).update(**{related.field.name: connection})
 
+    if connection.contact_id is None and duplicate.contact_id is not None:
+        connection.contact_id = duplicate.contact_id
+        connection.save()
 
+    duplicate.delete()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from rapidsms_httprouter.models import MessageBatch
+
+class Command(BaseCommand):
+    args = '[batch_id ...]'
+    help = 'Recomputes the per status message counters of the passed in batches, or all batches, from their messages.'
+
+    def handle(self, *batch_ids, **options):
+        repaired = MessageBatch.recount([int(batch_id) for batch_id in batch_ids] if batch_ids else None)
+        print "repaired the counters of %d batches" % repaired
@@ -0,0 +1,151 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from rapidsms_httprouter.router import HttpRouter
+
+from urllib import quote_plus
+import datetime
+import resource
+import time
+
+def legacy_build_send_url(params, **kwargs):
+    """
+    How build_send_url used to work, re-reading our settings and encoding everything for every message
+    """
+    params.update(kwargs)
+    for k, v in params.items():
+        try:
+            params[k] = quote_plus(str(v))
+        except UnicodeEncodeError:
+            params[k] = quote_plus(str(v.encode('UTF-8')))
+
+    router_url = settings.ROUTER_URL
+    if type(router_url) is dict:
+        router_dict = router_url
+        backend_name = params['backend']
+
+        if backend_name in router_dict:
+            router_url = router_dict[backend_name]
+        elif 'default' in router_dict:
+            router_url = router_dict['default']
+        else:
+            raise Exception("No router url mapping found for backend '%s'" % backend_name)
+
+    return router_url % params
+
+def legacy_fetch(url, params):
+    if hasattr(settings, 'ROUTER_FETCH_URL'):
+        return HttpRouter.definition_from_string(getattr(settings, 'ROUTER_FETCH_URL'))
+    return HttpRouter.fetch_url
+
+def bench_send_pipeline(count):
+    """
+    Compares the per message overhead of building send urls and resolving our fetch function
+    before and after we compiled send pipelines.  No urls are actually fetched.
+    """
+    from rapidsms_httprouter.tasks import send_pipeline
+
+    # we need some url to build
+    if not getattr(settings, 'ROUTER_URL', None):
+        settings.ROUTER_URL = "http://localhost:13013/cgi-bin/sendsms?from=123&text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+    if not getattr(settings, 'ROUTER_FETCH_URL', None):
+        settings.ROUTER_FETCH_URL = 'rapidsms_httprouter.pipeline.default_fetch'
+
+    def params(i):
+        return dict(backend='mtn', recipient='2567712%05d' % i, text=u'Hello w\u00f6rld %d' % i, id=i)
+
+    start = time.time()
+    for i in xrange(count):
+        p = params(i)
+        url = legacy_build_send_url(p)
+        legacy_fetch(url, p)
+    legacy = time.time() - start
+
+    start = time.time()
+    for i in xrange(count):
+        p = params(i)
+        pipeline = send_pipeline(p)
+        url = pipeline.build_url(p)
+        pipeline.fetch
+    compiled = time.time() - start
+
+    return [("legacy", legacy), ("pipeline", compiled)]
+
+def peak_memory():
+    # in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_mass_text(count):
+    """
+    Compares creating a mass text to count connections by building every message in memory and
+    inserting them all at once, as mass_text used to, with our streaming mass_text.  The connections
+    and messages created are deleted again once we're done.
+    """
+    from rapidsms.models import Backend, Connection
+    from rapidsms_httprouter.models import Message, MessageBatch
+
+    backend, created = Backend.objects.get_or_create(name='routerbench')
+    existing = Connection.objects.filter(backend=backend).count()
+    for start in xrange(existing, count, 1000):
+        Connection.objects.bulk_create([Connection(backend=backend, identity='bench%07d' % i)
+                                        for i in xrange(start, min(count, start + 1000))])
+    transaction.commit_unless_managed()
+
+    connections = Connection.objects.filter(backend=backend)
+    batches = []
+    results = []
+    try:
+        # run the streaming version first, so its peak memory isn't hidden by the legacy one's
+        memory = peak_memory()
+        start = time.time()
+        msgs = Message.mass_text("routerbench", connections)
+        results.append(("streaming", time.time() - start))
+        batches.append(msgs.batch.pk)
+        print "streaming    peak memory grew by %dMB" % ((peak_memory() - memory) / 1024)
+
+        memory = peak_memory()
+        start = time.time()
+        batch = MessageBatch.objects.create(status='Q')
+        batches.append(batch.pk)
+        entries = [Message(text="routerbench", date=datetime.datetime.now(), direction='O', status='P',
+                           batch=batch, connection=recipient, priority=10) for recipient in connections]
+        Message.objects.bulk_create(entries)
+        Message.objects.order_by('-pk')[0:connections.count()]
+        transaction.commit_unless_managed()
+        results.append(("legacy", time.time() - start))
+        print "legacy       peak memory grew by %dMB" % ((peak_memory() - memory) / 1024)
+    finally:
+        # deleting through the ORM would load every row, clean up in SQL instead
+        if batches:
+            ids = ','.join(str(pk) for pk in batches)
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM %s WHERE batch_id IN (%s)" % (Message._meta.db_table, ids))
+            cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (MessageBatch._meta.db_table, ids))
+            transaction.commit_unless_managed()
+
+    return results
+
+BENCHMARKS = {
+    'send_pipeline': bench_send_pipeline,
+    'mass_text': bench_mass_text,
+}
+
+class Command(BaseCommand):
+    args = '<benchmark>'
+    help = 'Runs one of our microbenchmarks: %s' % ', '.join(sorted(BENCHMARKS.keys()))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', action='store', type='int', dest='count', default=100000,
+                    help='How many messages to run the benchmark over'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in BENCHMARKS:
+            raise CommandError("Please specify one of: %s" % ', '.join(sorted(BENCHMARKS.keys())))
+
+        count = options['count']
+        for name, elapsed in BENCHMARKS[args[0]](count):
+            print "%-12s %8.3fs total  %8.2fus per message" % (name, elapsed, elapsed * 1000000 / count)
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+from threading import Lock
+import time
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    """
+    In process histogram of observed values.  Observing a value is just a bisect and a few
+    increments, so this is cheap enough to call for every app on every message.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self):
+        """
+        Returns a list of (upper bound, cumulative count) tuples, ending with +Inf
+        """
+        with self.lock:
+            counts = list(self.counts)
+
+        total = 0
+        cumulative = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class Timer(object):
+    """
+    Context manager which observes how long its block took in the passed in histogram
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.start)
+
+
+def format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra:
+        labels.append(extra)
+
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+def format_value(value):
+    if value == '+Inf':
+        return value
+    return repr(float(value))
+
+
+class Registry(object):
+    """
+    Collection of all our metrics, which can be rendered in the Prometheus text format.
+    Gauges and counters are registered as functions which are only called when rendering.
+    """
+    def __init__(self):
+        self.help = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+        self.counters = dict()
+        self.lock = Lock()
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self.histogram(name, **labels))
+
+    def gauge(self, name, help, func):
+        """
+        Registers a gauge, func should return a list of (labels dict, value) tuples
+        """
+        self.help[name] = help
+        self.gauges[name] = func
+
+    def counter(self, name, help, func):
+        """
+        Registers a counter, a value which only ever goes up, its name should end in _total.  func should
+        return a list of (labels dict, value) tuples
+        """
+        self.help[name] = help
+        self.counters[name] = func
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+
+        # group our histograms by name
+        histograms = dict()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            histograms.setdefault(name, []).append((labels, histogram))
+
+        for name, entries in sorted(histograms.items()):
+            if name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s histogram" % name)
+
+            for labels, histogram in entries:
+                for bound, count in histogram.cumulative():
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels, ('le', format_value(bound))), count))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(histogram.sum)))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), histogram.count))
+
+        for kind, funcs in (('gauge', self.gauges), ('counter', self.counters)):
+            for name, func in sorted(funcs.items()):
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in func():
+                    lines.append("%s%s %s" % (name, format_labels(sorted(labels.items())), format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+# our process wide registry
+registry = Registry()
+
+registry.describe('httprouter_app_phase_seconds', "Time spent by each SMS app in each message phase")
+registry.describe('httprouter_send_seconds', "Time spent sending messages, by backend and section")
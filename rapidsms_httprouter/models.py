@@ -1,8 +1,13 @@
 import datetime
 import django
+import uuid
 
-from django.db import models, connections, transaction
+from django.conf import settings
+from django.db import models, connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Count, F
+from django.db.models.sql import InsertQuery
 from django.db.models.query import QuerySet
+from django.template import Context, Template
 
 from rapidsms.models import Contact, Connection
 
@@ -27,14 +32,293 @@ STATUS_CHOICES = (
     ('E', "Errored")
 )
 
+# the MessageBatch field counting the messages in each status
+STATUS_COUNTERS = {
+    'P': 'processing',
+    'L': 'locked',
+    'Q': 'queued',
+    'S': 'sent',
+    'D': 'delivered',
+    'C': 'cancelled',
+    'E': 'errored',
+    'F': 'failed',
+}
+
+# messages in these statuses need no more work, a batch is done once all its messages are
+DONE_STATUSES = ('S', 'D', 'C', 'F')
+
 #Once we start mass_texting, batching messages becomes absolutely necessary
 class MessageBatch(models.Model):
     status = models.CharField(max_length=1, choices=STATUS_CHOICES)
     name = models.CharField(max_length=15,null=True,blank=True)
+
+    # how many messages are in this batch, and how many of them are in each status.  These are kept
+    # up to date as messages are created and change status, run the repairbatchcounts command if they drift
+    total = models.IntegerField(default=0)
+    processing = models.IntegerField(default=0)
+    locked = models.IntegerField(default=0)
+    queued = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    delivered = models.IntegerField(default=0)
+    cancelled = models.IntegerField(default=0)
+    errored = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
     
     def __unicode__(self):
         return '%s %s --> %s' % (self.pk, self.name, self.status) 
-    
+
+    def counts(self):
+        """
+        Returns a dict of status to the number of messages in this batch in that status
+        """
+        return dict((status, getattr(self, field)) for status, field in STATUS_COUNTERS.items())
+
+    @property
+    def done(self):
+        return sum(getattr(self, STATUS_COUNTERS[status]) for status in DONE_STATUSES)
+
+    @property
+    def finished(self):
+        return self.done >= self.total
+
+    @classmethod
+    def finished_filter(cls):
+        """
+        Returns a Q object matching batches all of whose messages are done
+        """
+        done = None
+        for status in DONE_STATUSES:
+            done = F(STATUS_COUNTERS[status]) if done is None else done + F(STATUS_COUNTERS[status])
+        return models.Q(total__lte=done)
+
+    @classmethod
+    def add_counts(cls, changes, using=None):
+        """
+        Applies the passed in dict of batch id to {status: change} to our counters, in a single update.
+        A 'total' entry changes the total number of messages in the batch.
+        """
+        values = dict()
+        for batch_id, deltas in changes.items():
+            for status, delta in deltas.items():
+                field = 'total' if status == 'total' else STATUS_COUNTERS.get(status)
+                if field and delta:
+                    fields = values.setdefault(batch_id, dict())
+                    fields[field] = fields.get(field, 0) + delta
+
+        if len(values) == 1:
+            batch_id, fields = values.items()[0]
+            MessageBatch.objects.using(using).filter(pk=batch_id)\
+                                .update(**dict((field, F(field) + delta) for field, delta in fields.items()))
+
+        elif values:
+            # each batch's change to each counter is picked out with a CASE on its id
+            using = using or DEFAULT_DB_ALIAS
+            qn = connections[using].ops.quote_name
+            sets = []
+            params = []
+            for field in sorted(set(field for fields in values.values() for field in fields)):
+                cases = []
+                for batch_id, fields in values.items():
+                    if fields.get(field):
+                        cases.append("WHEN %s THEN %s")
+                        params += [batch_id, fields[field]]
+                sets.append("%s = %s + CASE %s %s ELSE 0 END" % (qn(field), qn(field), qn('id'), ' '.join(cases)))
+
+            cursor = connections[using].cursor()
+            cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (qn(MessageBatch._meta.db_table), ', '.join(sets), qn('id'),
+                                                                  ', '.join(['%s'] * len(values))),
+                           params + list(values.keys()))
+            transaction.commit_unless_managed(using=using)
+
+    @classmethod
+    def recount(cls, batch_ids=None):
+        """
+        Recomputes the counters of the passed in batches (or all batches) from their messages,
+        returns the number of batches whose counters were wrong.
+        """
+        messages = Message.objects.filter(batch__isnull=False)
+        batches = MessageBatch.objects.all()
+        if batch_ids is not None:
+            messages = messages.filter(batch__in=batch_ids)
+            batches = batches.filter(pk__in=batch_ids)
+
+        counts = dict()
+        for batch_id, status, count in messages.values_list('batch', 'status').annotate(count=Count('id')).order_by():
+            counts.setdefault(batch_id, dict())[status] = count
+
+        repaired = 0
+        for batch in batches.iterator():
+            batch_counts = counts.get(batch.pk, dict())
+            values = dict((field, batch_counts.get(status, 0)) for status, field in STATUS_COUNTERS.items())
+            values['total'] = sum(batch_counts.values())
+
+            if any(getattr(batch, field) != value for field, value in values.items()):
+                MessageBatch.objects.filter(pk=batch.pk).update(**values)
+                repaired += 1
+
+        return repaired
+
+
+def count_change(changes, batch_id, status, delta):
+    """
+    Adds delta messages in the passed in status to the passed in batch, in a dict of changes for add_counts
+    """
+    if batch_id:
+        deltas = changes.setdefault(batch_id, dict())
+        deltas['total'] = deltas.get('total', 0) + delta
+        deltas[status] = deltas.get(status, 0) + delta
+
+class MessageQuerySet(QuerySet):
+    """
+    Keeps the counters on our batches up to date as messages are bulk created, updated, moved
+    between batches and deleted
+    """
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super(MessageQuerySet, self).bulk_create(objs, *args, **kwargs)
+        self.count_created(objs)
+        return created
+
+    def count_created(self, objs):
+        changes = dict()
+        for obj in objs:
+            count_change(changes, obj.batch_id, obj.status, 1)
+        MessageBatch.add_counts(changes, self.db)
+
+    def bulk_insert(self, objs):
+        """
+        Like bulk_create, but also sets the primary key of each of the passed in messages, so they can
+        be used right away without loading them back up.  On PostgreSQL the keys come back from the insert
+        itself, elsewhere our rows are tagged with a unique claimed_by token, which we read them back by,
+        in the order they were inserted, then clear.
+        """
+        if not objs:
+            return objs
+
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            fields = [f for f in Message._meta.local_fields if not isinstance(f, models.AutoField)]
+            query = InsertQuery(Message)
+            query.insert_values(fields, objs)
+            compiler = query.get_compiler(using=self.db)
+            compiler.return_id = False
+            insert, params = compiler.as_sql()[0]
+
+            cursor = connection.cursor()
+            cursor.execute("%s RETURNING %s" % (insert, connection.ops.quote_name(Message._meta.pk.column)), params)
+            ids = [row[0] for row in cursor.fetchall()]
+            transaction.commit_unless_managed(using=self.db)
+        else:
+            # our rows are stamped as updated no earlier than this, which lets us find them through its index
+            start = datetime.datetime.now().replace(microsecond=0)
+            token = "insert:%s" % uuid.uuid4().hex
+            for obj in objs:
+                obj.claimed_by = token
+            QuerySet.bulk_create(self, objs)
+
+            inserted = Message.objects.using(self.db).filter(updated__gte=start, claimed_by=token)
+            ids = list(inserted.order_by('pk').values_list('pk', flat=True))
+            QuerySet.update(inserted, claimed_by=None)
+            for obj in objs:
+                obj.claimed_by = None
+
+        for obj, pk in zip(objs, ids):
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = self.db
+            obj._counted = (obj.batch_id, obj.status)
+
+        self.count_created(objs)
+        return objs
+
+    counted = True
+
+    def uncounted(self):
+        """
+        Returns a copy of this queryset whose updates skip our batch counters, saving the query
+        needed to count them.  Only for updates to messages known not to belong to any batch.
+        """
+        return self._clone(counted=False)
+
+    def outside_batches(self):
+        """
+        Returns whether we are filtered to messages outside any batch, whose updates can't change any counts
+        """
+        batch = Message._meta.get_field('batch')
+
+        def filtered(node):
+            if node.negated or node.connector != 'AND':
+                return False
+
+            for child in node.children:
+                if isinstance(child, tuple):
+                    constraint, lookup, annotation, params = child
+                    if getattr(constraint, 'field', None) is batch and (lookup, annotation) == ('isnull', True):
+                        return True
+                elif filtered(child):
+                    return True
+            return False
+
+        return filtered(self.query.where)
+
+    def update(self, **kwargs):
+        """
+        Updates our messages, counting those which change status or batch against their batches.  Updates
+        which change neither, or are filtered to messages outside any batch, are a single query.  Others first
+        group our messages by batch and status, then update them all at once and move the counters of every
+        batch touched with one more update.  Should messages change status under us in between, the batches
+        involved are recounted instead.
+        """
+        status = kwargs.get('status')
+        moving = 'batch' in kwargs or 'batch_id' in kwargs
+        if (status is None and not moving) or not self.counted or (not moving and self.outside_batches()):
+            return super(MessageQuerySet, self).update(**kwargs)
+
+        batch = kwargs.get('batch_id', kwargs.get('batch'))
+        batch = getattr(batch, 'pk', batch)
+
+        # work out how many messages in each batch are changing from each status
+        groups = list(self.values_list('batch', 'status').annotate(count=Count('id')).order_by())
+        if not groups:
+            return 0
+
+        changes = dict()
+        expected = 0
+        for batch_id, old_status, count in groups:
+            count_change(changes, batch_id, old_status, -count)
+            count_change(changes, batch if moving else batch_id, status or old_status, count)
+            expected += count
+
+        # messages which moved on to a status we didn't count are left out, and give themselves away
+        updated = QuerySet.update(self.filter(status__in=set(old_status for batch_id, old_status, count in groups)), **kwargs)
+        if updated == expected:
+            MessageBatch.add_counts(changes, self.db)
+        else:
+            MessageBatch.recount(list(changes.keys()))
+        return updated
+    update.alters_data = True
+
+    def delete(self):
+        if not self.counted:
+            return super(MessageQuerySet, self).delete()
+
+        groups = list(self.values_list('batch', 'status').annotate(count=Count('id')).order_by())
+        super(MessageQuerySet, self).delete()
+
+        changes = dict()
+        for batch_id, status, count in groups:
+            count_change(changes, batch_id, status, -count)
+        MessageBatch.add_counts(changes, self.db)
+    delete.alters_data = True
+
+
+class MessageManager(models.Manager):
+    def get_query_set(self):
+        return MessageQuerySet(self.model, using=self._db)
+
+    def bulk_insert(self, objs):
+        return self.get_query_set().bulk_insert(objs)
+
+
 class Message(models.Model):
     connection = models.ForeignKey(Connection, related_name='messages')
     text       = models.TextField()
@@ -42,8 +326,9 @@ class Message(models.Model):
     direction  = models.CharField(max_length=1, choices=DIRECTION_CHOICES)
     status     = models.CharField(max_length=1, choices=STATUS_CHOICES)
 
-    date       = models.DateTimeField(auto_now_add=True)
-    updated    = models.DateTimeField(auto_now=True, null=True)
+    # defaulted rather than auto_now_add, so messages can be inserted with their own dates, see HttpRouter.add_messages
+    date       = models.DateTimeField(default=datetime.datetime.now, editable=False)
+    updated    = models.DateTimeField(auto_now=True, null=True, db_index=True)
 
     sent       = models.DateTimeField(null=True, blank=True)
     delivered  = models.DateTimeField(null=True, blank=True)
@@ -54,6 +339,46 @@ class Message(models.Model):
     application = models.CharField(max_length=100, null=True) #which application has handled the message
     in_response_to = models.ForeignKey('self', related_name='responses', null=True, blank=True)
 
+    # which worker has claimed this message for sending, and until when, see Message.claim
+    claimed_by = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # how many times we've failed to send this message, and when we should next try, see retry.RetryPolicy
+    attempts = models.IntegerField(default=0)
+    next_retry_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = MessageManager()
+
+    def __init__(self, *args, **kwargs):
+        super(Message, self).__init__(*args, **kwargs)
+
+        # the batch and status our batch counters have us down as, None if they were deferred
+        if 'batch_id' in self.__dict__ and 'status' in self.__dict__:
+            self._counted = (self.batch_id, self.status)
+        else:
+            self._counted = None
+
+    def save(self, *args, **kwargs):
+        counted = (None, None) if self._state.adding else self._counted
+        super(Message, self).save(*args, **kwargs)
+
+        if counted is not None and (self.batch_id, self.status) != counted:
+            changes = dict()
+            count_change(changes, counted[0], counted[1], -1)
+            count_change(changes, self.batch_id, self.status, 1)
+            MessageBatch.add_counts(changes, self._state.db)
+
+        if counted is not None:
+            self._counted = (self.batch_id, self.status)
+
+    def delete(self, *args, **kwargs):
+        counted = self._counted
+        using = self._state.db
+        super(Message, self).delete(*args, **kwargs)
+
+        if counted is not None and counted[0]:
+            MessageBatch.add_counts({counted[0]: {'total': -1, counted[1]: -1}}, using)
+
     def __unicode__(self):
         # crop the text (to avoid exploding the admin)
         if len(self.text) < 60: str = self.text
@@ -68,6 +393,49 @@ class Message(models.Model):
                     direction=self.direction, status=self.status, text=self.text,
                     date=self.date.isoformat())
 
+    def field_values(self):
+        """
+        Returns a dict of the values of all our fields, pass it to changed_fields later on to find out
+        which of them have changed since
+        """
+        return dict((field.attname, getattr(self, field.attname)) for field in self._meta.local_fields)
+
+    def changed_fields(self, values):
+        return [name for name, value in values.items() if getattr(self, name) != value]
+
+    def as_queryset(self, **filters):
+        """
+        Returns a queryset matching just this message (and the passed in filters), for updating it
+        in place.  Updates to messages outside any batch skip counting them against a batch.
+        """
+        queryset = Message.objects.filter(pk=self.pk, **filters)
+        return queryset if self.batch_id else queryset.uncounted()
+
+    def change_status(self, status, filters=None, **values):
+        """
+        Moves this message from the status we have it down as to the passed in one, along with the passed
+        in values, in a single update.  The update only happens if the message is still in that status and
+        matches the passed in filters, returns whether it did.
+        """
+        filters = dict(filters or dict(), status=self.status)
+        updated = Message.objects.filter(pk=self.pk, **filters).uncounted().update(status=status, **values)
+
+        # we know exactly which status we came from, so we can count the change ourselves
+        if updated and self.batch_id and status != self.status:
+            MessageBatch.add_counts({self.batch_id: {self.status: -1, status: 1}}, self._state.db)
+
+        if updated:
+            self.status = status
+            if self._counted is not None:
+                self._counted = (self.batch_id, status)
+        return bool(updated)
+
+    def claim_filters(self):
+        """
+        Returns the filters which only match this message while our claim on it holds, if we claimed it
+        """
+        return dict(claimed_by=self.claimed_by) if self.claimed_by else dict()
+
     def send(self):
         """
         Triggers our celery task to send this message off.  Note that our dependency to Celery
@@ -79,27 +447,250 @@ class Message(models.Model):
         # send this message off in celery
         send_message_task.delay(self.pk)
         
+    @classmethod
+    def claimable(cls, statuses=('Q', 'E'), now=None):
+        """
+        Returns a Q object matching messages which can be claimed, those in one of the passed in
+        statuses and those whose claim has expired.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        return models.Q(status__in=statuses) | models.Q(status='L', lease_expires__lt=now)
+
+    @classmethod
+    def claim(cls, worker, count=1, lease=None, statuses=('Q', 'E'), queryset=None, values=None):
+        """
+        Atomically claims up to count outgoing messages for the passed in worker, moving them to
+        the 'L' (Locked) status until lease seconds from now, after which other workers can claim them
+        again, unless the claim is renewed.  Only messages in one of the passed in statuses, or whose
+        lease has expired, are claimed, optionally limited to those in the passed in queryset.  Messages
+        are claimed in priority order, returns the list of claimed messages, or dicts of the passed in
+        values for each if any are given.
+
+        On databases that support it, rows locked by other workers' claims are skipped using
+        SELECT ... FOR UPDATE SKIP LOCKED, elsewhere we select candidates and claim them with an
+        UPDATE conditional on them still being claimable, so a message is never claimed twice.
+        """
+        if lease is None:
+            lease = getattr(settings, 'ROUTER_CLAIM_LEASE', 60)
+
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease)
+
+        # every claim gets its own token, so we can read back exactly the rows we claimed
+        token = ("%s:%s" % (worker, uuid.uuid4().hex[:12]))[-64:]
+
+        if queryset is None:
+            queryset = Message.objects.filter(direction='O')
+        candidates = queryset.filter(Message.claimable(statuses, now)).order_by('priority', 'pk')
+
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and getattr(connection, 'pg_version', 0) >= 90500:
+            sql, params = candidates.values_list('pk', 'batch', 'status')[:count].query.sql_with_params()
+            cursor = connection.cursor()
+            table = connection.ops.quote_name(Message._meta.db_table)
+            cursor.execute("UPDATE %s SET status = 'L', claimed_by = %%s, lease_expires = %%s, updated = %%s "
+                           "FROM (%s FOR UPDATE OF %s SKIP LOCKED) AS claimed WHERE %s.id = claimed.id "
+                           "RETURNING claimed.id, claimed.batch_id, claimed.status" % (table, sql, table, table),
+                           [token, expires, now] + list(params))
+
+            # our raw update skips our queryset, so count the claimed messages against their batches here
+            changes = dict()
+            claimed_ids = []
+            for message_id, batch_id, status in cursor.fetchall():
+                claimed_ids.append(message_id)
+                if batch_id:
+                    deltas = changes.setdefault(batch_id, dict())
+                    deltas[status] = deltas.get(status, 0) - 1
+                    deltas['L'] = deltas.get('L', 0) + 1
+            MessageBatch.add_counts(changes, queryset.db)
+
+            transaction.commit_unless_managed(using=queryset.db)
+        else:
+            claimed_ids = list(candidates.values_list('pk', flat=True)[:count])
+            Message.objects.filter(Message.claimable(statuses, now), pk__in=claimed_ids)\
+                           .update(status='L', claimed_by=token, lease_expires=expires, updated=now)
+
+        # read back by primary key, only the candidates we actually won carry our token
+        if not claimed_ids:
+            return []
+        claimed = Message.objects.filter(pk__in=claimed_ids, claimed_by=token, status='L').order_by('priority', 'pk')
+        if values:
+            return list(claimed.values(*values))
+        return list(claimed.select_related('connection__backend'))
+
+    @classmethod
+    def renew_claims(cls, token, message_ids, lease=None):
+        """
+        Extends the claim made with the passed in token on the passed in messages to lease seconds
+        from now, so messages which take a while to get to aren't reclaimed from under us.  Returns
+        the number of messages we still hold.
+        """
+        if lease is None:
+            lease = getattr(settings, 'ROUTER_CLAIM_LEASE', 60)
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return 0
+
+        now = datetime.datetime.now()
+        return Message.objects.filter(pk__in=message_ids, claimed_by=token, status='L')\
+                              .update(lease_expires=now + datetime.timedelta(seconds=lease))
+
+    @classmethod
+    def reclaim_expired(cls, status='Q'):
+        """
+        Puts messages whose claim has expired, most likely because their worker died, back in
+        the passed in status.  Returns the number of messages reclaimed.
+        """
+        now = datetime.datetime.now()
+        return Message.objects.filter(status='L', lease_expires__lt=now).update(status=status, claimed_by=None,
+                                                                                lease_expires=None, updated=now)
+
     #Some times its necessary to Mass insert messages
     @classmethod
     @transaction.commit_on_success
-    def mass_text(cls, text, connections, status='P', batch_status='Q', batch_name=None):
-        
+    def mass_text(cls, text, connections, status='P', batch_status='Q', batch_name=None, chunk_size=None):
+        """
+        Creates a message with the passed in text to each of the passed in connections, all in a
+        new batch.  Connections can be a queryset or any iterable of connections or connection ids,
+        they are read and inserted chunk_size (ROUTER_MASS_TEXT_CHUNK_SIZE, default 1000) at a time
+        so memory use doesn't grow with the number of recipients.
+
+        Returns a lazy queryset of exactly the messages created, its batch attribute is their MessageBatch.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'ROUTER_MASS_TEXT_CHUNK_SIZE', 1000)
+
+        entries = ((connection_id, text) for connection_ids in chunked_ids(connections, chunk_size)
+                                         for connection_id in connection_ids)
+        return cls.mass_insert(entries, status, batch_status, batch_name, chunk_size)
+
+    @classmethod
+    @transaction.commit_on_success
+    def mass_template(cls, template, rows, status='P', batch_status='Q', batch_name=None, chunk_size=None):
+        """
+        Like mass_text, but each message has its own text, rendered from the passed in template for
+        each (connection, context) in rows.  The template can be a compiled Django template or a
+        string, it is compiled once, and rendered without autoescaping as our messages aren't HTML.
+        Rows are read, rendered and inserted chunk_size at a time, so rows can be a generator.
+        """
+        if isinstance(template, basestring):
+            template = Template(template)
+
+        def render():
+            context = Context(autoescape=False)
+            for connection, values in rows:
+                context.update(values)
+                try:
+                    yield (getattr(connection, 'pk', connection), template.render(context))
+                finally:
+                    context.pop()
+
+        return cls.mass_insert(render(), status, batch_status, batch_name, chunk_size)
+
+    @classmethod
+    def mass_insert(cls, entries, status='P', batch_status='Q', batch_name=None, chunk_size=None):
+        """
+        Creates a message for each (connection id, text) in entries in a new batch, chunk_size
+        at a time, then lets everybody know through our mass_text_sent signal.  Returns a lazy
+        queryset of the messages created, its batch attribute is their MessageBatch.
+
+        If ROUTER_MASS_TEXT_PHASES is set, each chunk is run through our router's outgoing phases
+        and the messages apps cancel are marked as cancelled, with a single update.  Messages apps
+        change in any other way are saved one by one, changes and all.
+        """
         #imported here to make the dependency on celery soft
         from tasks import queue_messages_task
         msg_batch = MessageBatch.objects.create(status=batch_status, name=batch_name)
-        entries = []
-        
-        for connection in connections:
-            entries += [Message(text=text, date=datetime.datetime.now(), direction='O', status=status, batch=msg_batch, connection=connection, priority=10)]
-        Message.objects.bulk_create(entries)
 
-        toret = Message.objects.order_by('-pk')[0:connections.count()]
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'ROUTER_MASS_TEXT_CHUNK_SIZE', 1000)
+
+        router = None
+        if getattr(settings, 'ROUTER_MASS_TEXT_PHASES', False):
+            from .router import get_router
+            router = get_router()
+
+        def count(status, change):
+            # keep our copy of the batch counters in step with the database
+            if status in STATUS_COUNTERS:
+                setattr(msg_batch, STATUS_COUNTERS[status], getattr(msg_batch, STATUS_COUNTERS[status]) + change)
+
+        last = 0
+        chunk = []
+        entries = iter(entries)
+        while True:
+            for connection_id, text in entries:
+                chunk.append(Message(text=text, direction='O', status=status, batch=msg_batch,
+                                     connection_id=connection_id, priority=10))
+                if len(chunk) >= chunk_size:
+                    break
+
+            if not chunk:
+                break
+
+            Message.objects.bulk_create(chunk)
+            msg_batch.total += len(chunk)
+            count(status, len(chunk))
+            chunk = []
+
+            if router and [phase for phase in router.outgoing_phases if router.phase_apps(phase)]:
+                # nobody else adds to our batch, so the messages we haven't seen yet are the ones we just inserted
+                created = list(msg_batch.messages.filter(pk__gt=last).select_related('connection').order_by('pk'))
+                last = created[-1].pk
+
+                values = [msg.field_values() for msg in created]
+                cancelled = []
+                for msg, before, send_msg in zip(created, values, router.run_outgoing_phases_many(created)):
+                    if set(msg.changed_fields(before)) - set(['status', 'updated']):
+                        msg.save()
+                    elif not send_msg:
+                        cancelled.append(msg.pk)
+
+                    if not send_msg:
+                        count(status, -1)
+                        count('C', 1)
+
+                if cancelled:
+                    Message.objects.filter(pk__in=cancelled).update(status='C', updated=datetime.datetime.now())
+
+        toret = msg_batch.messages.all()
+        toret.batch = msg_batch
         
         #respond to these messages by queuing them up in celery
 #        queue_messages_task.delay(toret)
         mass_text_sent.send(sender=msg_batch, messages=toret, status=status)
         return toret
 
+def chunked_ids(objects, chunk_size):
+    """
+    Yields the ids of the passed in queryset, or iterable of objects or ids, in lists of up to
+    chunk_size.  Querysets are paged through by primary key, so only one chunk is ever in memory.
+    """
+    if isinstance(objects, QuerySet) and not objects.query.low_mark and objects.query.high_mark is None:
+        last = None
+        while True:
+            page = objects.order_by('pk')
+            if last is not None:
+                page = page.filter(pk__gt=last)
+
+            ids = list(page.values_list('pk', flat=True)[:chunk_size])
+            if ids:
+                yield ids
+            if len(ids) < chunk_size:
+                break
+            last = ids[-1]
+    else:
+        ids = []
+        for obj in objects:
+            ids.append(getattr(obj, 'pk', obj))
+            if len(ids) >= chunk_size:
+                yield ids
+                ids = []
+        if ids:
+            yield ids
+
 class DeliveryError(models.Model):
     """
     Simple class to keep track of delivery errors for messages.  We retry up to three times before
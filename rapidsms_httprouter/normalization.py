@@ -0,0 +1,123 @@
+from django.conf import settings
+
+from .cache import LRUCache
+
+import re
+
+class NumberRules(object):
+    """
+    The rules used to canonicalize the numbers of a backend.
+
+    country_code:           the country code to add to local numbers, ie: '257', if None
+                            numbers are only stripped of everything but digits and letters
+    trunk_prefixes:         prefixes dialed before local numbers, ie: '0', these are removed
+                            before adding the country code
+    international_prefixes: prefixes dialed before international numbers, ie: '00', these
+                            are removed, as is a leading +
+    local_lengths:          the lengths of local numbers (without trunk prefix), if set only
+                            numbers of these lengths will have the country code added, otherwise
+                            only numbers dialed with a trunk prefix will
+    """
+    def __init__(self, country_code=None, trunk_prefixes=('0',), international_prefixes=('00',), local_lengths=None):
+        self.country_code = country_code
+        self.trunk_prefixes = sorted(trunk_prefixes or (), key=len, reverse=True)
+        self.international_prefixes = sorted(international_prefixes or (), key=len, reverse=True)
+        self.local_lengths = set(local_lengths) if local_lengths else None
+
+    def update(self, **overrides):
+        """
+        Returns a copy of these rules with the passed in values overridden
+        """
+        values = dict(country_code=self.country_code,
+                      trunk_prefixes=self.trunk_prefixes,
+                      international_prefixes=self.international_prefixes,
+                      local_lengths=self.local_lengths)
+        values.update(overrides)
+        return NumberRules(**values)
+
+    def is_local(self, number, prefixed=False):
+        """
+        Returns whether the passed in number, stripped of any trunk prefix, is a local number.  Without
+        local_lengths a bare number could just as well be a shortcode or a foreign number missing its +,
+        so only numbers dialed with a trunk prefix are taken to be local.
+        """
+        if self.local_lengths:
+            return len(number) in self.local_lengths
+        return prefixed
+
+    def canonicalize(self, number):
+        international = number.startswith('+')
+        number = re.sub('[^0-9a-z]', '', number)
+
+        # nothing more to do for shortcodes or if we don't know our country
+        if not self.country_code or not number.isdigit():
+            return number
+
+        # explicitly international, just remove the prefix
+        if international:
+            return number
+
+        for prefix in self.international_prefixes:
+            if number.startswith(prefix):
+                return number[len(prefix):]
+
+        for prefix in self.trunk_prefixes:
+            if number.startswith(prefix) and self.is_local(number[len(prefix):], True):
+                return self.country_code + number[len(prefix):]
+
+        if self.is_local(number):
+            return self.country_code + number
+
+        return number
+
+
+class NumberNormalizer(object):
+    """
+    Canonicalizes phone numbers according to the rules for their backend, so that the same
+    phone always ends up with the same identity no matter how it was written.  Results are
+    memoized, as we see the same numbers over and over.
+    """
+    def __init__(self, rules=None, backend_rules=None, cache_size=10000):
+        self.rules = rules or NumberRules(None)
+        self.backend_rules = backend_rules or dict()
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def from_settings(cls):
+        rules = NumberRules(country_code=getattr(settings, 'ROUTER_COUNTRY_CODE', None),
+                            trunk_prefixes=getattr(settings, 'ROUTER_TRUNK_PREFIXES', ('0',)),
+                            international_prefixes=getattr(settings, 'ROUTER_INTERNATIONAL_PREFIXES', ('00',)),
+                            local_lengths=getattr(settings, 'ROUTER_LOCAL_NUMBER_LENGTHS', None))
+
+        backend_rules = dict()
+        for backend, overrides in getattr(settings, 'ROUTER_NUMBER_RULES', {}).items():
+            backend_rules[backend] = rules.update(**overrides)
+
+        return cls(rules, backend_rules, getattr(settings, 'ROUTER_NUMBER_CACHE_SIZE', 10000))
+
+    def normalize(self, number, backend=None):
+        key = (backend, number)
+        normalized = self.cache.get(key)
+        if normalized is None:
+            rules = self.backend_rules.get(backend, self.rules)
+            normalized = rules.canonicalize(number.strip().lower())
+            self.cache.set(key, normalized)
+
+        return normalized
+
+# our normalizer, built from our settings when the router starts
+normalizer = None
+
+def get_normalizer():
+    global normalizer
+    if normalizer is None:
+        normalizer = NumberNormalizer.from_settings()
+    return normalizer
+
+def reset_normalizer():
+    """
+    Rebuilds our normalizer from our current settings
+    """
+    global normalizer
+    normalizer = NumberNormalizer.from_settings()
+    return normalizer
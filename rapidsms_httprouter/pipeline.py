@@ -0,0 +1,133 @@
+from django.conf import settings
+from threading import Lock
+from urllib import quote_plus
+
+from .router import HttpRouter
+
+def encode_param(value):
+    """
+    URL encodes the passed in parameter value, unicode values are UTF-8 encoded first
+    """
+    if isinstance(value, unicode):
+        return quote_plus(value.encode('UTF-8'))
+    elif type(value) in (int, long):
+        return str(value)
+    else:
+        return quote_plus(str(value))
+
+def default_fetch(url, params):
+    # looked up on every call, as apps and tests monkey patch over it
+    return HttpRouter.fetch_url(url, params)
+
+
+class SendPipeline(object):
+    """
+    Everything needed to send a message through a backend, worked out once instead of for
+    every message: the url template, our encoded backend name, and the function used to fetch urls.
+    """
+    def __init__(self, backend, url, fetch):
+        self.backend = backend
+        self.url = url
+        self.fetch = fetch
+
+        # our backend is in every message, so encode it once
+        self.encoded_backend = encode_param(backend)
+
+    def build_url(self, params):
+        """
+        Builds the url for the passed in parameters.  Note that like build_send_url always has,
+        this URL encodes the passed in params in place.
+        """
+        for k, v in params.items():
+            if k == 'backend' and v == self.backend:
+                params[k] = self.encoded_backend
+            else:
+                params[k] = encode_param(v)
+
+        return self.url % params
+
+
+def resolve_url(router_url, backend):
+    """
+    Looks up the url template for the passed in backend in our ROUTER_URL setting
+    """
+    # is this actually a dict?  if so, we want to look up the appropriate backend
+    if type(router_url) is dict:
+        router_dict = router_url
+
+        # is there an entry for this backend?
+        if backend in router_dict:
+            router_url = router_dict[backend]
+
+        # if not, look for a default backend
+        elif 'default' in router_dict:
+            router_url = router_dict['default']
+
+        # none?  blow the hell up
+        else:
+            raise Exception("No router url mapping found for backend '%s', check your settings.ROUTER_URL setting" % backend)
+
+    return router_url
+
+
+class SendPipelines(object):
+    """
+    Our compiled pipelines, by backend.  These are thrown away and rebuilt whenever the settings
+    they are built from change.
+    """
+    def __init__(self):
+        self.pipelines = dict()
+        self.signature = None
+        self.fetch = None
+        self.lock = Lock()
+
+    def check(self):
+        """
+        Throws away our pipelines if the settings they were built from have changed
+        """
+        signature = (getattr(settings, 'ROUTER_URL', None), getattr(settings, 'ROUTER_FETCH_URL', None))
+        if self.signature is None or signature[0] is not self.signature[0] or signature[1] != self.signature[1]:
+            with self.lock:
+                self.pipelines = dict()
+                self.fetch = None
+                self.signature = signature
+
+    def get_fetch(self, check=True):
+        """
+        Returns the function used to fetch urls, either ROUTER_FETCH_URL or our router's fetch_url
+        """
+        if check:
+            self.check()
+
+        if self.fetch is None:
+            if getattr(settings, 'ROUTER_FETCH_URL', None):
+                self.fetch = HttpRouter.definition_from_string(settings.ROUTER_FETCH_URL)
+            else:
+                self.fetch = default_fetch
+        return self.fetch
+
+    def get(self, backend, url=None):
+        """
+        Returns the pipeline for the passed in backend, url can be passed in to override the url
+        configured in ROUTER_URL for this backend.
+        """
+        self.check()
+
+        key = (backend, url)
+        pipeline = self.pipelines.get(key)
+        if pipeline is None:
+            pipeline = SendPipeline(backend, url or resolve_url(settings.ROUTER_URL, backend), self.get_fetch(False))
+            self.pipelines[key] = pipeline
+
+        return pipeline
+
+    def reset(self):
+        with self.lock:
+            self.pipelines = dict()
+            self.fetch = None
+            self.signature = None
+
+send_pipelines = SendPipelines()
+
+def get_pipeline(backend, url=None):
+    return send_pipelines.get(backend, url)
@@ -0,0 +1,235 @@
+from django.conf import settings
+from threading import Lock
+
+from .metrics import registry
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# how long we stick with our in-memory buckets after failing to reach redis, in seconds
+REDIS_RETRY_INTERVAL = 30
+
+# takes tokens from a bucket stored in a redis hash, refilling it for the time since it was
+# last touched, by the clock of the redis server so that workers whose clocks differ agree.  ARGV
+# is rate, capacity, tokens wanted and whether to reserve them if they aren't available yet.
+# Returns whether the tokens were taken and how long until they can be used.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+
+-- reading the time before writing needs our effects replicated rather than our script, before redis 5
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or capacity
+local stamp = tonumber(state[2]) or now
+
+if now > stamp then
+    tokens = math.min(capacity, tokens + (now - stamp) * rate)
+    stamp = now
+end
+
+local taken = 0
+local wait = 0
+if tokens >= wanted then
+    tokens = tokens - wanted
+    taken = 1
+elseif reserve == 1 then
+    tokens = tokens - wanted
+    taken = 1
+    wait = -tokens / rate
+else
+    wait = (wanted - tokens) / rate
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(stamp))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 60)
+return {taken, tostring(wait), tostring(tokens)}
+"""
+
+class TokenBucket(object):
+    """
+    In-memory token bucket, holding up to capacity tokens and refilled at rate tokens per second.
+    """
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.stamp = clock()
+        self.lock = Lock()
+
+    def take(self, wanted=1, reserve=False):
+        """
+        Takes the wanted number of tokens, returns a (taken, wait) tuple.  If reserve is True the
+        tokens are always taken, wait being how long the caller must wait before using them.
+        Otherwise they are only taken if available right away, wait being how long until they are.
+        """
+        with self.lock:
+            self.refill()
+
+            if self.tokens >= wanted:
+                self.tokens -= wanted
+                return (True, 0.0)
+            elif reserve:
+                self.tokens -= wanted
+                return (True, -self.tokens / self.rate)
+            else:
+                return (False, (wanted - self.tokens) / self.rate)
+
+    def refill(self):
+        now = self.clock()
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return max(0, int(self.tokens))
+
+
+class RedisTokenBucket(object):
+    """
+    Token bucket kept in redis, so that it is shared by all our workers, and refilled by the redis server's clock
+    """
+    def __init__(self, client, key, rate, capacity):
+        self.client = client
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    def call(self, wanted, reserve):
+        return self.script(keys=[self.key], args=[repr(self.rate), repr(self.capacity), wanted, 1 if reserve else 0])
+
+    def take(self, wanted=1, reserve=False):
+        taken, wait, tokens = self.call(wanted, reserve)
+        return (bool(taken), float(wait))
+
+    def available(self):
+        taken, wait, tokens = self.call(0, False)
+        return max(0, int(float(tokens)))
+
+
+class RateLimiter(object):
+    """
+    Limits how fast we send through each backend.  limits is a dict of backend name to either a
+    number of messages per second, or a (messages per second, burst) tuple, backends without a limit
+    are never throttled.
+
+    If a redis client is passed in our buckets are kept in redis, so the limits hold across all our
+    workers.  If redis can't be reached we fall back to in-memory buckets for a little while.
+    """
+    def __init__(self, limits=None, client=None):
+        self.limits = dict()
+        for backend, limit in (limits or dict()).items():
+            if isinstance(limit, (tuple, list)):
+                rate, capacity = limit
+            else:
+                rate, capacity = limit, max(1, limit)
+            self.limits[backend] = (float(rate), float(capacity))
+
+        self.client = client
+        self.redis_failed = 0
+        self.buckets = dict()
+        self.redis_buckets = dict()
+        self.lock = Lock()
+
+    @classmethod
+    def from_settings(cls):
+        limits = getattr(settings, 'ROUTER_RATE_LIMITS', {})
+
+        client = None
+        if limits and getattr(settings, 'ROUTER_RATE_LIMIT_SHARED', True) and getattr(settings, 'REDIS_HOST', None):
+            import redis
+            client = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+        return cls(limits, client)
+
+    def bucket(self, backend, shared=True):
+        """
+        Returns the bucket for the passed in backend, or None if it isn't limited
+        """
+        limit = self.limits.get(backend)
+        if limit is None:
+            return None
+
+        buckets = self.redis_buckets if shared else self.buckets
+        bucket = buckets.get(backend)
+        if bucket is None:
+            with self.lock:
+                if shared:
+                    bucket = buckets.setdefault(backend, RedisTokenBucket(self.client, 'httprouter:ratelimit:%s' % backend, *limit))
+                else:
+                    bucket = buckets.setdefault(backend, TokenBucket(*limit))
+        return bucket
+
+    def call(self, backend, method, *args):
+        """
+        Calls the passed in method on the bucket for our backend, through redis if we can
+        """
+        if self.client and time.time() - self.redis_failed > REDIS_RETRY_INTERVAL:
+            try:
+                return getattr(self.bucket(backend), method)(*args)
+            except Exception as e:
+                logger.warning("Unable to rate limit through redis, using in-memory limits: %s" % e)
+                self.redis_failed = time.time()
+
+        return getattr(self.bucket(backend, False), method)(*args)
+
+    def wait(self, backend, count=1):
+        """
+        Blocks until we can send count messages through the passed in backend, returns how long we waited
+        """
+        if backend not in self.limits:
+            return 0
+
+        taken, wait = self.call(backend, 'take', count, True)
+        if wait > 0:
+            registry.observe('httprouter_rate_limit_wait_seconds', wait, backend=backend)
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self, backend, count=1):
+        """
+        Takes count tokens for the passed in backend if they are available right away, returns whether they were
+        """
+        if backend not in self.limits:
+            return True
+        return self.call(backend, 'take', count, False)[0]
+
+    def available(self, backend):
+        """
+        Returns how many messages can be sent through the passed in backend right now, None if it isn't limited
+        """
+        if backend not in self.limits:
+            return None
+        return self.call(backend, 'available')
+
+# our process wide limiter, built from our settings the first time it is used
+rate_limiter = None
+
+def get_rate_limiter():
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = RateLimiter.from_settings()
+    return rate_limiter
+
+def reset_rate_limiter():
+    """
+    Rebuilds our limiter from our current settings
+    """
+    global rate_limiter
+    rate_limiter = RateLimiter.from_settings()
+    return rate_limiter
+
+registry.describe('httprouter_rate_limit_wait_seconds', "Time spent waiting on the rate limit of each backend")
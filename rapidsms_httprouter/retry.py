@@ -0,0 +1,49 @@
+from django.conf import settings
+
+import datetime
+import random
+
+class RetryPolicy(object):
+    """
+    Works out when a message which failed to send should be tried again.  Delays grow
+    exponentially with the number of attempts, from base seconds up to max_delay seconds,
+    and are randomly shortened by up to jitter (a fraction of the delay) so that messages
+    which failed together during an outage don't all come back at the same moment.
+
+    budgets is a dict of backend name to how many messages can be retried through that
+    backend per retry run, default_budget applies to all other backends.
+    """
+    def __init__(self, base=30, factor=2, max_delay=3600, jitter=0.5, budgets=None, default_budget=100):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budgets = budgets or dict()
+        self.default_budget = default_budget
+
+    @classmethod
+    def from_settings(cls):
+        return cls(base=getattr(settings, 'ROUTER_RETRY_BASE_DELAY', 30),
+                   factor=getattr(settings, 'ROUTER_RETRY_BACKOFF', 2),
+                   max_delay=getattr(settings, 'ROUTER_RETRY_MAX_DELAY', 3600),
+                   jitter=getattr(settings, 'ROUTER_RETRY_JITTER', 0.5),
+                   budgets=getattr(settings, 'ROUTER_RETRY_BUDGETS', {}),
+                   default_budget=getattr(settings, 'ROUTER_RETRY_BUDGET', 100))
+
+    def delay(self, attempts):
+        """
+        Returns how many seconds to wait before trying a message which failed attempts times again
+        """
+        delay = min(self.max_delay, self.base * (self.factor ** max(0, attempts - 1)))
+        return delay * (1 - random.random() * self.jitter)
+
+    def next_retry(self, attempts, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        return now + datetime.timedelta(seconds=self.delay(attempts))
+
+    def budget(self, backend):
+        return self.budgets.get(backend, self.default_budget)
+
+def get_retry_policy():
+    return RetryPolicy.from_settings()
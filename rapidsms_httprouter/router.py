@@ -1,12 +1,18 @@
 from django.conf import settings
 from django.db import transaction
+from django.core.signals import request_finished
 from .models import Message
+from .cache import resolution_cache
+from .metrics import registry
+from .normalization import get_normalizer, reset_normalizer
+from .httppool import get_http_pool
 from rapidsms.models import Backend, Connection
 from rapidsms.apps.base import AppBase
 from rapidsms.messages.incoming import IncomingMessage
 from rapidsms.messages.outgoing import OutgoingMessage
 #from rapidsms.log.mixin import LoggerMixin
-from threading import Lock, Thread
+from threading import Lock, RLock, Thread, local
+from Queue import Queue
 
 from urllib import quote_plus
 from urllib2 import urlopen
@@ -34,26 +40,38 @@ class HttpRouter(object):
         # we need to be started
         self.started = False
 
+        # our local workers for handling messages in the background, only started if needed
+        self.workers = None
+
+        # per phase list of the apps to call, built when we start
+        self.dispatch = dict()
+        self.dispatch_apps = None
+
     @classmethod
     def fetch_url(cls, url, params):
         """
         Wrapper around url open, mostly here so we can monkey patch over it in unit tests, though
         in some cases apps may monkey patch this to deal with secondary urls.
+
+        Requests go through our pool of keep-alive connections, so we don't open a new
+        connection to our backend for every message.
         """
         if getattr(settings, 'ROUTER_HTTP_METHOD', 'GET') == 'GET':
-            response = urlopen(url, timeout=15)
+            response = get_http_pool().urlopen(url)
         else:
-            response = urlopen(url, " ", timeout=15)
-        
+            response = get_http_pool().urlopen(url, " ")
+
         return response
 
     @classmethod
-    def normalize_number(cls, number):
+    def normalize_number(cls, number, backend=None):
         """
         Normalizes the passed in number, they should be only digits, some backends prepend + and
-        maybe crazy users put in dashes or parentheses in the console.
+        maybe crazy users put in dashes or parentheses in the console.  If ROUTER_COUNTRY_CODE is
+        set, local and international forms of the same number are also canonicalized to a single
+        identity, optionally using rules specific to the passed in backend name.
         """
-        return re.sub('[^0-9a-z]', '', number.lower())
+        return get_normalizer().normalize(number, backend)
 
     def add_message(self, backend, contact, text, direction, status):
         """
@@ -63,21 +81,15 @@ class HttpRouter(object):
         # lookup / create this backend
         # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse 
         # any backends not found in our settings.  But I hate dropping messages on the floor.
-        backend, created = Backend.objects.get_or_create(name=backend)
-        contact = HttpRouter.normalize_number(contact)
+        backend = resolution_cache.get_backend(backend)
+        contact = HttpRouter.normalize_number(contact, backend.name)
 
-        # try to find a connection
-        connection = Connection.objects.filter(backend=backend, identity=contact)
-
-        # if not found, create it
-        if not connection:
-            connection = Connection.objects.create(backend=backend, identity=contact)
-        else:
-            connection = connection[0]
+        # find or create our connection, it is loaded from the database when it is needed
+        connection_id = resolution_cache.get_connection_id(backend, contact)
 
         # force to unicode
         text = unicode(text)
-        message = Message.objects.create(connection=connection,
+        message = Message.objects.create(connection_id=connection_id,
                                          text=text,
                                          direction=direction,
                                          status=status)
@@ -87,19 +99,238 @@ class HttpRouter(object):
         """
         Marks a message as delivered by the backend.
         """
-        message = Message.objects.get(pk=message_id)
-        message.status = 'D'
-        message.delivered = datetime.datetime.now()
-        message.save()
+        return self.mark_delivered_many([message_id])
+
+    def mark_delivered_many(self, message_ids, delivered=None):
+        """
+        Bulk version of mark_delivered, marks all the messages with the passed in ids as delivered
+        at delivered (or now) using one update per ROUTER_DELIVERED_CHUNK_SIZE messages.
+
+        Returns the number of messages marked as delivered.
+        """
+        if delivered is None:
+            delivered = datetime.datetime.now()
+
+        message_ids = list(message_ids)
+        chunk_size = getattr(settings, 'ROUTER_DELIVERED_CHUNK_SIZE', 500)
+
+        marked = 0
+        for i in range(0, len(message_ids), chunk_size):
+            marked += Message.objects.filter(pk__in=message_ids[i:i + chunk_size]).update(status='D', delivered=delivered,
+                                                                                          updated=delivered)
+        return marked
+
+    def add_messages(self, entries, direction, status, batch=None):
+        """
+        Bulk version of add_message, takes a list of (backend, contact, text, date) tuples and
+        adds them all to the db using a single insert.  date may be None, in which case the
+        message is stamped with the current time.
+
+        Returns the created messages, in the same order as the passed in entries.
+        """
+        if not entries:
+            return []
+
+        # resolve all our connections, grouped by backend
+        identities = dict()
+        for backend, contact, text, date in entries:
+            identities.setdefault(backend, set()).add(HttpRouter.normalize_number(contact, backend))
+
+        connections = dict()
+        for backend_name, contacts in identities.items():
+            backend = resolution_cache.get_backend(backend_name)
+            for identity, connection_id in resolution_cache.get_connection_ids(backend, contacts).items():
+                connections[(backend_name, identity)] = connection_id
+
+        # messages without a date of their own are stamped with the current time
+        created = []
+        for backend, contact, text, date in entries:
+            connection_id = connections[(backend, HttpRouter.normalize_number(contact, backend))]
+            created.append(Message(connection_id=connection_id,
+                                   text=unicode(text),
+                                   direction=direction,
+                                   status=status,
+                                   batch=batch,
+                                   date=date or datetime.datetime.now()))
+        Message.objects.bulk_insert(created)
+
+        return created
 
     def handle_incoming(self, backend, sender, text):
         """
         Handles an incoming message.
         """
+        # no apps to handle this message, so we already know how it ends up
+        if not self.has_incoming_apps():
+            return self.add_message(backend, sender, text, 'I', 'H')
+
         # create our db message for logging
         #TODO: implement storage of a message for many connections
         db_message = self.add_message(backend, sender, text, 'I', 'R')
 
+        # if messages are being handled in the background, we need to make sure any earlier
+        # messages from this connection are handled before ours
+        if getattr(settings, 'ROUTER_ASYNC_INCOMING', False):
+            self.process_pending_incoming(db_message.connection_id)
+            return Message.objects.get(pk=db_message.pk)
+
+        return self.process_incoming(db_message)
+
+    def queue_incoming(self, backend, sender, text):
+        """
+        Adds an incoming message to the db and queues it to be handled in the background,
+        either by celery or by our local pool of workers.
+        """
+        if not self.has_incoming_apps():
+            return self.add_message(backend, sender, text, 'I', 'H')
+
+        db_message = self.add_message(backend, sender, text, 'I', 'R')
+        self.submit_incoming(db_message.connection_id)
+        return db_message
+
+    def submit_incoming(self, connection_id):
+        """
+        Hands the passed in connection over to be handled in the background.  Whoever handles it mustn't
+        go looking for its messages before they are committed, so if we are inside a transaction the
+        connection is only handed over once our request is finished, by which time it has been.
+        """
+        if transaction.is_managed():
+            pending = pending_incoming.__dict__.setdefault('connections', [])
+            if connection_id not in pending:
+                pending.append(connection_id)
+        else:
+            self.dispatch_incoming(connection_id)
+
+    def dispatch_incoming(self, connection_id):
+        """
+        Hands the passed in connection over to celery or our local workers to handle its received messages
+        """
+        if self.async_backend() == 'celery':
+            from tasks import process_incoming_task
+            process_incoming_task.delay(connection_id)
+        else:
+            self.incoming_workers().submit(connection_id)
+
+    def recover_incoming(self, now=None):
+        """
+        Recovers received messages which were never handled, most likely because the process they were
+        queued in restarted first.  Messages left in 'P' for over ROUTER_INCOMING_PROCESSING_TIMEOUT seconds
+        (default 300) are put back in 'R', then every connection with messages received over
+        ROUTER_INCOMING_RECEIVED_TIMEOUT seconds (default 60) ago is handed over to be handled again.
+
+        Returns the ids of the connections handed over.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        processing = now - datetime.timedelta(seconds=getattr(settings, 'ROUTER_INCOMING_PROCESSING_TIMEOUT', 300))
+        received = now - datetime.timedelta(seconds=getattr(settings, 'ROUTER_INCOMING_RECEIVED_TIMEOUT', 60))
+
+        # we leave their updated time alone, so they are picked up below
+        stale = Message.objects.filter(direction='I', status='P', updated__lt=processing).update(status='R')
+        if stale:
+            logger.warning("Requeued %d messages stuck processing" % stale)
+
+        connection_ids = list(Message.objects.filter(direction='I', status='R', updated__lt=received)
+                                             .values_list('connection', flat=True).distinct().order_by())
+        for connection_id in connection_ids:
+            self.dispatch_incoming(connection_id)
+
+        return connection_ids
+
+    def async_backend(self):
+        """
+        Returns how we handle messages in the background, 'celery' if it is configured,
+        otherwise 'local'
+        """
+        backend = getattr(settings, 'ROUTER_ASYNC_BACKEND', None)
+        if not backend:
+            if getattr(settings, 'BROKER_URL', None) or getattr(settings, 'BROKER_BACKEND', None):
+                backend = 'celery'
+            else:
+                backend = 'local'
+        return backend
+
+    def incoming_workers(self):
+        """
+        Returns our local pool of workers, starting it if necessary
+        """
+        if not self.workers:
+            started = False
+            with http_router_lock:
+                if not self.workers:
+                    self.workers = IncomingWorkers(self.process_pending_incoming,
+                                                   getattr(settings, 'ROUTER_ASYNC_WORKERS', 4))
+                    started = True
+
+            # pick up anything received by our last run that it didn't get to
+            if started:
+                try:
+                    self.recover_incoming()
+                except Exception as e:
+                    logger.exception("Error recovering received messages")
+
+        return self.workers
+
+    def incoming_lock(self, connection_id):
+        """
+        Returns the lock which must be held when handling messages for the passed in connection
+        """
+        if self.async_backend() == 'celery':
+            import redis
+            r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+            return r.lock('process_incoming_%d' % connection_id, timeout=300)
+        else:
+            return self.incoming_workers().lock(connection_id)
+
+    def process_pending_incoming(self, connection_id):
+        """
+        Handles all the received messages for the passed in connection, in the order they were
+        received.  Each message is claimed by moving it to 'P' before being handled, so no
+        message is ever handled twice.
+        """
+        with self.incoming_lock(connection_id):
+            while True:
+                pending = Message.objects.filter(connection=connection_id, direction='I', status='R').order_by('pk')[:1]
+                if not pending:
+                    break
+
+                db_message = pending[0]
+                if db_message.as_queryset(status='R').update(status='P', updated=datetime.datetime.now()):
+                    db_message.status = 'P'
+                    self.process_incoming(db_message)
+
+    def handle_incoming_batch(self, entries):
+        """
+        Handles a list of incoming (backend, sender, text, date) tuples, adding them all to the
+        db in bulk before passing each through our apps.  This is used by relayers catching up
+        after an outage.
+
+        Returns the list of handled messages, in the same order as the passed in entries.
+        """
+        if not self.has_incoming_apps():
+            return self.add_messages(entries, 'I', 'H')
+
+        db_messages = self.add_messages(entries, 'I', 'R')
+        if not db_messages:
+            return []
+
+        for db_message in db_messages:
+            self.process_incoming(db_message)
+
+        return db_messages
+
+    def process_incoming(self, db_message):
+        """
+        Passes the passed in db message through all the incoming phases of our apps, then
+        sends off any responses.
+        """
+        text = db_message.text
+
+        # our apps get our connection fresh from the database, loaded along with its backend
+        if not hasattr(db_message, Message._meta.get_field('connection').get_cache_name()):
+            db_message.connection = Connection.objects.select_related('backend').get(pk=db_message.connection_id)
+
         # and our rapidsms transient message for processing
         # MessageBase now requires connections instead of connection
         # msg = IncomingMessage(db_message.connection, text, db_message.date)
@@ -108,6 +339,7 @@ class HttpRouter(object):
         # add an extra property to IncomingMessage, so httprouter-aware
         # apps can make use of it during the handling phase
         msg.db_message = db_message
+        values = db_message.field_values()
         
         logger.info("SMS[%d] IN (%s) : %s" % (db_message.id, msg.connection, msg.text))
         try:
@@ -119,13 +351,13 @@ class HttpRouter(object):
                         logger.debug("Skipping phase")
                         break
 
-                for app in self.apps:
+                for app, func in self.phase_apps(phase):
 #                    self.debug("In %s app" % app)
                     logger.debug("In %s app" % app)
                     handled = False
 
+                    start = time.time()
                     try:
-                        func = getattr(app, phase)
                         handled = func(msg)
 
                     except Exception, err:
@@ -133,6 +365,8 @@ class HttpRouter(object):
                         traceback.print_exc(err)
                         app.exception()
 
+                    registry.observe('httprouter_app_phase_seconds', time.time() - start, app=app.name, phase=phase)
+
                     # during the _filter_ phase, an app can return True
                     # to abort ALL further processing of this message
                     if phase == "filter":
@@ -152,7 +386,6 @@ class HttpRouter(object):
                             # mark the stored message with the app which has handled the message
                             msg.handled = True
                             db_message.application = "%s" % app.name
-                            db_message.save()
                             logger.debug("Message marked as handled by - %s" % app)
                             break
                     
@@ -166,10 +399,15 @@ class HttpRouter(object):
         except StopIteration:
             pass
 
+        # write our final state in a single update, unless our apps changed anything else about our message
         db_message.status = 'H'
-        db_message.save()
-        
-        db_responses = []
+        db_message.updated = datetime.datetime.now()
+        if set(db_message.changed_fields(values)) - set(('status', 'application', 'updated')):
+            db_message.save()
+        else:
+            db_message.as_queryset().update(status=db_message.status,
+                                            application=db_message.application,
+                                            updated=db_message.updated)
 
         # now send the message responses
         while msg.responses:
@@ -189,6 +427,10 @@ class HttpRouter(object):
         """
         #New version of Rapid Supports sending to multiple connections
         if not isinstance(connection, basestring) and isinstance(connection, list):
+            # sending to lots of connections at once is done in bulk
+            if len(connection) > 1:
+                return self.add_outgoing_many(connection, text, source, status)[-1]
+
             for c in connection:
                 db_message = Message.objects.create(connection=c,
                                             text=text,
@@ -233,6 +475,64 @@ class HttpRouter(object):
     
         return db_message
                 
+    def add_outgoing_many(self, connections, text, source=None, status='Q'):
+        """
+        Bulk version of add_outgoing, adds a message with the passed in text to each of the passed
+        in connections.  Messages are inserted with a single insert, outside any batch, cancelled and
+        queued messages are each marked with a single update and messages are handed to our send task
+        in chunks of ROUTER_SEND_TASK_SIZE (default 100).  Messages whose fields an app changed in its
+        outgoing phase are saved one by one, changes and all.
+
+        Returns the created messages, in the same order as the passed in connections.
+        """
+        if not connections:
+            return []
+
+        db_messages = Message.objects.bulk_insert([Message(connection=c, text=text, direction='O', status=status,
+                                                           in_response_to=source)
+                                                   for c in connections])
+        for db_message, c in zip(db_messages, connections):
+            logger.info("SMS[%d] OUT (%s) : %s" % (db_message.id, str(c), text))
+
+        # process our outgoing phases, cancelled messages are marked as such all at once
+        values = [db_message.field_values() for db_message in db_messages]
+        queued = []
+        cancelled = []
+        changed = []
+        for db_message, before, send_msg in zip(db_messages, values, self.run_outgoing_phases_many(db_messages)):
+            if send_msg:
+                db_message.status = 'Q'
+
+            if set(db_message.changed_fields(before)) - set(['status', 'updated']):
+                changed.append(db_message)
+            elif send_msg:
+                queued.append(db_message)
+            else:
+                cancelled.append(db_message)
+
+        # our messages aren't in any batch, so there is nothing to count
+        if cancelled:
+            Message.objects.filter(pk__in=[m.pk for m in cancelled]).uncounted().update(status='C', updated=datetime.datetime.now())
+
+        if queued:
+            Message.objects.filter(pk__in=[m.pk for m in queued]).uncounted().update(status='Q', updated=datetime.datetime.now())
+
+        for db_message in changed:
+            db_message.save()
+
+        queued = [db_message for db_message in db_messages if db_message.status == 'Q']
+
+        # if we have a router URL, send the messages off
+        if getattr(settings, 'ROUTER_URL', None) and queued:
+            # imported here to keep our dependency on celery soft
+            from tasks import send_messages_task
+
+            size = getattr(settings, 'ROUTER_SEND_TASK_SIZE', 100)
+            for i in range(0, len(queued), size):
+                send_messages_task.delay([m.pk for m in queued[i:i + size]])
+
+        return db_messages
+
     def handle_outgoing(self, msg, source=None):
         """
         Sends the passed in RapidSMS message off.  Optionally ties the outgoing message to the incoming
@@ -257,27 +557,30 @@ class HttpRouter(object):
         Apps have the opportunity to cancel messages in this phase by returning False when
         called with the message.  In that case this method will also return False
         """
-        # create a RapidSMS outgoing message
-        try:
-            outgoing.connection[0]
-            connections = [outgoing.connection]
-        except TypeError:
-            connections = outgoing.connection
-        msg = OutgoingMessage(connections, outgoing.text.replace('%','%%'))
-        msg.db_message = outgoing
+        send_msg = self.run_outgoing_phases(outgoing)
+        if not send_msg:
+            outgoing.save()
+        return send_msg
+
+    def run_outgoing_phases(self, outgoing):
+        """
+        Runs the passed in message through all our outgoing phases, returning False and setting its
+        status to 'C' if an app cancelled it.  The cancellation is left to the caller to save.
+        """
+        msg = self.outgoing_message(outgoing)
         
         send_msg = True
         for phase in self.outgoing_phases:
             logger.debug("Out %s phase" % phase)
 
-            # call outgoing phases in the opposite order of the incoming
-            # phases, so the first app called with an  incoming message
-            # is the last app called with an outgoing message
-            for app in reversed(self.apps):
+            # our dispatch table calls outgoing phases in the opposite order of
+            # the incoming phases, so the first app called with an incoming
+            # message is the last app called with an outgoing message
+            for app, func in self.phase_apps(phase):
                 logger.debug("Out %s app" % app)
 
+                start = time.time()
                 try:
-                    func = getattr(app, phase)
                     keep_sending = func(msg)
 
                     # we have to do things this way because by default apps return
@@ -287,11 +590,12 @@ class HttpRouter(object):
                 except Exception, err:
                     app.exception()
 
+                registry.observe('httprouter_app_phase_seconds', time.time() - start, app=app.name, phase=phase)
+
                 # during any outgoing phase, an app can return True to
                 # abort ALL further processing of this message
                 if not send_msg:
                     outgoing.status = 'C'
-                    outgoing.save()
 
                     logger.warning("Message cancelled")
                     send_msg = False
@@ -299,6 +603,63 @@ class HttpRouter(object):
 
         return send_msg
 
+    def outgoing_message(self, outgoing):
+        """
+        Builds the RapidSMS outgoing message handed to our apps for the passed in db message
+        """
+        try:
+            outgoing.connection[0]
+            connections = [outgoing.connection]
+        except TypeError:
+            connections = outgoing.connection
+        msg = OutgoingMessage(connections, outgoing.text.replace('%','%%'))
+        msg.db_message = outgoing
+        return msg
+
+    def run_outgoing_phases_many(self, outgoings):
+        """
+        Bulk version of run_outgoing_phases, returns whether each of the passed in messages should be
+        sent, setting the status of those cancelled to 'C'.  Apps which implement outgoing_many(messages)
+        are called once with all the messages still being sent, and return None to send them all or a
+        list with a result for each message, just as outgoing() would return it.  Other apps have
+        outgoing() called for each message.
+        """
+        msgs = [self.outgoing_message(outgoing) for outgoing in outgoings]
+        send = [True] * len(msgs)
+
+        for phase in self.outgoing_phases:
+            for app, func in self.phase_apps(phase):
+                pending = [i for i, send_msg in enumerate(send) if send_msg]
+                if not pending:
+                    break
+
+                start = time.time()
+                many = getattr(app, phase + '_many', None)
+                if many:
+                    try:
+                        results = many([msgs[i] for i in pending])
+                        if results is not None:
+                            for i, keep_sending in zip(pending, results):
+                                if keep_sending is False:
+                                    send[i] = False
+                    except Exception, err:
+                        app.exception()
+                else:
+                    for i in pending:
+                        try:
+                            if func(msgs[i]) is False:
+                                send[i] = False
+                        except Exception, err:
+                            app.exception()
+
+                registry.observe('httprouter_app_phase_seconds', time.time() - start, app=app.name, phase=phase)
+
+        for outgoing, send_msg in zip(outgoings, send):
+            if not send_msg:
+                outgoing.status = 'C'
+
+        return send
+
     @classmethod
     def definition_from_string(cls, class_name):
         """
@@ -311,6 +672,67 @@ class HttpRouter(object):
             m = getattr(m, comp)
         return m
 
+    @classmethod
+    def overrides_phase(cls, app, phase):
+        """
+        Returns whether the passed in app does anything in the passed in phase, that is whether
+        it overrides the no-op implementation in AppBase.
+        """
+        if phase in app.__dict__:
+            return True
+
+        func = getattr(type(app), phase, None)
+        if func is None:
+            return False
+
+        base = getattr(AppBase, phase, None)
+        if base is None:
+            return True
+
+        return getattr(func, 'im_func', func) is not getattr(base, 'im_func', base)
+
+    def build_dispatch(self):
+        """
+        Builds our dispatch table, which for each phase contains the (app, method) pairs to call,
+        in order, skipping apps which don't implement that phase.
+        """
+        dispatch = dict()
+        for phase in self.incoming_phases:
+            dispatch[phase] = [(app, getattr(app, phase)) for app in self.apps if HttpRouter.overrides_phase(app, phase)]
+
+        # outgoing phases are called in the reverse order of incoming ones, apps may implement just the bulk
+        # version of an outgoing phase, in which case it is called with a list of one for single messages
+        for phase in self.outgoing_phases:
+            dispatch[phase] = []
+            for app in reversed(self.apps):
+                if HttpRouter.overrides_phase(app, phase):
+                    dispatch[phase].append((app, getattr(app, phase)))
+                elif hasattr(app, phase + '_many'):
+                    many = getattr(app, phase + '_many')
+                    dispatch[phase].append((app, lambda msg, many=many: (many([msg]) or [None])[0]))
+
+        self.dispatch = dispatch
+        self.dispatch_apps = list(self.apps)
+
+    def phase_apps(self, phase):
+        """
+        Returns the (app, method) pairs to call for the passed in phase, rebuilding our dispatch
+        table if our apps have changed since it was built.
+        """
+        if self.dispatch_apps != self.apps:
+            self.build_dispatch()
+
+        return self.dispatch[phase]
+
+    def has_incoming_apps(self):
+        """
+        Returns whether any of our apps do anything with incoming messages
+        """
+        for phase in self.incoming_phases:
+            if self.phase_apps(phase):
+                return True
+        return False
+
     def add_app(self, module_name):
         """
         Find the app named *module_name*, instantiate it, and add it to
@@ -358,9 +780,52 @@ class HttpRouter(object):
         # upon first starting up
         self.outgoing = [message for message in Message.objects.filter(status='Q')]
 
+        # figure out which apps need to be called for each phase
+        self.build_dispatch()
+
+        # and compile our number normalization rules
+        reset_normalizer()
+
         # mark ourselves as started
         self.started = True
         
+class IncomingWorkers(object):
+    """
+    Local pool of threads used to handle incoming messages in the background when celery
+    isn't available.  Connections are always assigned to the same worker, so messages from
+    a connection are handled in the order they came in.
+    """
+    def __init__(self, process, size=4):
+        self.process = process
+        self.size = size
+        self.queues = [Queue() for i in range(size)]
+        self.locks = [RLock() for i in range(size)]
+
+        for i in range(size):
+            worker = Thread(target=self.work, args=(self.queues[i],), name="httprouter-incoming-%d" % i)
+            worker.daemon = True
+            worker.start()
+
+    def lock(self, connection_id):
+        return self.locks[connection_id % self.size]
+
+    def submit(self, connection_id):
+        self.queues[connection_id % self.size].put(connection_id)
+
+    def work(self, queue):
+        while True:
+            connection_id = queue.get()
+            try:
+                self.process(connection_id)
+            except Exception as e:
+                logger.exception("Error handling messages for connection %d" % connection_id)
+            finally:
+                queue.task_done()
+
+    def join(self):
+        for queue in self.queues:
+            queue.join()
+
 # we'll get started when we first get used
 http_router = HttpRouter()
 http_router_lock = Lock()
@@ -381,3 +846,15 @@ def get_router():
             http_router_lock.release()
 
     return http_router
+
+# connections with messages received inside a transaction, handed over once our request is finished
+pending_incoming = local()
+
+def submit_pending_incoming(sender, **kwargs):
+    connection_ids = getattr(pending_incoming, 'connections', None)
+    if connection_ids:
+        pending_incoming.connections = []
+        for connection_id in connection_ids:
+            get_router().dispatch_incoming(connection_id)
+
+request_finished.connect(submit_pending_incoming)
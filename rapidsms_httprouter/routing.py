@@ -0,0 +1,154 @@
+from django.conf import settings
+from threading import Lock
+
+import csv
+import os
+import time
+
+class Route(object):
+    """
+    Where messages to numbers starting with prefix should be sent, url may be None in
+    which case the url configured for the backend is used.
+    """
+    def __init__(self, prefix, backend, url=None):
+        self.prefix = prefix
+        self.backend = backend
+        self.url = url or None
+
+    def __repr__(self):
+        return "<Route %s -> %s>" % (self.prefix, self.backend)
+
+
+class PrefixTrie(object):
+    """
+    Trie of number prefixes, lookups find the longest prefix matching a number in time
+    proportional to the length of the number, no matter how many prefixes we have.
+    """
+    def __init__(self):
+        self.root = dict()
+        self.size = 0
+
+    def add(self, prefix, value):
+        node = self.root
+        for digit in prefix:
+            node = node.setdefault(digit, dict())
+
+        if None not in node:
+            self.size += 1
+        node[None] = value
+
+    def longest_match(self, number):
+        node = self.root
+        match = node.get(None)
+        for digit in number:
+            node = node.get(digit)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+    def __len__(self):
+        return self.size
+
+
+class RoutingTable(object):
+    """
+    Maps recipients to the backend (and optionally url) their messages should be sent through,
+    based on the prefix of their number.  Routes come from ROUTER_PREFIX_ROUTES, a dict of prefix
+    to backend name or (backend name, url) tuples, and from ROUTER_PREFIX_ROUTES_FILE, a CSV file
+    of prefix,backend[,url] lines.  Routes in the file take precedence.
+    """
+    def __init__(self, routes=()):
+        self.trie = PrefixTrie()
+        for route in routes:
+            self.trie.add(route.prefix, route)
+
+    @classmethod
+    def read_file(cls, filename):
+        routes = []
+        with open(filename, 'rb') as routes_file:
+            for row in csv.reader(routes_file):
+                # skip blank lines and comments
+                if not row or row[0].strip().startswith('#'):
+                    continue
+
+                row = [field.strip() for field in row]
+                routes.append(Route(row[0], row[1], row[2] if len(row) > 2 else None))
+        return routes
+
+    @classmethod
+    def from_settings(cls):
+        routes = []
+        for prefix, route in getattr(settings, 'ROUTER_PREFIX_ROUTES', {}).items():
+            if isinstance(route, basestring):
+                routes.append(Route(prefix, route))
+            else:
+                routes.append(Route(prefix, *route))
+
+        filename = getattr(settings, 'ROUTER_PREFIX_ROUTES_FILE', None)
+        if filename:
+            routes += RoutingTable.read_file(filename)
+
+        return cls(routes)
+
+    def route(self, identity):
+        """
+        Returns the Route for the passed in identity, or None if no prefix matches
+        """
+        if not identity or not self.trie.size:
+            return None
+        return self.trie.longest_match(identity)
+
+    def __len__(self):
+        return len(self.trie)
+
+
+class RoutingTableLoader(object):
+    """
+    Keeps our routing table up to date, reloading it whenever our settings or routes file change.
+    The routes file is checked at most every ROUTER_PREFIX_ROUTES_RELOAD seconds, so changes are
+    picked up by running workers without needing a restart.
+    """
+    def __init__(self):
+        self.table = None
+        self.signature = None
+        self.checked = 0
+        self.lock = Lock()
+
+    def current_signature(self):
+        filename = getattr(settings, 'ROUTER_PREFIX_ROUTES_FILE', None)
+        mtime = None
+        if filename:
+            try:
+                mtime = os.path.getmtime(filename)
+            except OSError:
+                pass
+
+        return (id(getattr(settings, 'ROUTER_PREFIX_ROUTES', None)), filename, mtime)
+
+    def get(self):
+        now = time.time()
+        if self.table is None or now - self.checked >= getattr(settings, 'ROUTER_PREFIX_ROUTES_RELOAD', 30):
+            with self.lock:
+                self.checked = now
+                signature = self.current_signature()
+                if self.table is None or signature != self.signature:
+                    self.table = RoutingTable.from_settings()
+                    self.signature = signature
+
+        return self.table
+
+    def reload(self):
+        with self.lock:
+            self.table = RoutingTable.from_settings()
+            self.signature = self.current_signature()
+            self.checked = time.time()
+        return self.table
+
+routing_tables = RoutingTableLoader()
+
+def get_routing_table():
+    return routing_tables.get()
+
+def reload_routing_table():
+    return routing_tables.reload()
@@ -0,0 +1,105 @@
+from django.conf import settings
+
+class Scheduler(object):
+    """
+    Shares out how many messages we send in each cycle between everything that has messages queued.
+    Every batch and priority is its own queue, as are messages outside any batch, our interactive
+    replies.  Each queue gets a share of the cycle proportional to its weight, queues which need less
+    than their share hand the rest to the others, so a million recipient broadcast can't hold up
+    replies or other batches.
+
+    Shares rarely come out as whole messages, the fractions each queue misses out on are carried over
+    to its next cycle, so a queue whose share is less than a message still gets one every few cycles
+    rather than losing out to the same queues every time.  This only holds for cycles run through the
+    same scheduler, so in the same process.
+
+    interactive_weight and batch_weight are the weights of interactive and batch queues, the weight
+    of a queue is multiplied by the value for its priority in priority_weights if there is one.
+    """
+    def __init__(self, interactive_weight=10, batch_weight=1, priority_weights=None):
+        self.interactive_weight = interactive_weight
+        self.batch_weight = batch_weight
+        self.priority_weights = priority_weights or dict()
+
+        # the fractions of a message each queue is owed from previous cycles, by group
+        self.deficits = dict()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(interactive_weight=getattr(settings, 'ROUTER_SCHEDULER_INTERACTIVE_WEIGHT', 10),
+                   batch_weight=getattr(settings, 'ROUTER_SCHEDULER_BATCH_WEIGHT', 1),
+                   priority_weights=getattr(settings, 'ROUTER_SCHEDULER_PRIORITY_WEIGHTS', {}))
+
+    def weight(self, interactive, priority):
+        weight = self.interactive_weight if interactive else self.batch_weight
+        return float(weight) * self.priority_weights.get(priority, 1)
+
+    def allocate(self, queues, capacity, group=None):
+        """
+        Takes a dict of queue key to (interactive, priority, queued) and the number of messages we can
+        send, returns a dict of queue key to how many messages to send from that queue.  Queues are
+        owed what they miss out on within the passed in group, say the backend they are sent through.
+        """
+        deficits = self.deficits.get(group, dict())
+        owed = dict()
+
+        allocated = dict((key, 0) for key in queues)
+        weights = dict((key, self.weight(interactive, priority)) for key, (interactive, priority, queued) in queues.items())
+        demand = dict((key, queued) for key, (interactive, priority, queued) in queues.items())
+
+        # weightless queues still get a look in once everybody else is done
+        for key in weights:
+            if weights[key] <= 0:
+                weights[key] = 0.000001
+
+        remaining = capacity
+        while remaining > 0:
+            active = [key for key in queues if demand[key] > allocated[key]]
+            if not active:
+                break
+
+            total = sum(weights[key] for key in active)
+            shares = dict((key, remaining * weights[key] / total) for key in active)
+
+            # queues which need no more than their share get all they need, the rest is shared out again
+            satisfied = [key for key in active if demand[key] - allocated[key] <= shares[key]]
+            if satisfied:
+                for key in satisfied:
+                    remaining -= demand[key] - allocated[key]
+                    allocated[key] = demand[key]
+                continue
+
+            # everybody wants more than their share, hand out whole shares then the remainders, those
+            # owed the most first, and remember what everybody is owed for next time
+            for key in active:
+                allocated[key] += int(shares[key])
+                remaining -= int(shares[key])
+                owed[key] = deficits.get(key, 0) + shares[key] - int(shares[key])
+
+            for key in sorted(active, key=lambda key: (owed[key], weights[key]), reverse=True):
+                if remaining <= 0:
+                    break
+                allocated[key] += 1
+                owed[key] -= 1
+                remaining -= 1
+            break
+
+        self.deficits[group] = owed
+        return allocated
+
+# our process wide scheduler, built from our settings the first time it is used
+scheduler = None
+
+def get_scheduler():
+    global scheduler
+    if scheduler is None:
+        scheduler = Scheduler.from_settings()
+    return scheduler
+
+def reset_scheduler():
+    """
+    Rebuilds our scheduler from our current settings, forgetting what any queue was owed
+    """
+    global scheduler
+    scheduler = Scheduler.from_settings()
+    return scheduler
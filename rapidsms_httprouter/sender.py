@@ -0,0 +1,253 @@
+from django.conf import settings
+from django.db import connection
+from threading import Lock, Thread
+from Queue import Queue, Empty
+
+from .metrics import registry
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SendJob(object):
+    """
+    A unit of sending work for a backend, func is called on one of our worker threads and
+    its return value (or the exception it raised) handed back to the caller.  size is the number
+    of messages the job sends, used for our throughput stats.
+    """
+    def __init__(self, backend, func, data=None, size=1):
+        self.backend = backend
+        self.func = func
+        self.data = data
+        self.size = size
+
+
+class BackendStats(object):
+    """
+    Running totals for a backend.  Throughput is the number of messages sent per second of time
+    spent with at least one send in flight, so idle time between runs doesn't drag it down.
+    """
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.active_seconds = 0.0
+        self.active_since = None
+
+    def started(self, now):
+        if not self.in_flight:
+            self.active_since = now
+        self.in_flight += 1
+
+    def finished(self, now, size, ok):
+        self.in_flight -= 1
+        if ok:
+            self.sent += size
+        else:
+            self.failed += size
+
+        if not self.in_flight:
+            self.active_seconds += now - self.active_since
+            self.active_since = None
+
+    def throughput(self, now=None):
+        active = self.active_seconds
+        if self.active_since is not None:
+            active += (now or time.time()) - self.active_since
+
+        if not active:
+            return 0.0
+        return (self.sent + self.failed) / active
+
+
+class ConcurrentSender(object):
+    """
+    Sends to many backends in parallel on a pool of threads, so one slow backend can't hold up
+    all the others.  At most size jobs are in flight at once, and at most the limit for a backend
+    (from backend_limits, or default_limit) for any single backend.  Backends take turns getting
+    free slots, so a backend with lots of work queued doesn't starve the others.
+
+    Jobs only run on our threads, their results are always handed back on the calling thread,
+    which is where message statuses should be updated.
+    """
+    def __init__(self, size=8, backend_limits=None, default_limit=2):
+        self.size = size
+        self.backend_limits = backend_limits or dict()
+        self.default_limit = default_limit
+
+        self.jobs = None
+        self.lock = Lock()
+        self.stats = dict()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(size=getattr(settings, 'ROUTER_SEND_CONCURRENCY', 8),
+                   backend_limits=getattr(settings, 'ROUTER_BACKEND_CONCURRENCY', {}),
+                   default_limit=getattr(settings, 'ROUTER_DEFAULT_BACKEND_CONCURRENCY', 2))
+
+    def limit(self, backend):
+        return max(1, self.backend_limits.get(backend, self.default_limit))
+
+    def start(self):
+        """
+        Starts our worker threads, if they aren't already running
+        """
+        with self.lock:
+            if self.jobs is None:
+                self.jobs = Queue()
+                for i in range(self.size):
+                    worker = Thread(target=self.work, name="httprouter-sender-%d" % i)
+                    worker.daemon = True
+                    worker.start()
+
+    def work(self):
+        while True:
+            job, results = self.jobs.get()
+            start = time.time()
+            try:
+                result = (True, job.func())
+            except Exception as e:
+                result = (False, e)
+            finally:
+                # we don't want to hang on to a database connection between jobs
+                connection.close()
+
+            results.put((job, result[0], result[1], time.time() - start))
+
+    def backend_stats(self, backend):
+        stats = self.stats.get(backend)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(backend, BackendStats())
+        return stats
+
+    def run(self, jobs, callback=None, tick=None, interval=None):
+        """
+        Runs all the passed in jobs, returning once they are all complete.  If passed in,
+        callback(job, ok, value) is called on this thread as each job completes, with the
+        job's return value or the exception it raised, and tick() every interval seconds while
+        we wait for jobs to complete.  Returns the number of jobs which failed.
+        """
+        # queue our jobs up by backend
+        pending = dict()
+        backends = []
+        for job in jobs:
+            if job.backend not in pending:
+                pending[job.backend] = []
+                backends.append(job.backend)
+            pending[job.backend].append(job)
+
+        if not pending:
+            return 0
+
+        self.start()
+
+        for backend in backends:
+            pending[backend].reverse()
+
+        results = Queue()
+        in_flight = dict()
+        total = 0
+        failed = 0
+        last_tick = time.time()
+
+        while pending or total:
+            # hand out free slots, one job per backend per pass
+            submitted = True
+            while submitted and total < self.size:
+                submitted = False
+                for backend in list(backends):
+                    if total >= self.size:
+                        break
+
+                    if in_flight.get(backend, 0) >= self.limit(backend):
+                        continue
+
+                    job = pending[backend].pop()
+                    if not pending[backend]:
+                        del pending[backend]
+                        backends.remove(backend)
+
+                    stats = self.backend_stats(backend)
+                    with self.lock:
+                        stats.started(time.time())
+
+                    in_flight[backend] = in_flight.get(backend, 0) + 1
+                    total += 1
+                    submitted = True
+                    self.jobs.put((job, results))
+
+            # wait for one to finish, ticking while we do
+            result = None
+            while result is None:
+                timeout = max(0, last_tick + interval - time.time()) if tick else None
+                try:
+                    result = results.get(timeout=timeout)
+                except Empty:
+                    pass
+
+                if tick and time.time() >= last_tick + interval:
+                    try:
+                        tick()
+                    except Exception as e:
+                        logger.exception("Error ticking while sending")
+                    last_tick = time.time()
+
+            job, ok, value, elapsed = result
+            in_flight[job.backend] -= 1
+            total -= 1
+
+            stats = self.backend_stats(job.backend)
+            with self.lock:
+                stats.finished(time.time(), job.size, ok)
+            registry.observe('httprouter_sender_job_seconds', elapsed, backend=job.backend)
+
+            if not ok:
+                failed += 1
+
+            if callback:
+                try:
+                    callback(job, ok, value)
+                except Exception as e:
+                    logger.exception("Error handling the result of sending through %s" % job.backend)
+            elif not ok:
+                logger.error("Error sending through %s: %s" % (job.backend, value))
+
+        return failed
+
+# our process wide sender, built from our settings the first time it is used
+sender = None
+sender_lock = Lock()
+
+def get_sender():
+    global sender
+    if sender is None:
+        with sender_lock:
+            if sender is None:
+                sender = ConcurrentSender.from_settings()
+    return sender
+
+def sender_stats(field):
+    def stats():
+        if sender is None:
+            return []
+
+        now = time.time()
+        with sender.lock:
+            values = []
+            for backend, stats in sorted(sender.stats.items()):
+                if field == 'throughput':
+                    values.append((dict(backend=backend), stats.throughput(now)))
+                elif field == 'messages':
+                    values.append((dict(backend=backend, result='sent'), stats.sent))
+                    values.append((dict(backend=backend, result='failed'), stats.failed))
+                else:
+                    values.append((dict(backend=backend), getattr(stats, field)))
+            return values
+    return stats
+
+registry.describe('httprouter_sender_job_seconds', "Time taken by each send job, by backend")
+registry.counter('httprouter_sender_messages_total', "Messages sent through our concurrent sender, by backend and result", sender_stats('messages'))
+registry.gauge('httprouter_sender_in_flight', "Send jobs currently in flight, by backend", sender_stats('in_flight'))
+registry.gauge('httprouter_sender_throughput', "Messages sent per second while sending, by backend", sender_stats('throughput'))
@@ -2,123 +2,275 @@ import StringIO
 from celery.task import task
 from datetime import datetime, timedelta
 from django.conf import settings
-from .models import Message, DeliveryError
+from django.db.models import Q, F, Count
+from .models import Message, MessageBatch, DeliveryError
 from .router import HttpRouter
+from .metrics import registry
+from .routing import get_routing_table
+from .pipeline import get_pipeline, send_pipelines
+from .httppool import get_http_pool
+from .sender import SendJob, get_sender
+from .ratelimit import get_rate_limiter
+from .retry import get_retry_policy
+from .scheduler import get_scheduler
+from functools import partial
 from urllib import quote_plus, unquote
 from urllib2 import urlopen
 import urllib2
 import traceback
+import random
+import socket
 import time
+import os
 import re
 import redis
 
 import logging
 logger = logging.getLogger(__name__)
 
+def worker_name():
+    """
+    Identifies this worker process in the messages it claims
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
 def fetch_url(url, params):
-    if hasattr(settings, 'ROUTER_FETCH_URL'):
-        fetch_url = HttpRouter.definition_from_string(getattr(settings, 'ROUTER_FETCH_URL'))
-        return fetch_url(url, params)
-    else:
-        return HttpRouter.fetch_url(url, params)
+    return send_pipelines.get_fetch()(url, params)
+
+def send_pipeline(params):
+    """
+    Returns the send pipeline for the given message parameters, taking into account any
+    prefix routes for the recipient.
+    """
+    # our recipient may need to go out through a specific backend
+    route = get_routing_table().route(params.get('recipient', None))
+    if route:
+        params['backend'] = route.backend
+        return get_pipeline(route.backend, route.url)
+
+    return get_pipeline(params['backend'])
 
 def build_send_url(params, **kwargs):
     """
     Constructs an appropriate send url for the given message.
     """
-    # make sure our parameters are URL encoded
     params.update(kwargs)
-    for k, v in params.items():
-        try:
-            params[k] = quote_plus(str(v))
-        except UnicodeEncodeError:
-            params[k] = quote_plus(str(v.encode('UTF-8')))
-            
-    # get our router URL
-    router_url = settings.ROUTER_URL
 
-    # is this actually a dict?  if so, we want to look up the appropriate backend
-    if type(router_url) is dict:
-        router_dict = router_url
-        backend_name = params['backend']
-            
-        # is there an entry for this backend?
-        if backend_name in router_dict:
-            router_url = router_dict[backend_name]
+    # our pipeline knows which url to use for this backend and takes care of encoding our params
+    return send_pipeline(params).build_url(params)
 
-        # if not, look for a default backend 
-        elif 'default' in router_dict:
-            router_url = router_dict['default']
+def prepare_message(msg):
+    """
+    Works out how the passed in message should be sent, returns a (pipeline, url, params) tuple
+    """
+    params = {
+        'backend': msg.connection.backend.name,
+        'recipient': msg.connection.identity,
+        'text': msg.text,
+        'id': msg.pk
+    }
 
-        # none?  blow the hell up
-        else:
-            raise Exception("No router url mapping found for backend '%s', check your settings.ROUTER_URL setting" % backend_name)
+    pipeline = send_pipeline(params)
+    return (pipeline, pipeline.build_url(params), params)
 
-    # return our built up url with all our variables substituted in
-    full_url = router_url % params
-    return full_url
+def fetch_message(pipeline, url, params, backend_name):
+    """
+    Hands a prepared message off to our router URL, returns the (status code, body) of the response
+    """
+    # don't go faster than our backend allows
+    get_rate_limiter().wait(pipeline.backend)
 
-def send_message(msg, **kwargs):
+    with registry.timer('httprouter_send_seconds', backend=backend_name, section='http'):
+        response = pipeline.fetch(url, params)
+        status_code = response.getcode()
+
+        body = response.read().decode('ascii', 'ignore').encode('ascii')
+
+    return (status_code, body)
+
+def message_sent(msg, status_code, body, backend_name):
     """
-    Sends a message using its configured endpoint
+    Marks the passed in message as sent if our router URL accepted it, raising an exception if not
+    """
+    # kannel likes to send 202 responses, really any
+    # 2xx value means things went okay
+    if int(status_code/100) == 2:
+        print "  [%d] - sent %d" % (msg.id, status_code)
+        logger.info("SMS[%d] SENT" % msg.id)
+        with registry.timer('httprouter_send_seconds', backend=backend_name, section='db'):
+            now = datetime.now()
+
+            # release our claim as we go, if it lapsed someone else owns the message now and we leave it be
+            if not msg.change_status('S', msg.claim_filters(), sent=now, updated=now, claimed_by=None, lease_expires=None):
+                logger.warning("SMS[%d] changed while we were sending it, not marking it as sent" % msg.id)
+                return body
+
+            msg.sent = now
+            msg.claimed_by = None
+            msg.lease_expires = None
+
+        return body
+    else:
+        raise Exception("Received status code: %d" % status_code)
+
+def delivery_log(msg, e, backend_name, url, response, permanent):
+    """
+    Builds the log saved with the DeliveryError for a failed message, only ever done on failure
     """
     msg_log = "Sending message: [%d]\n" % msg.id
+    if url:
+        msg_log += "%s %s\n" % (backend_name, url)
+
+    if response:
+        msg_log += "Status Code: %d\n" % response[0]
+        msg_log += "Body: %s\n" % response[1]
+
+    msg_log += "Failure #%d\n\n" % msg.attempts
+    msg_log += "Error: %s\n\n" % str(e)
 
+    if permanent:
+        msg_log += "Permanent failure, will not retry."
+    else:
+        msg_log += "Will retry %d more time(s), next at %s." % (max_attempts() - msg.attempts, msg.next_retry_at)
+
+    return msg_log
+
+def log_delivery_error(msg, e, backend_name, url, response, permanent):
+    """
+    Saves a DeliveryError for a failed message, depending on ROUTER_DELIVERY_ERROR_LOG this is either
+    'full', 'truncated' to ROUTER_DELIVERY_ERROR_LOG_LENGTH characters, 'sampled' so that only
+    ROUTER_DELIVERY_ERROR_SAMPLE_RATE of retryable failures (and all permanent ones) are logged, or 'none'.
+    """
+    mode = getattr(settings, 'ROUTER_DELIVERY_ERROR_LOG', 'full')
+    if mode == 'none':
+        return
+
+    if mode == 'sampled' and not permanent and random.random() >= getattr(settings, 'ROUTER_DELIVERY_ERROR_SAMPLE_RATE', 0.01):
+        return
+
+    msg_log = delivery_log(msg, e, backend_name, url, response, permanent)
+    if mode == 'truncated':
+        msg_log = msg_log[:getattr(settings, 'ROUTER_DELIVERY_ERROR_LOG_LENGTH', 500)]
+
+    DeliveryError.objects.create(message=msg, log=msg_log)
+
+def max_attempts():
+    return getattr(settings, 'ROUTER_MAX_ATTEMPTS', 3)
+
+def message_failed(msg, e, backend_name, url=None, response=None):
+    """
+    Records a failure to send the passed in message, by default it is retried up to two more
+    times, backing off longer after each failure.  The passed in url and (status code, body)
+    response, if any, are only used for our delivery error log.
+    """
+    print "  [%d] - send error - %s" % (msg.id, str(e))
+
+    with registry.timer('httprouter_send_seconds', backend=backend_name, section='db'):
+        now = datetime.now()
+
+        # count this attempt and update our status in a single update, messages which have
+        # used up all their attempts fail permanently.  either way we release our claim on it,
+        # and if that has lapsed someone else owns the message now and we leave it be
+        claim = msg.claim_filters()
+        released = dict(updated=now, claimed_by=None, lease_expires=None)
+        permanent = msg.change_status('F', dict(claim, attempts__gte=max_attempts() - 1),
+                                      attempts=F('attempts') + 1, next_retry_at=None, **released)
+
+        next_retry_at = None
+        if not permanent:
+            next_retry_at = get_retry_policy().next_retry(msg.attempts + 1, now)
+            if not msg.change_status('E', claim, attempts=F('attempts') + 1, next_retry_at=next_retry_at, **released):
+                logger.warning("SMS[%d] changed while we were sending it, not marking it as failed" % msg.id)
+                return
+
+        msg.attempts += 1
+        msg.next_retry_at = next_retry_at
+        msg.claimed_by = None
+        msg.lease_expires = None
+
+        log_delivery_error(msg, e, backend_name, url, response, permanent)
+
+def send_message(msg, **kwargs):
+    """
+    Sends a message using its configured endpoint
+    """
     print "[%d] >> %s\n" % (msg.id, msg.text)
 
+    backend_name = msg.connection.backend.name
+    url = None
+    response = None
+
     # and actually hand the message off to our router URL
     try:
-        params = {
-            'backend': msg.connection.backend.name,
-            'recipient': msg.connection.identity,
-            'text': msg.text,
-            'id': msg.pk
-        }
-
-        url = build_send_url(params)
+        pipeline, url, params = prepare_message(msg)
         print "[%d] - %s\n" % (msg.id, url)
-        msg_log += "%s %s\n" % (msg.connection.backend.name, url)
 
-        response = fetch_url(url, params)
-        status_code = response.getcode()
+        response = fetch_message(pipeline, url, params, backend_name)
+        return message_sent(msg, response[0], response[1], backend_name)
+    except Exception as e:
+        message_failed(msg, e, backend_name, url, response)
 
-        body = response.read().decode('ascii', 'ignore').encode('ascii')
+    return None
 
-        msg_log += "Status Code: %d\n" % status_code
-        msg_log += "Body: %s\n" % body
+def renew_claims(pending):
+    """
+    Renews our claims on the messages in the passed in dict of message id to claim token, the
+    ones we haven't got to yet, so they aren't reclaimed and sent by someone else while they wait
+    """
+    tokens = dict()
+    for message_id, token in pending.items():
+        if token:
+            tokens.setdefault(token, []).append(message_id)
 
-        # kannel likes to send 202 responses, really any
-        # 2xx value means things went okay
-        if int(status_code/100) == 2:
-            print "  [%d] - sent %d" % (msg.id, status_code)
-            logger.info("SMS[%d] SENT" % msg.id)
-            msg.sent = datetime.now()
-            msg.status = 'S'
-            msg.save()
+    for token, message_ids in tokens.items():
+        Message.renew_claims(token, message_ids)
 
-            return body
-        else:
-            raise Exception("Received status code: %d" % status_code)
-    except Exception as e:
-        print "  [%d] - send error - %s" % (msg.id, str(e))
-
-        # previous errors
-        previous_count = DeliveryError.objects.filter(message=msg).count()
-        msg_log += "Failure #%d\n\n" % (previous_count+1)
-        msg_log += "Error: %s\n\n" % str(e)
-        
-        if previous_count >= 2:
-            msg_log += "Permanent failure, will not retry."
-            msg.status = 'F'
-            msg.save()
-        else:
-            msg_log += "Will retry %d more time(s)." % (2 - previous_count)
-            msg.status = 'E'
-            msg.save()
+def renew_interval():
+    # renew our claims well before they run out
+    return getattr(settings, 'ROUTER_CLAIM_LEASE', 60) / 3.0
 
-        DeliveryError.objects.create(message=msg, log=msg_log)
+def send_messages(messages):
+    """
+    Sends the passed in messages, sending to different backends in parallel through our
+    concurrent sender.  Only the HTTP requests are made on the sender's threads, message
+    statuses are all updated on this thread, as are our claims on the messages still waiting
+    to be sent.  Returns the number of messages sent.
+    """
+    jobs = []
+    pending = dict()
+    for msg in messages:
+        backend_name = msg.connection.backend.name
 
-    return None
+        try:
+            pipeline, url, params = prepare_message(msg)
+        except Exception as e:
+            message_failed(msg, e, backend_name)
+            continue
+
+        print "[%d] - %s\n" % (msg.id, url)
+
+        # jobs are limited by the backend they actually go out through
+        jobs.append(SendJob(pipeline.backend, partial(fetch_message, pipeline, url, params, backend_name),
+                            (msg, url, backend_name)))
+        pending[msg.pk] = msg.claimed_by
+
+    sent = [0]
+    def handle_result(job, ok, value):
+        msg, url, backend_name = job.data
+        pending.pop(msg.pk, None)
+        response = None
+        try:
+            if not ok:
+                raise value
+
+            response = value
+            message_sent(msg, response[0], response[1], backend_name)
+            sent[0] += 1
+        except Exception as e:
+            message_failed(msg, e, backend_name, url, response)
+
+    get_sender().run(jobs, handle_result, partial(renew_claims, pending), renew_interval())
+    return sent[0]
 
 @task(track_started=True)
 def send_message_task(message_id):  #pragma: no cover
@@ -126,20 +278,114 @@ def send_message_task(message_id):  #pragma: no cover
     if not getattr(settings, 'ROUTER_URL', None):
         print "  [%d] - no ROUTER_URL configured, ignoring" % message_id
 
-    # we use redis to acquire a global lock based on our settings key
-    r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    # claim the message, this only succeeds if it hasn't been sent, needs to be sent and
+    # no other worker is already sending it.  our claim lasts at most ROUTER_CLAIM_LEASE seconds
+    claimed = Message.claim(worker_name(), 1, queryset=Message.objects.filter(pk=message_id))
+    if not claimed:
+        print "  [%d] - already sent or being sent, ignoring" % message_id
+        return
+
+    print "  [%d] - sending message" % message_id
+
+    msg = claimed[0]
+    body = send_message(msg)
+    print "  [%d] - msg sent status: %s" % (message_id, msg.status)
+
+@task(track_started=True)
+def send_messages_task(message_ids):
+    """
+    Sends the passed in queued or errored messages, in parallel across backends
+    """
+    messages = Message.claim(worker_name(), len(message_ids), queryset=Message.objects.filter(pk__in=message_ids))
+    count = send_messages(messages)
+    print "-- sent %d of %d messages --" % (count, len(message_ids))
+
+@task(track_started=True)
+def process_incoming_task(connection_id):
+    """
+    Handles all received messages for the passed in connection, used when ROUTER_ASYNC_INCOMING is set
+    """
+    from .router import get_router
+    get_router().process_pending_incoming(connection_id)
+
+@task(track_started=True)
+def recover_incoming_task():
+    """
+    Hands received messages which were never handled back to be handled, should be run every minute or so
+    when ROUTER_ASYNC_INCOMING is set
+    """
+    from .router import get_router
+    recovered = get_router().recover_incoming()
+    print "-- recovered messages for %d connections --" % len(recovered)
+
+def due_messages(now=None):
+    """
+    Returns the errored outgoing messages which are due to be retried, soonest due first
+    """
+    if now is None:
+        now = datetime.now()
+
+    # messages which errored before we scheduled retries don't have a retry time, they are due
+    return Message.objects.filter(Q(next_retry_at__lte=now) | Q(next_retry_at__isnull=True), direction='O', status='E')\
+                          .order_by('next_retry_at').select_related('connection__backend')
+
+def stale_messages(now=None):
+    """
+    Returns the queued outgoing messages outside any batch which have been waiting for over two
+    minutes, oldest first.  Batch messages are left to the tasks which send batches in chunks.
+    """
+    if now is None:
+        now = datetime.now()
+
+    return Message.objects.filter(direction='O', status='Q', batch__isnull=True, updated__lte=now - timedelta(minutes=2))\
+                          .order_by('updated').select_related('connection__backend')
+
+def resend_messages(pending, budgets, policy=None, limit=None):
+    """
+    Queues up to limit (by default ROUTER_RETRY_SCAN) of the passed in messages to be sent again,
+    skipping any whose backend has used up its budget of messages for this run.  budgets maps
+    backend names to how many more messages we can send through them, it is filled in from our
+    retry policy and rate limiter as we come across new backends.  Returns the number of messages
+    queued.
+    """
+    if policy is None:
+        policy = get_retry_policy()
+    limiter = get_rate_limiter()
+
+    if limit is None:
+        limit = getattr(settings, 'ROUTER_RETRY_SCAN', 5000)
+
+    resend = []
+    for msg in pending[:limit]:
+        backend = route_message(None, msg)[0]
+        if backend not in budgets:
+            budget = policy.budget(backend)
+
+            # no point retrying more than our backend's rate limit allows right now
+            available = limiter.available(backend)
+            if available is not None and (budget is None or available < budget):
+                budget = available
+
+            budgets[backend] = budget
 
-    # try to acquire a lock, at most it will last 60 seconds
-    with r.lock('send_message_%d' % message_id, timeout=60):
-        print "  [%d] - sending message" % message_id
+        # leave this one for next time, its backend is already as busy as it can be
+        if budgets[backend] is not None:
+            if budgets[backend] <= 0:
+                continue
+            budgets[backend] -= 1
 
-        # get the message
-        msg = Message.objects.get(pk=message_id)
+        resend.append(msg)
 
-        # if it hasn't been sent and it needs to be sent
-        if msg.status == 'Q' or msg.status == 'E':
-            body = send_message(msg)
-            print "  [%d] - msg sent status: %s" % (message_id, msg.status)
+    if resend:
+        # push these back so we don't queue them again before our workers get to them
+        now = datetime.now()
+        lease = getattr(settings, 'ROUTER_CLAIM_LEASE', 60)
+        Message.objects.filter(pk__in=[msg.pk for msg in resend]).update(next_retry_at=now + timedelta(seconds=lease), updated=now)
+
+    for msg in resend:
+        msg.send()
+
+    return len(resend)
 
 @task(track_started=True)
 def resend_errored_messages_task():  #pragma: no cover
@@ -154,55 +400,51 @@ def resend_errored_messages_task():  #pragma: no cover
 
     # try to acquire a lock, at most it will last 5 mins
     with r.lock('resend_messages', timeout=300):
-        # get all errored outgoing messages
-        pending = Message.objects.filter(direction='O', status__in=('E'))
+        # messages claimed by workers which never finished sending them go back in the queue
+        reclaimed = Message.reclaim_expired()
+        if reclaimed:
+            print "-- reclaimed %d messages with expired claims --" % reclaimed
 
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
+        # we only resend as many messages as each backend's retry budget and rate limit allow
+        budgets = dict()
+        policy = get_retry_policy()
 
-            if count >= 100: break
+        # get all errored outgoing messages which are due to be retried
+        count = resend_messages(due_messages(), budgets, policy)
 
         print "-- resent %d errored messages --" % count
 
-        # and all queued messages that are older than 2 minutes
-        two_minutes_ago = datetime.now() - timedelta(minutes=2)
-        pending = Message.objects.filter(direction='O', status__in=('Q'), updated__lte=two_minutes_ago)
-#        pending = Message.objects.filter(direction='O', status__in=('Q')) #why wait for two minutes???
-
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
-
-            if count >= 100: break
+        # and a few individual messages that have been queued for over 2 minutes, messages whose
+        # sender gave up on them have already been put back in the queue above
+        count = resend_messages(stale_messages(), budgets, policy, getattr(settings, 'ROUTER_STALE_SCAN', 100))
 
         print "-- resent %d pending messages -- " % count
 
 @task(track_started=True)
 def queue_messages_task():
     """
-    Queue batched messages
-    TODO: Ensure that batches that were queued before are taken care of first
+    Queue batched messages, up to CHUNK_SIZE pending messages per batch per run.  Batches are
+    promoted oldest first, and the messages in each in priority order, with a single update per
+    batch.  Returns the number of messages queued.
     """
-    from .models import Message, MessageBatch
-    from rapidsms.messages.outgoing import OutgoingMessage
-    batches = MessageBatch.objects.filter(status='Q')
-    for batch in batches:
+    chunk_size = getattr(settings, 'CHUNK_SIZE', 400)
+    promoted = 0
+
+    for batch in MessageBatch.objects.filter(status='Q').order_by('pk'):
         try:
-            messages = Message.objects.filter(batch=batch, status='P', direction='O')[0:settings.CHUNK_SIZE]
-            # create a RapidSMS outgoing message
-            for outgoing in messages:
-                msg = OutgoingMessage(outgoing.connection, outgoing.text.replace('%','%%'))
-                msg.db_message = outgoing
-                if msg:
-                    outgoing.status = 'Q'
-                    outgoing.save()
-        except IndexError:
-            pass
+            pending = Message.objects.filter(batch=batch, status='P', direction='O')
+
+            # only pick out which messages to promote if we can't promote them all
+            if batch.processing > chunk_size:
+                pending = Message.objects.filter(pk__in=list(pending.order_by('priority', 'pk').values_list('pk', flat=True)[:chunk_size]),
+                                                 status='P')
+
+            promoted += pending.update(status='Q', updated=datetime.now())
+        except Exception, exc:
+            logger.exception("Error queuing messages for batch %d" % batch.pk)
+
+    print "-- queued %d messages -- " % promoted
+    return promoted
 
 def build_send_url_legacy(params, **kwargs):
     """
@@ -243,21 +485,110 @@ def build_send_url_legacy(params, **kwargs):
 
     return full_url
     
-def send_backend_chunk(router_url, pks, backend_name):
-    msgs = Message.objects.filter(pk__in=pks).exclude(connection__identity__iregex="[a-z]")
-    print "-- %s messages to be send out -- " % msgs.count()
-    #        try:
-    params = {
-    'router_url': router_url,
-     'backend': backend_name, 
-     'recipient': ' '.join(msgs.values_list('connection__identity', flat=True)), 
-     'text': msgs[0].text, 
-    }
-    url = build_send_url_legacy(params)
+# the fields we need for each message we send as part of a chunk
+CHUNK_FIELDS = ('id', 'text', 'connection__identity', 'connection__backend__name')
+
+class Chunk(object):
+    """
+    Messages with the exact same text going out through the same backend and url, these are
+    sent to Kannel in a single request with a space separated list of recipients.  token is the
+    claim we hold on the messages, if we claimed them.
+    """
+    def __init__(self, backend, router_url, text, token=None):
+        self.backend = backend
+        self.router_url = router_url
+        self.text = text
+        self.token = token
+        self.pks = []
+        self.recipients = []
+
+        # whether our url carries the id of our message, limiting us to a single one
+        self.per_message = per_message(router_url, backend)
+
+        # the length of our url with no recipients
+        self.length = len(self.url())
+
+    def url(self):
+        params = {
+            'router_url': self.router_url,
+            'backend': self.backend,
+            'recipient': ' '.join(self.recipients),
+            'text': self.text,
+            'id': ' '.join(str(pk) for pk in self.pks),
+        }
+        return build_send_url_legacy(params)
+
+def per_message(router_url, backend):
+    """
+    Returns whether the passed in url includes the id of the message sent, usually in a dlr-url, in which case
+    every message needs a request of its own, chunks can only carry a single id
+    """
+    if type(router_url) is dict:
+        router_url = router_url.get(backend, router_url.get('default'))
+    return '%(id)' in (router_url or '')
+
+def group_messages(rows, router_url, max_recipients=None, max_url_length=None):
+    """
+    Groups the passed in messages, dicts of CHUNK_FIELDS and optionally claimed_by, into chunks by
+    the backend and url they go out through, their exact text and the claim we hold on them.  Chunks never have more than max_recipients recipients
+    or a url longer than max_url_length characters, and only ever one if their url carries the id of its message.  Chunks are returned in the order of their
+    first message, so messages passed in priority order are sent in priority order.
+    """
+    if max_recipients is None:
+        max_recipients = getattr(settings, 'ROUTER_CHUNK_MAX_RECIPIENTS', getattr(settings, 'MESSAGE_CHUNK_SIZE', 400))
+    if max_url_length is None:
+        max_url_length = getattr(settings, 'ROUTER_CHUNK_MAX_URL_LENGTH', 8000)
+
+    table = get_routing_table()
+
+    chunks = []
+    open_chunks = dict()
+    for row in rows:
+        identity = row['connection__identity']
+        backend = row['connection__backend__name']
+        url = router_url
+
+        # our recipient may need to go out through a specific backend, and so that backend's url
+        route = table.route(identity)
+        if route:
+            backend = route.backend
+            url = route.url or kannel_url(route.backend, router_url)
+
+        key = (backend, route.url if route else None, row['text'], row.get('claimed_by'))
+        chunk = open_chunks.get(key)
+
+        # each recipient adds its encoded identity and a separator to our url
+        length = len(quote_plus(identity)) + 1
+        if chunk and (len(chunk.pks) >= max_recipients or chunk.length + length > max_url_length or chunk.per_message):
+            chunk = None
+
+        if chunk is None:
+            chunk = Chunk(backend, url, row['text'], row.get('claimed_by'))
+            open_chunks[key] = chunk
+            chunks.append(chunk)
+
+        chunk.pks.append(row['id'])
+        chunk.recipients.append(identity)
+        chunk.length += length if len(chunk.pks) > 1 else length - 1
+
+    return chunks
+
+def fetch_chunk(chunk):
+    """
+    Sends the passed in chunk to Kannel in a single request, returns whether it was accepted
+    """
+    url = chunk.url()
     print "-- calling url: %s -- " % url
     res = None 
+    status_code = None
+
+    # every recipient counts against our backend's rate limit
+    get_rate_limiter().wait(chunk.backend, len(chunk.pks))
+
     try:
-        res = urllib2.urlopen(url, timeout=15)
+        with registry.timer('httprouter_send_seconds', backend=chunk.backend, section='http'):
+            res = get_http_pool().urlopen(url)
+            status_code = res.getcode()
     except urllib2.HTTPError, err:
         if err.code == 404:
             print " -- Not found (404)! -- Kannel might be down"
@@ -265,88 +596,161 @@ def send_backend_chunk(router_url, pks, backend_name):
             print "-- Access denied (403)! -- Connection to Kannel Refused"
         else:
             print "HTTPError! Error code: %s", err.code
-        msgs.update(status='E')
+        status_code = err.code
     except urllib2.URLError, err:
         print "-- URLError: %s", err.reason
-        msgs.update(status='E')
-    finally:   
-        if res:
-            status_code = res.getcode()
+        status_code = err.reason
+    except Exception, err:
+        print "-- Error: %s", err
+        res = None
+
+    print "-- kannel responded with %s status code -- " % status_code     
+
+    # kannel likes to send 202 responses, really any
+    # 2xx value means things went okay
+    return res is not None and int(status_code / 100) == 2
+
+def chunk_sent(chunk, accepted):
+    """
+    Marks the messages in the passed in chunk as sent if Kannel accepted it, releasing our claim on
+    them.  If not, messages which have used up all their attempts fail permanently and the rest are
+    retried, backing off by how many times each has been tried.  Messages whose claim lapsed belong
+    to whoever reclaimed them and are left be.
+    """
+    msgs = Message.objects.filter(pk__in=chunk.pks)
+    if chunk.token:
+        msgs = msgs.filter(status='L', claimed_by=chunk.token)
+
+    with registry.timer('httprouter_send_seconds', backend=chunk.backend, section='db'):
+        if accepted:
+            msgs.update(status='S', sent=datetime.now(), claimed_by=None, lease_expires=None)
+            print "-- kannel accepted all the %s messages, we mark them as sent -- " % len(chunk.pks)
         else:
-            try:
-                status_code = err.code
-            except AttributeError:
-                status_code = err.reason       
-        print "-- kannel responded with %s status code -- " % status_code     
-        # kannel likes to send 202 responses, really any
-        # 2xx value means things went okay
-        if not res == None and int(status_code / 100) == 2:
-            msgs.update(status='S')
-            print "-- kannel accepted all the %s messages, we mark them as sent -- " % msgs.count()
-            
-#        else:
-#            msgs.update(status='Q')
-#            print "-- kannel didn't accept these %s messages, we leave them queued -- " % msgs.count()
-
-#        except Exception as e:
-#            print "-- there was Error, %s messages are left queued -- " % msgs.count()
-#            msgs.update(status='Q')
-            
-def send_all(router_url, to_send):
-        pks = []
-        if len(to_send):
-            backend_name = to_send[0].connection.backend.name
-            print "-- initializing sending messages for %s backend -- " % backend_name 
-            for msg in to_send:
-                if backend_name != msg.connection.backend.name:
-                    # send all of the same backend
-                    send_backend_chunk(router_url, pks, backend_name)
-                    # reset the loop status variables to build the next chunk of messages with the same backend
-                    backend_name = msg.connection.backend.name
-                    pks = [msg.pk]
-                else:
-                    pks.append(msg.pk)
-            print "-- sending out %s messages as a chunk through %s backend -- " % (len(pks), backend_name)
-            send_backend_chunk(router_url, pks, backend_name)
-
-def send_individual(router_url, backend):
-    to_process = Message.objects.filter(direction='O', connection__backend__name=backend, status__in=['Q']).order_by('priority', 'status')
-    print "-- processing %s individually -- " % to_process.count()
-    if len(to_process):
-        send_all(router_url, [to_process[0]])
-                    
+            now = datetime.now()
+            released = dict(updated=now, claimed_by=None, lease_expires=None)
+            msgs.filter(attempts__gte=max_attempts() - 1)\
+                .update(status='F', attempts=F('attempts') + 1, next_retry_at=None, **released)
+
+            # messages in a chunk have usually all been tried the same number of times, we go from the
+            # most tried down so that no message is counted twice
+            policy = get_retry_policy()
+            retried = msgs.filter(attempts__lt=max_attempts() - 1)
+            for attempts in sorted(set(retried.values_list('attempts', flat=True)), reverse=True):
+                retried.filter(attempts=attempts)\
+                       .update(status='E', attempts=attempts + 1, next_retry_at=policy.next_retry(attempts + 1, now), **released)
+
+def send_chunk(chunk):
+    try:
+        accepted = fetch_chunk(chunk)
+    except Exception, exc:
+        logger.exception("Error sending chunk through %s backend" % chunk.backend)
+        accepted = False
+
+    chunk_sent(chunk, accepted)
+
+def send_chunks(chunks):
+    """
+    Sends the passed in chunks, different backends in parallel through our concurrent sender.
+    Only the requests are made on the sender's threads, message statuses and our claims on them
+    are updated on this one.
+    """
+    pending = dict()
+    for chunk in chunks:
+        pending.update((pk, chunk.token) for pk in chunk.pks)
+
+    def handle_result(job, ok, value):
+        for pk in job.data.pks:
+            pending.pop(pk, None)
+        chunk_sent(job.data, ok and value)
+
+    jobs = [SendJob(chunk.backend, partial(fetch_chunk, chunk), chunk, size=len(chunk.pks)) for chunk in chunks]
+    get_sender().run(jobs, handle_result, partial(renew_claims, pending), renew_interval())
+
+def route_message(router_url, msg):
+    """
+    Returns the (backend name, router url) the passed in message should be sent through, taking
+    into account any prefix routes for its recipient.
+    """
+    route = get_routing_table().route(msg.connection.identity)
+    if route:
+        return (route.backend, route.url or kannel_url(route.backend, router_url))
+    return (msg.connection.backend.name, router_url)
+
+def kannel_url(backend, default=None):
+    """
+    Returns the url KANNEL_BACKENDS configures for the passed in backend, or default if it has none
+    """
+    return getattr(settings, 'KANNEL_BACKENDS', {}).get(backend, default)
+
+def queued_messages(backend):
+    """
+    Returns the queued outgoing messages for the passed in backend, across all batches and
+    individual sends, in priority order.  Messages to identities containing letters can't be
+    sent to Kannel and are left out.
+    """
+    return Message.objects.filter(direction='O', connection__backend__name=backend, status='Q')\
+                          .exclude(connection__identity__iregex="[a-z]").order_by('priority', 'pk')
+
+def queued_counts(backends):
+    """
+    Returns the number of queued outgoing messages for the passed in backends, as a list of
+    dicts with batch, backend, priority and count, in a single aggregated query.  Just like
+    queued_messages, messages to identities containing letters are left out.
+    """
+    return Message.objects.filter(direction='O', status='Q', connection__backend__name__in=backends)\
+                          .exclude(connection__identity__iregex="[a-z]")\
+                          .values('batch', 'connection__backend__name', 'priority')\
+                          .annotate(count=Count('id')).order_by()
+
+def close_finished_batches():
+    """
+    Marks all queued batches whose messages are all done as sent, in a single update using the
+    counters on each batch.  Returns the number of batches closed.
+    """
+    return MessageBatch.objects.filter(MessageBatch.finished_filter(), status='Q').update(status='S')
+
 @task(track_started=True)
 def send_kannel_messages_task():
     """
     Send MT messages to Kannel for onward forwarding to 
     """
-#    import ipdb;ipdb.set_trace()
     print "-- starting the passing of messages to kannel --" 
-    from .models import Message, MessageBatch
     backends = settings.KANNEL_BACKENDS
     CHUNK_SIZE = getattr(settings, 'MESSAGE_CHUNK_SIZE', 400)
-#    while (True): #Removed since this is now run as a celery task
+
+    closed = close_finished_batches()
+    if closed:
+        print "-- %d batches have no more messages to process, closed them out -- " % closed
+
+    # work out what each backend has queued, by batch and priority, in one query
+    queues = dict()
+    for row in queued_counts(backends.keys()):
+        queues.setdefault(row['connection__backend__name'], dict())[(row['batch'], row['priority'])] = \
+            (row['batch'] is None, row['priority'], row['count'])
+
+    scheduler = get_scheduler()
+    chunks = []
     for backend, router_url in backends.items():
-        print "-- processing messages for %s backend -- " % backend 
+        if not queues.get(backend):
+            continue
+
+        print "-- processing %d queued messages for %s backend -- " % (sum(q[2] for q in queues[backend].values()), backend)
         try:
-            to_process = MessageBatch.objects.filter(status='Q')
-            if to_process.count():
-                print "-- %s batches found -- " % to_process.count() 
-                batch = to_process[0]
-                print "-- processing batch %s -- " % batch 
-                to_process = batch.messages.filter(direction='O', connection__backend__name=backend, status__in=['Q']).order_by('priority', 'status')[:CHUNK_SIZE]
-                if to_process.count():
-                    print "-- batch %s contains %s messages to process -- " % (batch, to_process.count()) 
-                    send_all(router_url, to_process)
-                elif batch.messages.filter(status__in=['S', 'C']).count() == batch.messages.count():
-                    print "-- batch %s has no more messages to processing, clossing it out -- " % batch 
-                    batch.status = 'S'
-                    batch.save()
-                else:
-                    print "-- sending individual message -- "  
-                    send_individual(router_url, backend)
-            else:
-                print "-- sending individual message -- " 
-                send_individual(router_url, backend)
+            # share this cycle out between our batches and interactive messages
+            message_ids = []
+            for (batch, priority), count in sorted(scheduler.allocate(queues[backend], CHUNK_SIZE, backend).items()):
+                if count:
+                    message_ids += queued_messages(backend).filter(batch=batch, priority=priority).values_list('pk', flat=True)[:count]
+
+            # claim them, so overlapping runs and our resend task leave them be while we send them, then
+            # group everything we're sending through this backend by its text
+            if message_ids:
+                to_process = Message.claim(worker_name(), len(message_ids), statuses=('Q',),
+                                           queryset=Message.objects.filter(pk__in=message_ids),
+                                           values=CHUNK_FIELDS + ('claimed_by',))
+                chunks += group_messages(to_process, router_url)
         except Exception, exc:
-            pass
+            logger.exception("Error grouping messages for %s backend" % backend)
+
+    # our backends are all sent to in parallel, so a slow one doesn't hold up the others
+    send_chunks(chunks)
@@ -7,9 +7,12 @@ add issues as they occur so we have automated regression testing.
 
 """
 import time
+import datetime
 from django.test import TestCase, TransactionTestCase
-from .router import get_router, HttpRouter
+from django.test.utils import override_settings
+from .router import get_router, HttpRouter, IncomingWorkers
 from .models import Message
+from .cache import resolution_cache, LRUCache
 
 from rapidsms.models import Backend, Connection
 from rapidsms.apps.base import AppBase
@@ -35,6 +38,7 @@ class BackendTest(TransactionTestCase):
 
         settings.ROUTER_PASSWORD = None
         settings.ROUTER_URL = None
+        resolution_cache.clear()
 
         # make celery tasks execute immediately (no redis)
         settings.CELERY_ALWAYS_EAGER = True
@@ -81,6 +85,655 @@ class BackendTest(TransactionTestCase):
         # check whether our url was set right
         self.assertEquals("http://mykannel.com/cgi-bin/sendsms?from=1234&text=test&to=2067799294&smsc=test_backend&id=%d" % msg1.id, test_fetch_url.url)
 
+    def testSendPipeline(self):
+        from .tasks import send_message
+        from .pipeline import get_pipeline
+
+        settings.ROUTER_URL = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+
+        # monkey patch the router's fetch_url request
+        def test_fetch_url(cls, url, params):
+            test_fetch_url.url = url
+            return TestResponse()
+
+        HttpRouter.fetch_url = classmethod(test_fetch_url)
+
+        msg = Message.objects.create(connection=self.connection, text="fish & chips", direction='O', status='Q')
+        self.assertEquals("body", send_message(msg))
+        self.assertEquals('S', Message.objects.get(pk=msg.pk).status)
+        self.assertEquals("http://mykannel.com/cgi-bin/sendsms?text=fish+%%26+chips&to=2067799294&smsc=test_backend&id=%d" % msg.pk, test_fetch_url.url)
+
+        # our pipeline is reused between messages
+        pipeline = get_pipeline('test_backend')
+        self.assertTrue(pipeline is get_pipeline('test_backend'))
+
+        # until our settings change
+        settings.ROUTER_URL = "http://mykannel2.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s"
+        self.assertFalse(pipeline is get_pipeline('test_backend'))
+
+        msg = Message.objects.create(connection=self.connection, text="test", direction='O', status='Q')
+        send_message(msg)
+        self.assertEquals("http://mykannel2.com/cgi-bin/sendsms?text=test&to=2067799294", test_fetch_url.url)
+
+    def testConcurrentSender(self):
+        import threading
+        from .sender import ConcurrentSender, SendJob
+
+        sender = ConcurrentSender(size=3, backend_limits=dict(slow=2), default_limit=1)
+
+        lock = threading.Lock()
+        running = dict()
+        peaks = dict(total=0)
+
+        def send(backend, value):
+            with lock:
+                running[backend] = running.get(backend, 0) + 1
+                peaks[backend] = max(peaks.get(backend, 0), running[backend])
+                peaks['total'] = max(peaks['total'], sum(running.values()))
+            time.sleep(0.01)
+            with lock:
+                running[backend] -= 1
+            if value < 0:
+                raise Exception("failed")
+            return value
+
+        jobs = [SendJob(backend, lambda b=backend, v=i: send(b, v), i) for i in range(8) for backend in ('slow', 'fast', 'other')]
+        jobs.append(SendJob('fast', lambda: send('fast', -1), -1))
+
+        results = []
+        failed = sender.run(jobs, lambda job, ok, value: results.append((job.backend, ok, value)))
+
+        # everything ran, with our caps respected
+        self.assertEquals(1, failed)
+        self.assertEquals(25, len(results))
+        self.assertEquals(2, peaks['slow'])
+        self.assertEquals(1, peaks['fast'])
+        self.assertEquals(1, peaks['other'])
+        self.assertEquals(3, peaks['total'])
+
+        # results come back with each job's data
+        self.assertEquals(range(8), sorted(value for backend, ok, value in results if backend == 'slow'))
+        self.assertTrue(('fast', False) in [(backend, ok) for backend, ok, value in results if not ok])
+
+        self.assertEquals(8, sender.stats['fast'].sent)
+        self.assertEquals(1, sender.stats['fast'].failed)
+        self.assertEquals(0, sender.stats['fast'].in_flight)
+        self.assertTrue(sender.stats['slow'].throughput() > 0)
+
+        # we tick on this thread while waiting on slow jobs
+        ticks = []
+        sender.run([SendJob('slow', lambda: time.sleep(0.2))], tick=lambda: ticks.append(threading.current_thread()), interval=0.05)
+        self.assertTrue(len(ticks) >= 2)
+        self.assertEquals(set([threading.current_thread()]), set(ticks))
+
+    def testSendMessages(self):
+        from .tasks import send_messages
+
+        settings.ROUTER_URL = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+
+        # messages through our second backend fail
+        def test_fetch_url(cls, url, params):
+            if 'test_backend2' in url:
+                raise Exception("Kannel is down")
+            return TestResponse()
+
+        HttpRouter.fetch_url = classmethod(test_fetch_url)
+
+        msgs = [Message.objects.create(connection=connection, text="test %d" % i, direction='O', status='Q')
+                for i in range(3) for connection in (self.connection, self.connection2)]
+        self.assertEquals(3, send_messages(msgs))
+
+        for msg in msgs:
+            msg = Message.objects.get(pk=msg.pk)
+            if msg.connection == self.connection:
+                self.assertEquals('S', msg.status)
+                self.assertTrue(msg.sent)
+            else:
+                self.assertEquals('E', msg.status)
+                self.assertEquals(1, msg.errors.count())
+
+    def testRateLimit(self):
+        import redis
+        from .ratelimit import TokenBucket, RateLimiter
+
+        now = [1000.0]
+        bucket = TokenBucket(10, 5, clock=lambda: now[0])
+
+        # we start with a full bucket
+        self.assertEquals(5, bucket.available())
+        self.assertEquals((True, 0.0), bucket.take(5))
+        self.assertEquals(False, bucket.take(1)[0])
+        self.assertAlmostEquals(0.1, bucket.take(1)[1])
+
+        # which refills over time, but never past its capacity
+        now[0] += 0.25
+        self.assertEquals(2, bucket.available())
+        now[0] += 10
+        self.assertEquals(5, bucket.available())
+
+        # reserving always takes our tokens, telling us how long to wait before using them
+        self.assertEquals((True, 0.0), bucket.take(5, True))
+        taken, wait = bucket.take(2, True)
+        self.assertTrue(taken)
+        self.assertAlmostEquals(0.2, wait)
+        self.assertEquals(0, bucket.available())
+
+        # our limiter falls back to in-memory buckets when redis can't be reached
+        limiter = RateLimiter(dict(mtn=1000, airtel=(1, 2)), redis.StrictRedis(host='localhost', port=1))
+        self.assertEquals(None, limiter.available('orange'))
+        self.assertTrue(limiter.try_acquire('orange', 1000))
+        self.assertEquals(2, limiter.available('airtel'))
+        self.assertTrue(limiter.try_acquire('airtel', 2))
+        self.assertFalse(limiter.try_acquire('airtel'))
+        self.assertTrue(limiter.redis_failed)
+
+        # waiting for a token actually sleeps
+        start = time.time()
+        self.assertEquals(0, limiter.wait('mtn', 1000))
+        self.assertTrue(limiter.wait('mtn', 10) > 0)
+        self.assertTrue(time.time() - start >= 0.009)
+
+    def testClaim(self):
+        msgs = [Message.objects.create(connection=self.connection, text="test %d" % i, direction='O', status='Q', priority=10 - i)
+                for i in range(5)]
+        Message.objects.filter(pk=msgs[0].pk).update(status='S')
+        Message.objects.filter(pk=msgs[1].pk).update(status='E')
+
+        # we claim the highest priority messages first
+        claimed = Message.claim('worker1', 2)
+        self.assertEquals([msgs[4].pk, msgs[3].pk], [msg.pk for msg in claimed])
+        self.assertEquals(['L', 'L'], [msg.status for msg in claimed])
+        self.assertTrue(claimed[0].claimed_by.startswith('worker1:'))
+
+        # claimed and sent messages can't be claimed by anybody else
+        claimed = Message.claim('worker2', 5)
+        self.assertEquals([msgs[2].pk, msgs[1].pk], [msg.pk for msg in claimed])
+        self.assertEquals([], Message.claim('worker3', 5))
+
+        # until their lease expires
+        Message.objects.filter(pk=msgs[4].pk).update(lease_expires=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEquals([msgs[4].pk], [msg.pk for msg in Message.claim('worker3', 5)])
+
+        # expired claims can also be put back in the queue
+        Message.objects.filter(pk=msgs[3].pk).update(lease_expires=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEquals(1, Message.reclaim_expired())
+        self.assertEquals('Q', Message.objects.get(pk=msgs[3].pk).status)
+
+        # claims can be limited to a queryset
+        claimed = Message.claim('worker4', 5, queryset=Message.objects.filter(pk=msgs[3].pk))
+        self.assertEquals([msgs[3].pk], [msg.pk for msg in claimed])
+
+    def testLostClaim(self):
+        from .tasks import message_sent, message_failed
+
+        msgs = [Message.objects.create(connection=self.connection, text="test %d" % i, direction='O', status='Q')
+                for i in range(3)]
+        claimed = Message.claim('worker1', 3)
+        token = claimed[0].claimed_by
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=1)
+
+        # renewing our claim keeps it from being reclaimed
+        Message.objects.filter(pk__in=[msg.pk for msg in msgs]).update(lease_expires=expired)
+        self.assertEquals(3, Message.renew_claims(token, [msg.pk for msg in msgs]))
+        self.assertEquals(0, Message.reclaim_expired())
+
+        # but once it lapses and someone else claims the message, it's theirs
+        Message.objects.filter(pk=msgs[0].pk).update(lease_expires=expired)
+        self.assertEquals(1, Message.reclaim_expired())
+        other = Message.claim('worker2', 1)
+        self.assertEquals([msgs[0].pk], [msg.pk for msg in other])
+        self.assertEquals(0, Message.renew_claims(token, [msgs[0].pk]))
+
+        # so finishing up with it leaves it be
+        message_sent(claimed[0], 200, "", 'test_backend')
+        self.assertEquals(('L', other[0].claimed_by), Message.objects.filter(pk=msgs[0].pk).values_list('status', 'claimed_by')[0])
+
+        # the messages we still hold are released as they are sent or fail
+        message_sent(claimed[1], 200, "", 'test_backend')
+        message_failed(claimed[2], Exception("failed"), 'test_backend')
+        self.assertEquals([('S', None), ('E', None)], list(Message.objects.filter(pk__in=[msgs[1].pk, msgs[2].pk])
+                                                                           .order_by('pk').values_list('status', 'claimed_by')))
+        self.assertEquals(['S', 'E'], [claimed[1].status, claimed[2].status])
+
+    def testRetry(self):
+        from .retry import RetryPolicy
+        from .tasks import send_message, due_messages, resend_messages
+
+        # delays grow exponentially up to our max
+        policy = RetryPolicy(base=10, factor=3, max_delay=60, jitter=0)
+        self.assertEquals([10, 30, 60, 60], [policy.delay(attempts) for attempts in range(1, 5)])
+
+        # jitter shortens them by up to the passed in fraction
+        policy = RetryPolicy(base=10, jitter=0.5)
+        for i in range(20):
+            self.assertTrue(5 <= policy.delay(1) <= 10)
+
+        # failed messages are scheduled for a retry
+        settings.ROUTER_URL = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+        def failing_fetch_url(cls, url, params):
+            raise Exception("Kannel is down")
+
+        fetch_url = HttpRouter.__dict__['fetch_url']
+        HttpRouter.fetch_url = classmethod(failing_fetch_url)
+        try:
+            msgs = [Message.objects.create(connection=connection, text="test", direction='O', status='Q')
+                    for i in range(3) for connection in (self.connection, self.connection2)]
+            for msg in msgs:
+                send_message(msg)
+
+            msg = Message.objects.get(pk=msgs[0].pk)
+            self.assertEquals('E', msg.status)
+            self.assertEquals(1, msg.attempts)
+            self.assertTrue(msg.next_retry_at > datetime.datetime.now())
+
+            # so none of them are due yet
+            self.assertEquals(0, due_messages().count())
+
+            # until their time comes
+            Message.objects.update(next_retry_at=datetime.datetime.now() - datetime.timedelta(seconds=1))
+            self.assertEquals(6, due_messages().count())
+
+            # each backend can only retry so many messages per run
+            HttpRouter.fetch_url = classmethod(lambda cls, url, params: TestResponse())
+            policy = RetryPolicy(budgets=dict(test_backend=1), default_budget=2)
+            self.assertEquals(3, resend_messages(due_messages(), dict(), policy))
+            self.assertEquals(1, Message.objects.filter(connection=self.connection, status='S').count())
+            self.assertEquals(2, Message.objects.filter(connection=self.connection2, status='S').count())
+
+            # and the ones left over are retried next time
+            self.assertEquals(3, due_messages().count())
+            self.assertEquals(2, resend_messages(due_messages(), dict(), policy))
+            self.assertEquals(5, Message.objects.filter(status='S').count())
+        finally:
+            HttpRouter.fetch_url = fetch_url
+
+    def testStaleMessages(self):
+        from .models import MessageBatch
+        from .tasks import stale_messages, resend_messages
+
+        batch = MessageBatch.objects.create(status='Q')
+        old = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        msgs = [Message.objects.create(connection=self.connection, text="test %d" % i, direction='O', status='Q')
+                for i in range(3)]
+        Message.objects.create(connection=self.connection, text="batch", direction='O', status='Q', batch=batch)
+        Message.objects.create(connection=self.connection, text="recent", direction='O', status='Q')
+        Message.objects.exclude(text="recent").update(updated=old)
+
+        # only individual messages which have been waiting a while are picked up, batches are sent in chunks
+        self.assertEquals([msg.pk for msg in msgs], [msg.pk for msg in stale_messages()])
+
+        # and only as many as we are allowed
+        self.assertEquals(2, resend_messages(stale_messages(), dict(), limit=2))
+
+    def testFailedAttempts(self):
+        from .tasks import message_failed
+
+        msg = Message.objects.create(connection=self.connection, text="test", direction='O', status='L')
+
+        # failures are counted without counting our delivery errors
+        with self.assertNumQueries(3):
+            message_failed(msg, Exception("Kannel is down"), 'test_backend', "http://kannel/send", (500, "error"))
+
+        msg = Message.objects.get(pk=msg.pk)
+        self.assertEquals(('E', 1), (msg.status, msg.attempts))
+        log = msg.errors.get().log
+        self.assertTrue("Status Code: 500" in log)
+        self.assertTrue("Failure #1" in log)
+        self.assertTrue("Will retry 2 more time(s)" in log)
+
+        # logs can be truncated
+        with override_settings(ROUTER_DELIVERY_ERROR_LOG='truncated', ROUTER_DELIVERY_ERROR_LOG_LENGTH=20):
+            message_failed(msg, Exception("Kannel is down"), 'test_backend')
+        self.assertEquals(20, len(msg.errors.order_by('-pk')[0].log))
+        self.assertEquals(('E', 2), (Message.objects.get(pk=msg.pk).status, Message.objects.get(pk=msg.pk).attempts))
+
+        # or turned off, and our last attempt is a permanent failure
+        with override_settings(ROUTER_DELIVERY_ERROR_LOG='none'):
+            with self.assertNumQueries(1):
+                message_failed(msg, Exception("Kannel is down"), 'test_backend')
+        self.assertEquals(('F', 3), (Message.objects.get(pk=msg.pk).status, Message.objects.get(pk=msg.pk).attempts))
+        self.assertEquals(2, msg.errors.count())
+
+        # sampled logs always include permanent failures
+        with override_settings(ROUTER_DELIVERY_ERROR_LOG='sampled', ROUTER_DELIVERY_ERROR_SAMPLE_RATE=0):
+            message_failed(msg, Exception("Kannel is down"), 'test_backend')
+            self.assertEquals(3, msg.errors.count())
+
+            msg = Message.objects.create(connection=self.connection, text="test", direction='O', status='L')
+            message_failed(msg, Exception("Kannel is down"), 'test_backend')
+            self.assertEquals(0, msg.errors.count())
+
+    def testGroupMessages(self):
+        from .tasks import group_messages
+        from .routing import reload_routing_table
+
+        rows = [dict(id=i, text="hello" if i % 3 else "bonjour", connection__identity="2567%05d" % i, connection__backend__name='mtn')
+                for i in range(10)]
+        rows.append(dict(id=10, text="hello", connection__identity="25670000", connection__backend__name='airtel'))
+
+        url = "http://kannel/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s"
+        chunks = group_messages(rows, url)
+
+        # one chunk per backend and text, in the order of their first message
+        self.assertEquals([('mtn', 'bonjour'), ('mtn', 'hello'), ('airtel', 'hello')], [(c.backend, c.text) for c in chunks])
+        self.assertEquals([0, 3, 6, 9], chunks[0].pks)
+        self.assertEquals("http://kannel/send?to=256700000+256700003+256700006+256700009&text=bonjour&smsc=mtn", chunks[0].url())
+
+        # chunks are split to respect our recipient limit
+        chunks = group_messages(rows, url, max_recipients=3)
+        self.assertEquals([[0, 3, 6], [1, 2, 4], [5, 7, 8], [9], [10]], [c.pks for c in chunks])
+
+        # and our url length limit, here just short of three recipients for our longer text
+        chunks = group_messages(rows, url, max_url_length=len(chunks[0].url()) - 1)
+        self.assertEquals([[0, 3], [1, 2, 4], [5, 7, 8], [6, 9], [10]], [c.pks for c in chunks])
+        for chunk in chunks:
+            self.assertTrue(len(chunk.url()) < len(url) + 30)
+            self.assertEquals(chunk.length, len(chunk.url()))
+
+        # urls which carry the id of their message, for a dlr-url, can only send one message per request
+        dlr_url = "http://kannel/send?to=%(recipient)s&text=%(text)s&dlr-url=http%%3A%%2F%%2Fmyrapid.com%%2Frouter%%2Fdlr%%3Fmessage_id%%3D%(id)s"
+        chunks = group_messages(rows[:3], dlr_url)
+        self.assertEquals([[0], [1], [2]], [c.pks for c in chunks])
+        self.assertEquals("http://kannel/send?to=256700001&text=hello&dlr-url=http%3A%2F%2Fmyrapid.com%2Frouter%2Fdlr%3Fmessage_id%3D1", chunks[1].url())
+
+        # routed recipients go out through their route's backend, and that backend's url unless the route has its own
+        rows = [dict(id=11, text="hello", connection__identity="25768123456", connection__backend__name='mtn'),
+                dict(id=12, text="hello", connection__identity="25779123456", connection__backend__name='mtn')]
+        with override_settings(KANNEL_BACKENDS={'lumitel': "http://lumitel.com/send?to=%(recipient)s&smsc=%(backend)s"},
+                               ROUTER_PREFIX_ROUTES={'25768': 'lumitel', '25779': ('leo', 'http://leo.com/send?to=%(recipient)s&smsc=%(backend)s')}):
+            reload_routing_table()
+            try:
+                chunks = group_messages(rows, url)
+            finally:
+                reload_routing_table()
+        self.assertEquals(["http://lumitel.com/send?to=25768123456&smsc=lumitel", "http://leo.com/send?to=25779123456&smsc=leo"],
+                          [c.url() for c in chunks])
+
+    @override_settings(KANNEL_BACKENDS={'test_backend': "http://kannel/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s"})
+    def testSendKannelMessages(self):
+        from .models import MessageBatch
+        from .httppool import get_http_pool
+        from .tasks import send_kannel_messages_task
+
+        connections = [Connection.objects.create(backend=self.backend, identity="2567%05d" % i) for i in range(5)]
+
+        batch = MessageBatch.objects.create(status='Q')
+        msgs = [Message.objects.create(connection=connection, text="broadcast", direction='O', status='Q', batch=batch)
+                for connection in connections]
+        msgs += [Message.objects.create(connection=connection, text="reply %d" % (i % 2), direction='O', status='Q')
+                 for i, connection in enumerate(connections)]
+
+        urls = []
+        def urlopen(url):
+            urls.append(url)
+            return TestResponse()
+
+        pool = get_http_pool()
+        pool.urlopen = urlopen
+        try:
+            # everything queued goes out grouped by text, across batches and individual messages, never under the wrong text
+            send_kannel_messages_task()
+            self.assertEquals(["http://kannel/send?to=256700000+256700001+256700002+256700003+256700004&text=broadcast&smsc=test_backend",
+                               "http://kannel/send?to=256700000+256700002+256700004&text=reply+0&smsc=test_backend",
+                               "http://kannel/send?to=256700001+256700003&text=reply+1&smsc=test_backend"], sorted(urls))
+            self.assertEquals(10, Message.objects.filter(status='S').count())
+
+            # our batch is closed out on the next run, which has nothing left to send
+            urls = []
+            send_kannel_messages_task()
+            self.assertEquals([], urls)
+            self.assertEquals('S', MessageBatch.objects.get(pk=batch.pk).status)
+        finally:
+            del pool.urlopen
+
+    @override_settings(ROUTER_RETRY_JITTER=0)
+    def testChunkFailed(self):
+        import socket
+        from .httppool import get_http_pool
+        from .tasks import Chunk, send_chunk
+
+        msgs = [Message.objects.create(connection=self.connection, text="broadcast", direction='O', status='Q', attempts=i)
+                for i in range(3)]
+        chunk = Chunk('test_backend', "http://kannel/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s", "broadcast")
+        chunk.pks = [msg.pk for msg in msgs]
+        chunk.recipients = [self.connection.identity] * 3
+
+        # errors other than HTTP ones still count as a failed attempt
+        def urlopen(url):
+            raise socket.timeout("timed out")
+
+        pool = get_http_pool()
+        pool.urlopen = urlopen
+        try:
+            start = datetime.datetime.now()
+            send_chunk(chunk)
+        finally:
+            del pool.urlopen
+
+        # each message backs off by how many times it has been tried, and fails once it is out of attempts
+        msgs = list(Message.objects.filter(pk__in=chunk.pks).order_by('pk'))
+        self.assertEquals([('E', 1), ('E', 2), ('F', 3)], [(msg.status, msg.attempts) for msg in msgs])
+        self.assertTrue(start + datetime.timedelta(seconds=30) <= msgs[0].next_retry_at < start + datetime.timedelta(seconds=60))
+        self.assertTrue(start + datetime.timedelta(seconds=60) <= msgs[1].next_retry_at < start + datetime.timedelta(seconds=90))
+        self.assertEquals(None, msgs[2].next_retry_at)
+
+    def testBatchCounts(self):
+        from .models import MessageBatch
+
+        batch = MessageBatch.objects.create(status='Q')
+        Message.objects.bulk_create([Message(connection=self.connection, text="test %d" % i, direction='O', status='P', batch=batch)
+                                     for i in range(5)])
+        single = Message.objects.create(connection=self.connection2, text="single", direction='O', status='Q', batch=batch)
+        Message.objects.create(connection=self.connection, text="no batch", direction='O', status='Q')
+
+        batch = MessageBatch.objects.get(pk=batch.pk)
+        self.assertEquals((6, 5, 1), (batch.total, batch.processing, batch.queued))
+
+        # bulk updates move our counts, only counting messages which actually change status
+        self.assertEquals(7, Message.objects.filter(direction='O', status__in=['P', 'Q']).update(status='Q'))
+        pks = list(Message.objects.filter(batch=batch).order_by('pk').values_list('pk', flat=True))
+        self.assertEquals(3, Message.objects.filter(pk__in=pks[:3]).update(status='S', sent=datetime.datetime.now()))
+        Message.objects.filter(pk=pks[3]).update(status='C')
+
+        # as do saves
+        single = Message.objects.get(pk=single.pk)
+        single.status = 'F'
+        single.save()
+        single.save()
+
+        batch = MessageBatch.objects.get(pk=batch.pk)
+        self.assertEquals({'P': 0, 'L': 0, 'Q': 1, 'S': 3, 'D': 0, 'C': 1, 'E': 0, 'F': 1}, batch.counts())
+        self.assertEquals((5, False), (batch.done, batch.finished))
+
+        # claims are counted too
+        claimed = Message.claim('test', 10, queryset=Message.objects.filter(batch=batch))
+        self.assertEquals(1, len(claimed))
+        self.assertEquals((0, 1), (MessageBatch.objects.get(pk=batch.pk).queued, MessageBatch.objects.get(pk=batch.pk).locked))
+
+        claimed[0].status = 'D'
+        claimed[0].save()
+        self.assertTrue(MessageBatch.objects.get(pk=batch.pk).finished)
+        self.assertEquals(1, MessageBatch.objects.filter(MessageBatch.finished_filter(), pk=batch.pk).count())
+
+        # counters which drift are fixed by recounting
+        MessageBatch.objects.filter(pk=batch.pk).update(total=2, sent=7)
+        self.assertEquals(1, MessageBatch.recount())
+        self.assertEquals(0, MessageBatch.recount())
+        batch = MessageBatch.objects.get(pk=batch.pk)
+        self.assertEquals((6, 3, 1), (batch.total, batch.sent, batch.delivered))
+
+        # moving messages between batches moves their counts along with them
+        other = MessageBatch.objects.create(status='Q')
+        Message.objects.filter(batch=batch, status='S').update(batch=other)
+        Message.objects.filter(pk=single.pk).update(batch=other.pk, status='Q')
+        batch, other = MessageBatch.objects.get(pk=batch.pk), MessageBatch.objects.get(pk=other.pk)
+        self.assertEquals((2, 0), (batch.total, batch.sent))
+        self.assertEquals((4, 3, 1), (other.total, other.sent, other.queued))
+
+        # as does deleting them, one at a time or in bulk
+        Message.objects.get(pk=single.pk).delete()
+        Message.objects.filter(batch=other).delete()
+        Message.objects.filter(batch=batch, status='D').delete()
+        batch, other = MessageBatch.objects.get(pk=batch.pk), MessageBatch.objects.get(pk=other.pk)
+        self.assertEquals((1, 0, 1), (batch.total, batch.delivered, batch.cancelled))
+        self.assertEquals((0, 0, 0), (other.total, other.sent, other.queued))
+        self.assertEquals(0, MessageBatch.recount())
+
+        # messages outside any batch are updated without counting, those across batches all at once
+        Message.objects.bulk_create([Message(connection=self.connection, text="other", direction='O', status='Q', batch=other)
+                                     for i in range(2)])
+        with self.assertNumQueries(1):
+            Message.objects.filter(batch=None).update(status='S')
+        with self.assertNumQueries(3):
+            self.assertEquals(3, Message.objects.filter(batch__isnull=False).update(status='S'))
+
+        batch, other = MessageBatch.objects.get(pk=batch.pk), MessageBatch.objects.get(pk=other.pk)
+        self.assertEquals((1, 0, 1), (batch.sent, batch.cancelled, batch.total))
+        self.assertEquals((2, 0, 2), (other.sent, other.queued, other.total))
+        self.assertEquals(0, MessageBatch.recount())
+
+    def testMassText(self):
+        from .models import mass_text_sent
+
+        connections = [Connection.objects.create(backend=self.backend, identity="2567%05d" % i) for i in range(5)]
+
+        sent = []
+        def receiver(sender, messages, status, **kwargs):
+            sent.append((sender, messages, status))
+        mass_text_sent.connect(receiver)
+
+        try:
+            # connections are read and inserted in chunks
+            msgs = Message.mass_text("hello", Connection.objects.filter(identity__startswith="2567"), chunk_size=2)
+            self.assertEquals(5, msgs.batch.total)
+            self.assertEquals((msgs.batch, 'P'), (sent[0][0], sent[0][2]))
+
+            # messages created since aren't picked up
+            Message.objects.create(connection=self.connection, text="other", direction='O', status='P')
+            self.assertEquals(sorted(c.pk for c in connections), sorted(msgs.values_list('connection', flat=True)))
+            self.assertEquals(set(["hello"]), set(msg.text for msg in sent[0][1]))
+
+            # connection ids work too
+            msgs = Message.mass_text("again", iter([self.connection.pk, self.connection2.pk]), status='Q', chunk_size=1)
+            self.assertEquals((2, 2), (msgs.count(), msgs.batch.queued))
+        finally:
+            mass_text_sent.disconnect(receiver)
+
+    def testMassTemplate(self):
+        from django.template import Template
+
+        def rows():
+            yield (self.connection, dict(name="Eric & Nic", balance=10))
+            yield (self.connection2.pk, dict(name="Ben"))
+
+        msgs = Message.mass_template(Template("Hi {{ name }}{% if balance %}, you have {{ balance }}{% endif %}"), rows(),
+                                     status='Q', chunk_size=1)
+        self.assertEquals([(self.connection.pk, "Hi Eric & Nic, you have 10"), (self.connection2.pk, "Hi Ben")],
+                          list(msgs.order_by('pk').values_list('connection', 'text')))
+        self.assertEquals((2, 2), (msgs.batch.total, msgs.batch.queued))
+
+    @override_settings(CHUNK_SIZE=3)
+    def testQueueMessages(self):
+        from .tasks import queue_messages_task
+
+        connections = [Connection.objects.create(backend=self.backend, identity="2567%05d" % i) for i in range(5)]
+        first = Message.mass_text("first", connections)
+        second = Message.mass_text("second", connections[:2])
+        urgent = [msg.pk for msg in first.order_by('pk')[3:]]
+        Message.objects.filter(pk__in=urgent).update(priority=1)
+
+        # the first chunk of our oldest batch, most urgent first, then all of our second
+        with self.assertNumQueries(8):
+            self.assertEquals(5, queue_messages_task())
+        self.assertEquals(set(urgent + [first.order_by('pk')[0].pk]), set(first.filter(status='Q').values_list('pk', flat=True)))
+        self.assertEquals(2, second.filter(status='Q').count())
+
+        self.assertEquals(2, queue_messages_task())
+        self.assertEquals(0, queue_messages_task())
+        self.assertEquals(7, Message.objects.filter(status='Q').count())
+
+    def testScheduler(self):
+        from .scheduler import Scheduler
+
+        scheduler = Scheduler(interactive_weight=10, batch_weight=1, priority_weights={1: 3})
+
+        # capacity is shared by weight, queues needing less than their share hand on the rest
+        self.assertEquals({'replies': 5, 'big': 50, 'other': 50},
+                          scheduler.allocate(dict(replies=(True, 10, 5), big=(False, 10, 100000), other=(False, 10, 100000)), 105))
+        self.assertEquals({'replies': 77, 'big': 8, 'urgent': 23},
+                          scheduler.allocate(dict(replies=(True, 10, 1000), big=(False, 10, 1000), urgent=(False, 1, 1000)), 108))
+        self.assertEquals({'a': 1, 'b': 0}, scheduler.allocate(dict(a=(False, 10, 5), b=(False, 10, 5)), 1))
+        self.assertEquals({'a': 5}, scheduler.allocate(dict(a=(False, 10, 5)), 100))
+
+        # queues which miss out on a cycle are first in line the next, so nobody is starved
+        batches = dict(("b%02d" % i, (False, 10, 1000)) for i in range(30))
+        first = scheduler.allocate(batches, 20, 'mtn')
+        second = scheduler.allocate(batches, 20, 'mtn')
+        self.assertEquals((20, 20), (sum(first.values()), sum(second.values())))
+        self.assertEquals([], [key for key in batches if not first[key] and not second[key]])
+
+        # which is kept track of separately for each group
+        self.assertEquals(10, sum(scheduler.allocate(dict(("b%02d" % i, (False, 10, 1000)) for i in range(20)), 10, 'airtel').values()))
+        self.assertEquals(20, sum(scheduler.allocate(batches, 20, 'mtn').values()))
+
+    @override_settings(KANNEL_BACKENDS={'test_backend': "http://kannel/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s"},
+                       MESSAGE_CHUNK_SIZE=20)
+    def testSchedulerReplies(self):
+        from .httppool import get_http_pool
+        from .tasks import send_kannel_messages_task, queued_counts
+
+        # replies go out alongside a big broadcast instead of waiting for it to finish
+        Connection.objects.bulk_create([Connection(backend=self.backend, identity="2567%05d" % i) for i in range(100)])
+        Message.mass_text("broadcast", Connection.objects.filter(identity__startswith="2567"), status='Q')
+        for i in range(3):
+            Message.objects.create(connection=self.connection, text="reply %d" % i, direction='O', status='Q')
+
+        # messages we can't send to Kannel don't take up any of the cycle
+        alpha = Connection.objects.create(backend=self.backend, identity="mtn-shortcode")
+        for i in range(5):
+            Message.objects.create(connection=alpha, text="alpha %d" % i, direction='O', status='Q')
+        self.assertEquals(103, sum(row['count'] for row in queued_counts(['test_backend'])))
+
+        pool = get_http_pool()
+        pool.urlopen = lambda url: TestResponse()
+        try:
+            send_kannel_messages_task()
+            self.assertEquals(3, Message.objects.filter(batch=None, status='S').count())
+            self.assertEquals(17, Message.objects.filter(text="broadcast", status='S').count())
+        finally:
+            del pool.urlopen
+
+    @override_settings(KANNEL_BACKENDS={'test_backend': "http://kannel/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s",
+                                        'test_backend2': "http://kannel2/send?to=%(recipient)s&text=%(text)s&smsc=%(backend)s"},
+                       MESSAGE_CHUNK_SIZE=10000)
+    def testSendKannelQueries(self):
+        from .models import MessageBatch
+        from .httppool import get_http_pool
+        from .tasks import send_kannel_messages_task
+
+        Connection.objects.bulk_create([Connection(backend=self.backend, identity="2567%05d" % i) for i in range(10000)])
+        batch = MessageBatch.objects.create(status='Q')
+        Message.objects.bulk_create([Message(connection_id=pk, text="broadcast", direction='O', status='Q', batch=batch)
+                                     for pk in Connection.objects.filter(identity__startswith="2567").values_list('pk', flat=True)])
+
+        urls = []
+        def urlopen(url):
+            urls.append(url)
+            return TestResponse()
+
+        pool = get_http_pool()
+        pool.urlopen = urlopen
+        try:
+            # closing batches, counting what is queued and picking our messages, claiming them, then
+            # counting, updating and moving our batch counters for each request, no matter how many
+            # messages there are
+            with self.assertNumQueries(3 + 5 + 13 * 3):
+                send_kannel_messages_task()
+            self.assertEquals(13, len(urls))
+            self.assertEquals(10000, Message.objects.filter(status='S').count())
+        finally:
+            del pool.urlopen
+
     def testRouterDictURL(self):
         # set our router URL
         settings.ROUTER_URL = {
@@ -124,6 +777,201 @@ class BackendTest(TransactionTestCase):
         self.assertEquals("http://mykannel2.com/cgi-bin/sendsms?from=1234&text=test2&to=2067799291&smsc=test_backend2&id=%d" % msg2.id, test_fetch_url.url)
 
 
+class RoutingTest(TestCase):
+
+    def tearDown(self):
+        from .routing import reload_routing_table
+        reload_routing_table()
+
+    def testPrefixTrie(self):
+        from .routing import PrefixTrie
+        trie = PrefixTrie()
+        trie.add('2577', 'a')
+        trie.add('25779', 'b')
+        trie.add('2576', 'c')
+
+        self.assertEquals(3, len(trie))
+        self.assertEquals('b', trie.longest_match('25779123456'))
+        self.assertEquals('a', trie.longest_match('25771123456'))
+        self.assertEquals('c', trie.longest_match('2576'))
+        self.assertEquals(None, trie.longest_match('257'))
+        self.assertEquals(None, trie.longest_match('256772123456'))
+
+    @override_settings(ROUTER_URL={
+                           "default": "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s",
+                           "lumitel": "http://lumitel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s",
+                       },
+                       ROUTER_PREFIX_ROUTES={'25768': 'lumitel', '25779': ('leo', 'http://leo.com/send?to=%(recipient)s&smsc=%(backend)s')})
+    def testRoutingTable(self):
+        import tempfile, os
+        from .routing import get_routing_table, reload_routing_table
+        from .tasks import build_send_url
+
+        reload_routing_table()
+
+        # routed by prefix to a backend with its own url
+        url = build_send_url(dict(backend='console', recipient='25768123456', text='hi', id=1))
+        self.assertEquals("http://lumitel.com/cgi-bin/sendsms?text=hi&to=25768123456&smsc=lumitel", url)
+
+        # to a route with an explicit url
+        url = build_send_url(dict(backend='console', recipient='25779123456', text='hi', id=1))
+        self.assertEquals("http://leo.com/send?to=25779123456&smsc=leo", url)
+
+        # no route, we use our backend
+        url = build_send_url(dict(backend='console', recipient='25771123456', text='hi', id=1))
+        self.assertEquals("http://mykannel.com/cgi-bin/sendsms?text=hi&to=25771123456&smsc=console", url)
+
+        # routes can also be loaded from a file, which is reloaded when it changes
+        (handle, filename) = tempfile.mkstemp()
+        try:
+            os.write(handle, "# prefix,backend,url\n25771,econet\n")
+            os.close(handle)
+
+            with override_settings(ROUTER_PREFIX_ROUTES_FILE=filename, ROUTER_PREFIX_ROUTES_RELOAD=0):
+                self.assertEquals('econet', get_routing_table().route('25771123456').backend)
+                self.assertEquals('lumitel', get_routing_table().route('25768123456').backend)
+
+                with open(filename, 'w') as routes_file:
+                    routes_file.write("25771,onatel\n")
+                os.utime(filename, (time.time() + 10, time.time() + 10))
+                self.assertEquals('onatel', get_routing_table().route('25771123456').backend)
+        finally:
+            os.remove(filename)
+
+
+class HttpPoolTest(TestCase):
+
+    def setUp(self):
+        import threading
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+        connections = self.connections = []
+        requests = self.requests = []
+
+        class KeepAliveHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                requests.append(self.path)
+
+                # a slow backend, which only answers after our client has given up
+                if self.path.startswith('/slow'):
+                    time.sleep(0.5)
+
+                code = 404 if self.path.startswith('/missing') else 202
+                body = "path: %s" % self.path
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+                # hang up without telling our client, like a server timing out an idle connection
+                if self.path.startswith('/hangup'):
+                    self.close_connection = 1
+
+            def do_POST(self):
+                requests.append("POST %s" % self.path)
+                self.rfile.read(int(self.headers['Content-Length']))
+
+                # redirect to wherever our path says, with the code it says
+                code, location = self.path.split('/')[2:4]
+                self.send_response(int(code))
+                self.send_header('Location', '/' + location)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), KeepAliveHandler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testKeepAlive(self):
+        import urllib2
+        from .httppool import HTTPConnectionPool
+
+        pool = HTTPConnectionPool(size=2, timeout=5, idle_timeout=30)
+        for i in range(5):
+            response = pool.urlopen(self.url + "/send?id=%d" % i)
+            self.assertEquals(202, response.getcode())
+            self.assertEquals("path: /send?id=%d" % i, response.read())
+
+        # all our requests went over a single connection
+        self.assertEquals(1, len(self.connections))
+
+        stats = pool.stats()[('http', '127.0.0.1', self.server.server_address[1])]
+        self.assertEquals(5, stats['requests'])
+        self.assertEquals(4, stats['reused'])
+        self.assertEquals(0.8, stats['reuse_ratio'])
+        self.assertEquals(1, stats['open'])
+
+        # errors are raised just like urlopen does, and the connection is still reused
+        try:
+            pool.urlopen(self.url + "/missing")
+            self.fail("should have raised an HTTPError")
+        except urllib2.HTTPError as e:
+            self.assertEquals(404, e.code)
+        self.assertEquals(1, len(self.connections))
+
+        # idle connections are evicted
+        pool.evict_idle(time.time() + 60)
+        self.assertEquals(0, pool.stats()[('http', '127.0.0.1', self.server.server_address[1])]['open'])
+        pool.urlopen(self.url + "/send")
+        self.assertEquals(2, len(self.connections))
+
+        # connection errors are URLErrors
+        import socket
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.assertRaises(urllib2.URLError, pool.urlopen, "http://127.0.0.1:%d/send" % port)
+
+    def testNoResend(self):
+        import urllib2
+        from .httppool import HTTPConnectionPool
+
+        pool = HTTPConnectionPool(size=2, timeout=0.2, idle_timeout=30)
+        pool.urlopen(self.url + "/send")
+
+        # a timeout waiting for our response on a reused connection is never retried, our message may have gone out
+        self.assertRaises(urllib2.URLError, pool.urlopen, self.url + "/slow")
+        time.sleep(0.5)
+        self.assertEquals(["/send", "/slow"], self.requests)
+
+        # but connections the server closed while idle aren't used again
+        pool.urlopen(self.url + "/hangup")
+        time.sleep(0.1)
+        self.assertEquals(202, pool.urlopen(self.url + "/send").getcode())
+        self.assertEquals(["/send", "/slow", "/hangup", "/send"], self.requests)
+        self.assertEquals(3, len(self.connections))
+
+        # redirected POSTs are never made again, we GET their new location instead, or fail should they need resending
+        del self.requests[:]
+        self.assertEquals("path: /sent", pool.urlopen(self.url + "/redirect/303/sent", "text=hello").read())
+        try:
+            pool.urlopen(self.url + "/redirect/307/sent", "text=hello")
+            self.fail("should have raised an HTTPError")
+        except urllib2.HTTPError as e:
+            self.assertEquals(307, e.code)
+        self.assertEquals(["POST /redirect/303/sent", "/sent", "POST /redirect/307/sent"], self.requests)
+
+
 class RouterTest(TestCase):
 
     def setUp(self):
@@ -134,6 +982,7 @@ class RouterTest(TestCase):
         settings.SMS_APPS = []
         settings.ROUTER_PASSWORD = None
         settings.ROUTER_URL = None
+        resolution_cache.clear()
 
         # make celery tasks execute immediately (no redis)
         settings.CELERY_ALWAYS_EAGER = True
@@ -162,6 +1011,130 @@ class RouterTest(TestCase):
 #        msg4 = router.add_message('test', 'asdfASDF', 'test', 'I', 'P') #Not applicable to U-Report
 #        self.assertEquals('asdfasdf', msg4.connection.identity)
 
+        # messages added in bulk keep their own dates, with no queries beyond the three our insert takes on sqlite
+        date = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        with self.assertNumQueries(3):
+            added = router.add_messages([('test', '250788383383', 'one', date), ('test', '250788383383', 'two', None)], 'I', 'P')
+        self.assertEquals([date, date], [added[0].date, Message.objects.get(pk=added[0].pk).date])
+        self.assertTrue(Message.objects.get(pk=added[1].pk).date > date)
+
+    def testResolutionCache(self):
+        router = get_router()
+
+        # the first message creates our connection, the second looks it up and caches it
+        msg1 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+        msg2 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+        self.assertEquals(self.connection.pk, msg2.connection.pk)
+
+        # from now on we shouldn't need to look up either our backend or connection
+        with self.assertNumQueries(1):
+            msg3 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+
+        self.assertEquals(self.connection.pk, msg3.connection.pk)
+        self.assertTrue(resolution_cache.connections.hits >= 1)
+
+        # changing the identity of our connection evicts it
+        self.connection.identity = '2067799295'
+        self.connection.save()
+
+        msg4 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+        self.assertNotEquals(self.connection.pk, msg4.connection.pk)
+        self.assertEquals('2067799294', msg4.connection.identity)
+
+        # changes made by other processes, which we never hear about, are never handed out
+        with override_settings(ROUTER_RESOLUTION_CACHE_TTL=0.2):
+            resolution_cache.clear()
+            msg5 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+            Connection.objects.filter(pk=msg5.connection_id).update(identity='2067799296')
+            msg6 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+            self.assertEquals((msg5.connection_id, '2067799296'), (msg6.connection_id, msg6.connection.identity))
+
+            # and our lookups of them expire
+            time.sleep(0.3)
+            msg7 = router.add_message('test_backend', '2067799294', 'test', 'I', 'P')
+            self.assertNotEquals(msg5.connection_id, msg7.connection_id)
+            self.assertEquals('2067799294', msg7.connection.identity)
+
+        # as does deleting our backend, which takes all our connections with it
+        self.assertEquals(1, len(resolution_cache.backends))
+        Backend.objects.filter(name='test_backend').delete()
+        self.assertEquals(0, len(resolution_cache.backends))
+        self.assertEquals(0, len(resolution_cache.connections))
+
+    def testLRUCache(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+
+        # touch a, so b becomes the least recently used
+        self.assertEquals(1, lru.get('a'))
+        lru.set('c', 3)
+
+        self.assertEquals(None, lru.get('b'))
+        self.assertEquals(1, lru.get('a'))
+        self.assertEquals(3, lru.get('c'))
+
+        stats = lru.stats()
+        self.assertEquals(2, stats['size'])
+        self.assertEquals(3, stats['hits'])
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(1, stats['evictions'])
+
+    def testNormalization(self):
+        from .normalization import NumberRules, NumberNormalizer
+
+        burundi = NumberRules('257', local_lengths=(8,))
+        normalizer = NumberNormalizer(burundi, dict(uganda=burundi.update(country_code='256', local_lengths=(9,))))
+
+        # all these forms are the same number
+        for number in ('+25779123456', '0025779123456', '79123456', '079123456', '257 79-12-34-56'):
+            self.assertEquals('25779123456', normalizer.normalize(number))
+
+        # shortcodes and foreign numbers are left alone
+        self.assertEquals('8080', normalizer.normalize('8080'))
+        self.assertEquals('256772123456', normalizer.normalize('+256772123456'))
+        self.assertEquals('256772123456', normalizer.normalize('256772123456'))
+        self.assertEquals('abc', normalizer.normalize('ABC'))
+
+        # without local lengths, only numbers with a trunk prefix are taken to be local
+        normalizer = NumberNormalizer(NumberRules('257'))
+        self.assertEquals('25779123456', normalizer.normalize('079123456'))
+        self.assertEquals('8080', normalizer.normalize('8080'))
+        self.assertEquals('256772123456', normalizer.normalize('256772123456'))
+        self.assertEquals('79123456', normalizer.normalize('79123456'))
+        normalizer = NumberNormalizer(burundi, dict(uganda=burundi.update(country_code='256', local_lengths=(9,))))
+
+        # backends can have their own rules
+        self.assertEquals('256772123456', normalizer.normalize('0772123456', 'uganda'))
+        self.assertEquals('25779123456', normalizer.normalize('0025779123456', 'uganda'))
+
+        # our results are memoized
+        self.assertTrue(('uganda', '0772123456') in normalizer.cache.entries)
+
+        # without a country code we only strip numbers
+        self.assertEquals('079123456', NumberNormalizer().normalize('(079) 123-456'))
+
+    def testNormalizeConnections(self):
+        from django.core.management import call_command
+        from .normalization import reset_normalizer
+
+        reset_normalizer()
+        backend = Backend.objects.create(name="normalize")
+        existing = Connection.objects.create(backend=backend, identity="256700000")
+        duplicate = Connection.objects.create(backend=backend, identity="+256-700-000")
+        other = Connection.objects.create(backend=backend, identity="+256700001")
+        msg = Message.objects.create(connection=duplicate, text="test", direction='I', status='H')
+
+        # connections colliding with an existing one are skipped by default
+        call_command('normalizeconnections')
+        self.assertEquals("256700001", Connection.objects.get(pk=other.pk).identity)
+        self.assertEquals("+256-700-000", Connection.objects.get(pk=duplicate.pk).identity)
+
+        # or merged into it, along with their messages
+        call_command('normalizeconnections', merge=True)
+        self.assertFalse(Connection.objects.filter(pk=duplicate.pk))
+        self.assertEquals(existing.pk, Message.objects.get(pk=msg.pk).connection_id)
+
     def testRouter(self):
         router = get_router()
 
@@ -219,6 +1192,169 @@ class RouterTest(TestCase):
         finally:
             router.apps = []
 
+    def testAddOutgoingMany(self):
+        router = get_router()
+        connections = [Connection.objects.create(backend=self.backend, identity="2567%05d" % i) for i in range(4)]
+
+        class CancelApp(AppBase):
+            # cancels messages to our odd connections
+            def outgoing(self, msg):
+                return int(msg.db_message.connection.identity) % 2 == 0
+
+        class PriorityApp(AppBase):
+            # bumps the priority of messages to our last connection
+            def outgoing(self, msg):
+                if msg.db_message.connection == connections[2]:
+                    msg.db_message.priority = 1
+
+        try:
+            router.apps = [CancelApp(router)]
+
+            # one insert for all our messages, which takes two more queries to load their ids outside
+            # postgres, then one update each for our queued and cancelled ones
+            with self.assertNumQueries(5):
+                last = router.add_outgoing(connections, "hello", status='P')
+
+            db_msgs = list(Message.objects.filter(text="hello").order_by('pk'))
+            self.assertEquals(connections, [msg.connection for msg in db_msgs])
+            self.assertEquals(['Q', 'C', 'Q', 'C'], [msg.status for msg in db_msgs])
+            self.assertEquals((db_msgs[-1].pk, 'C'), (last.pk, last.status))
+            self.assertEquals([None] * 4, [msg.batch_id for msg in db_msgs])
+
+            # messages our apps change are saved with their changes
+            router.apps = [PriorityApp(router), CancelApp(router)]
+            router.add_outgoing(connections, "urgent")
+            db_msgs = list(Message.objects.filter(text="urgent").order_by('pk'))
+            self.assertEquals([('Q', 10), ('C', 10), ('Q', 1), ('C', 10)], [(msg.status, msg.priority) for msg in db_msgs])
+        finally:
+            router.apps = []
+
+    def testOutgoingMany(self):
+        from .models import MessageBatch
+
+        router = get_router()
+        connections = [Connection.objects.create(backend=self.backend, identity="2567%05d" % i) for i in range(4)]
+
+        class BlacklistApp(AppBase):
+            # only implements the bulk hook, blacklisting our first connection
+            calls = []
+            def outgoing_many(self, msgs):
+                BlacklistApp.calls.append(len(msgs))
+                return [msg.db_message.connection != connections[0] for msg in msgs]
+
+        class CountApp(AppBase):
+            seen = []
+            def outgoing(self, msg):
+                CountApp.seen.append(msg.db_message.pk)
+
+                # and bumps the priority of messages to our last connection
+                if msg.db_message.connection_id == connections[3].pk:
+                    msg.db_message.priority = 1
+
+        try:
+            router.apps = [CountApp(router), BlacklistApp(router)]
+
+            # bulk sends call our bulk hook once, and everybody else per message
+            router.add_outgoing(connections, "hello")
+            self.assertEquals([4], BlacklistApp.calls)
+            self.assertEquals(3, len(CountApp.seen))
+            self.assertEquals(['C', 'Q', 'Q', 'Q'], [msg.status for msg in Message.objects.filter(text="hello").order_by('pk')])
+
+            # single messages go through it as a list of one
+            self.assertEquals('C', router.add_outgoing(connections[0], "single").status)
+            self.assertEquals([4, 1], BlacklistApp.calls)
+
+            # mass texts only run our phases if asked to
+            Message.mass_text("mass", Connection.objects.filter(pk__in=[c.pk for c in connections]))
+            self.assertEquals([4, 1], BlacklistApp.calls)
+
+            with override_settings(ROUTER_MASS_TEXT_PHASES=True):
+                msgs = Message.mass_text("mass", Connection.objects.filter(pk__in=[c.pk for c in connections]), chunk_size=3)
+            self.assertEquals([4, 1, 3, 1], BlacklistApp.calls)
+            self.assertEquals([('C', 10), ('P', 10), ('P', 10), ('P', 1)], [(msg.status, msg.priority) for msg in msgs.order_by('pk')])
+            self.assertEquals((3, 1), (msgs.batch.processing, msgs.batch.cancelled))
+            self.assertEquals(0, MessageBatch.recount())
+        finally:
+            router.apps = []
+
+    def testIncomingQueryCount(self):
+        router = get_router()
+
+        class HandleApp(AppBase):
+            def handle(self, msg):
+                return True
+
+            @property
+            def name(self):
+                return "HandleApp"
+
+        # warm up our connection cache
+        router.handle_incoming(self.backend.name, self.connection.identity, "test")
+        router.handle_incoming(self.backend.name, self.connection.identity, "test")
+
+        # without any apps, our message is inserted as handled
+        with self.assertNumQueries(1):
+            db_msg = router.handle_incoming(self.backend.name, self.connection.identity, "test")
+        self.assertEqual('H', Message.objects.get(pk=db_msg.pk).status)
+
+        try:
+            router.apps = [HandleApp(router)]
+
+            # one insert, loading our connection and one update for our final state
+            with self.assertNumQueries(3):
+                db_msg = router.handle_incoming(self.backend.name, self.connection.identity, "test")
+
+            db_msg = Message.objects.get(pk=db_msg.pk)
+            self.assertEqual('H', db_msg.status)
+            self.assertEqual('HandleApp', db_msg.application)
+
+            # apps which change anything else about the message get it saved
+            class PriorityApp(HandleApp):
+                def handle(self, msg):
+                    msg.db_message.priority = 1
+                    return True
+
+            router.apps = [PriorityApp(router)]
+            db_msg = router.handle_incoming(self.backend.name, self.connection.identity, "test")
+
+            db_msg = Message.objects.get(pk=db_msg.pk)
+            self.assertEqual(('H', 'HandleApp', 1), (db_msg.status, db_msg.application, db_msg.priority))
+        finally:
+            router.apps = []
+
+    def testDispatch(self):
+        router = get_router()
+
+        class HandleApp(AppBase):
+            def handle(self, msg):
+                return False
+
+            def outgoing(self, msg):
+                return True
+
+        class OutgoingApp(AppBase):
+            def outgoing(self, msg):
+                return True
+
+        try:
+            handle_app = HandleApp(router)
+            outgoing_app = OutgoingApp(router)
+            router.apps = [handle_app, outgoing_app]
+
+            # only apps which implement a phase are called for it
+            self.assertEquals([handle_app], [app for app, func in router.phase_apps('handle')])
+            self.assertEquals([], router.phase_apps('filter'))
+
+            # and outgoing phases are called in reverse order
+            self.assertEquals([outgoing_app, handle_app], [app for app, func in router.phase_apps('outgoing')])
+
+            # adding an app rebuilds our table
+            router.apps.append(OutgoingApp(router))
+            self.assertEquals(3, len(router.phase_apps('outgoing')))
+
+        finally:
+            router.apps = []
+
     def testAppReply(self):
         router = get_router()
 
@@ -282,6 +1418,7 @@ class ViewTest(TestCase):
         (self.connection, created) = Connection.objects.get_or_create(backend=self.backend, identity='2067799294')
         settings.SMS_APPS = ['rapidsms_httprouter.tests.EchoApp']
         settings.ROUTER_PASSWORD = None
+        resolution_cache.clear()
 
     def tearDown(self):
         get_router().apps = []
@@ -364,6 +1501,284 @@ class ViewTest(TestCase):
 
         self.assertEquals(0, len(outbox['outbox']))
 
+    def testReceiveBatch(self):
+        import json
+        router = get_router()
+        router.apps = [EchoApp(router)]
+
+        messages = [["test_backend", "2067799294", "one", None],
+                    {"backend": "test_backend", "sender": "+2067799999", "message": "two", "timestamp": "2013-01-01 12:00:00"},
+                    ["test_backend", "", "no sender", None],
+                    ["test_backend2", "2067799294", "three", 1357041600]]
+
+        response = self.client.post("/router/receive_batch", json.dumps(dict(messages=messages)), content_type="application/json")
+        self.assertEquals(200, response.status_code)
+        results = json.loads(response.content)['results']
+        self.assertEquals(4, len(results))
+
+        # our third message is invalid
+        self.assertEquals(["handled", "handled", "error", "handled"], [r['status'] for r in results])
+
+        # all our messages were handled and echoed
+        self.assertEquals("one", results[0]['message']['text'])
+        self.assertEquals("H", results[0]['message']['status'])
+        self.assertEquals("echo one", results[0]['responses'][0]['text'])
+
+        # a new connection was created for our second sender
+        self.assertEquals("2067799999", results[1]['message']['contact'])
+        self.assertEquals("echo two", results[1]['responses'][0]['text'])
+        self.assertEquals(datetime.datetime(2013, 1, 1, 12, 0, 0), Message.objects.get(pk=results[1]['id']).date)
+
+        # and a new backend for our last
+        self.assertEquals("test_backend2", results[3]['message']['backend'])
+        self.assertEquals(self.connection.identity, results[3]['message']['contact'])
+        self.assertEquals(datetime.datetime.fromtimestamp(1357041600), Message.objects.get(pk=results[3]['id']).date)
+
+        # form encoded works too
+        response = self.client.post("/router/receive_batch", dict(backend="test_backend", sender=["2067799294", "2067799294"], message=["four", "five"]))
+        self.assertEquals(200, response.status_code)
+        results = json.loads(response.content)['results']
+        self.assertEquals(["four", "five"], [r['message']['text'] for r in results])
+        self.assertEquals(results[0]['message']['contact'], results[1]['message']['contact'])
+
+        # our messages are loaded back without needing a batch
+        from .models import MessageBatch
+        self.assertEquals(0, MessageBatch.objects.count())
+        self.assertEquals(0, Message.objects.exclude(claimed_by=None).count())
+
+        # we need one backend, or one for each sender
+        response = self.client.post("/router/receive_batch", dict(backend=["test_backend", "test_backend"],
+                                                                 sender=["2067799294", "2067799294", "2067799294"],
+                                                                 message=["six", "seven", "eight"]))
+        self.assertEquals(400, response.status_code)
+
+        # but GETs don't
+        response = self.client.get("/router/receive_batch")
+        self.assertEquals(400, response.status_code)
+
+    def testDeliveredBatch(self):
+        import json
+        from .models import MessageBatch
+        router = get_router()
+
+        batch = MessageBatch.objects.create(status='Q', name='delivered')
+        messages = [Message.objects.create(connection=self.connection, text="msg %d" % i, direction='O',
+                                           status='S', batch=batch) for i in range(4)]
+        ids = [m.pk for m in messages]
+
+        # a list of ids or of dicts are both fine, all marked with a single update
+        with self.assertNumQueries(3):
+            response = self.client.post("/router/delivered_batch", json.dumps([ids[0], dict(message_id=ids[1])]),
+                                        content_type="application/json")
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("2 messages marked as delivered.", json.loads(response.content)['status'])
+
+        # as are form encoded ids
+        response = self.client.post("/router/delivered_batch", dict(message_id=["%d,%d" % (ids[2], ids[3])]))
+        self.assertEquals(200, response.status_code)
+
+        for message in Message.objects.filter(pk__in=ids):
+            self.assertEquals('D', message.status)
+            self.assertTrue(message.delivered)
+
+        batch = MessageBatch.objects.get(pk=batch.pk)
+        self.assertEquals((4, 0, 4), (batch.total, batch.sent, batch.delivered))
+
+        # bad ids, GETs and too many ids are refused
+        response = self.client.post("/router/delivered_batch", json.dumps(["foo"]), content_type="application/json")
+        self.assertEquals(400, response.status_code)
+
+        response = self.client.get("/router/delivered_batch?message_id=%d" % ids[0])
+        self.assertEquals(400, response.status_code)
+
+        with override_settings(ROUTER_DELIVERED_BATCH_SIZE=2):
+            response = self.client.post("/router/delivered_batch", json.dumps(ids), content_type="application/json")
+            self.assertEquals(400, response.status_code)
+
+        # large reports are marked in chunks
+        Message.objects.filter(pk__in=ids).update(status='S', delivered=None)
+        with override_settings(ROUTER_DELIVERED_CHUNK_SIZE=3):
+            self.assertEquals(4, router.mark_delivered_many(ids))
+        self.assertEquals(4, Message.objects.filter(pk__in=ids, status='D').count())
+
+    def testKannelDlr(self):
+        import json
+        from .delivery import DeliveryBuffer, reset_delivery_buffer, flush_delivery_buffer
+
+        first = Message.objects.create(connection=self.connection, text="first", direction='O', status='S')
+        second = Message.objects.create(connection=self.connection, text="second", direction='O', status='S')
+
+        # reports of messages reaching the SMSC are ignored
+        response = self.client.get("/router/dlr?message_id=%d&type=8" % first.pk)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('S', Message.objects.get(pk=first.pk).status)
+
+        response = self.client.get("/router/dlr?type=1")
+        self.assertEquals(400, response.status_code)
+
+        # but delivery reports mark our message as delivered
+        response = self.client.get("/router/dlr?message_id=%d&type=1" % first.pk)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('D', Message.objects.get(pk=first.pk).status)
+
+        # with a flush window, reports are held until the window closes or the buffer fills up
+        buffer = DeliveryBuffer(window=60, size=4)
+        self.assertEquals(0, buffer.add([first.pk, second.pk], datetime.datetime(2013, 1, 1, 12, 0, 0, 500)))
+        self.assertEquals(0, buffer.add([second.pk], datetime.datetime(2013, 1, 1, 12, 0, 0)))
+        self.assertEquals('S', Message.objects.get(pk=second.pk).status)
+
+        # reports in the same second are marked together, with one update and the query for our batch counts
+        with self.assertNumQueries(2):
+            self.assertEquals(2, buffer.flush())
+
+        second = Message.objects.get(pk=second.pk)
+        self.assertEquals(('D', datetime.datetime(2013, 1, 1, 12, 0, 0)), (second.status, second.delivered))
+        self.assertEquals(0, buffer.count)
+        self.assertEquals(0, buffer.flush())
+
+        Message.objects.all().update(status='S')
+        self.assertEquals(2, buffer.add([first.pk, second.pk, first.pk, second.pk]))
+
+        # which is what our views use when we have a window
+        Message.objects.filter(pk=first.pk).update(status='S')
+        try:
+            with override_settings(ROUTER_DELIVERED_FLUSH_WINDOW=60):
+                reset_delivery_buffer()
+                response = self.client.get("/router/dlr?message_id=%d&type=1" % first.pk)
+                self.assertEquals("1 delivery reports queued.", json.loads(response.content)['status'])
+                self.assertEquals(('S', 'D'), (Message.objects.get(pk=first.pk).status, Message.objects.get(pk=second.pk).status))
+
+                # anything still buffered is flushed as we exit
+                self.assertEquals(1, flush_delivery_buffer())
+                self.assertEquals('D', Message.objects.get(pk=first.pk).status)
+        finally:
+            reset_delivery_buffer()
+
+    def testAsyncReceive(self):
+        import json
+        router = get_router()
+        router.apps = [EchoApp(router)]
+
+        # record the connections that are queued to our workers instead of handling them
+        queued = []
+        workers = router.workers
+        router.workers = IncomingWorkers(queued.append, 2)
+
+        try:
+            settings.ROUTER_ASYNC_INCOMING = True
+            settings.ROUTER_ASYNC_BACKEND = 'local'
+
+            # our message should be received, but not yet handled
+            response = self.client.get("/router/receive?backend=test_backend&sender=2067799294&message=first")
+            self.assertEquals(200, response.status_code)
+            message = json.loads(response.content)['message']
+            self.assertEquals("R", message['status'])
+
+            router.workers.join()
+            self.assertEquals([self.connection.pk], queued)
+
+            # asking for an echo handles our message right away, but only after the one before it
+            response = self.client.get("/router/receive?backend=test_backend&sender=2067799294&message=second&echo=true")
+            self.assertEquals(200, response.status_code)
+            content = json.loads(response.content)
+            self.assertEquals("H", content['message']['status'])
+            self.assertEquals(["echo second"], [r['text'] for r in content['responses']])
+
+            self.assertEquals('H', Message.objects.get(pk=message['id']).status)
+            responses = Message.objects.filter(direction='O').order_by('pk')
+            self.assertEquals(["echo first", "echo second"], [r.text for r in responses])
+
+        finally:
+            settings.ROUTER_ASYNC_INCOMING = False
+            settings.ROUTER_ASYNC_BACKEND = None
+            router.workers = workers
+
+    @override_settings(ROUTER_ASYNC_BACKEND='local')
+    def testRecoverIncoming(self):
+        from django.core.signals import request_finished
+        router = get_router()
+
+        queued = []
+        workers = router.workers
+        router.workers = IncomingWorkers(queued.append, 2)
+
+        try:
+            other = Connection.objects.create(backend=self.backend, identity='2067790000')
+
+            def received(connection, status, age):
+                msg = Message.objects.create(connection=connection, text="hi", direction='I', status=status)
+                Message.objects.filter(pk=msg.pk).update(updated=datetime.datetime.now() - datetime.timedelta(seconds=age))
+                return msg
+
+            lost = received(self.connection, 'R', 120)
+            crashed = received(other, 'P', 600)
+            processing = received(other, 'P', 10)
+            recent = received(self.connection, 'R', 10)
+
+            # messages stuck processing go back to received, and connections with old received messages are handed over
+            self.assertEquals(set([self.connection.pk, other.pk]), set(router.recover_incoming()))
+            router.workers.join()
+            self.assertEquals(set([self.connection.pk, other.pk]), set(queued))
+
+            self.assertEquals('R', Message.objects.get(pk=crashed.pk).status)
+            self.assertEquals('P', Message.objects.get(pk=processing.pk).status)
+            self.assertEquals('R', Message.objects.get(pk=lost.pk).status)
+
+            # connections submitted inside a transaction are only handed over once our request is finished
+            del queued[:]
+            router.submit_incoming(recent.connection_id)
+            router.submit_incoming(recent.connection_id)
+            router.workers.join()
+            self.assertEquals([], queued)
+
+            request_finished.send(sender=self.__class__)
+            router.workers.join()
+            self.assertEquals([self.connection.pk], queued)
+
+        finally:
+            router.workers = workers
+
+    def testIncomingWorkers(self):
+        # each connection always goes to the same worker, in the order submitted
+        processed = []
+        workers = IncomingWorkers(processed.append, 3)
+        for connection_id in (1, 4, 2, 1, 7):
+            workers.submit(connection_id)
+        workers.join()
+
+        self.assertEquals([1, 4, 1, 7], [c for c in processed if c % 3 == 1])
+        self.assertEquals(5, len(processed))
+        self.assertTrue(workers.lock(1) is workers.lock(4))
+
+    def testMetrics(self):
+        router = get_router()
+        router.apps = [EchoApp(router)]
+
+        response = self.client.get("/router/receive?backend=test_backend&sender=2067799294&message=test")
+        self.assertEquals(200, response.status_code)
+
+        response = self.client.get("/router/metrics")
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith("text/plain"))
+
+        # our echo app should have been timed in the handle phase
+        self.assertTrue("# TYPE httprouter_app_phase_seconds histogram" in response.content)
+        self.assertTrue('httprouter_app_phase_seconds_bucket{app="rapidsms_httprouter",phase="handle",le="+Inf"}' in response.content)
+        self.assertTrue('httprouter_app_phase_seconds_count{app="rapidsms_httprouter",phase="handle"}' in response.content)
+        self.assertTrue("# TYPE httprouter_resolution_cache_lookups_total counter" in response.content)
+        self.assertTrue('httprouter_resolution_cache_lookups_total{cache="connection",result="hit"}' in response.content)
+        self.assertTrue('httprouter_resolution_cache_evictions_total{cache="connection"}' in response.content)
+
+    def testHistogram(self):
+        from .metrics import Histogram
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEquals([(0.1, 2), (1.0, 3), ('+Inf', 4)], histogram.cumulative())
+        self.assertEquals(4, histogram.count)
+        self.assertAlmostEqual(5.65, histogram.sum)
+
     def testSecurity(self):
         try:
             settings.ROUTER_PASSWORD = "foo"
@@ -2,14 +2,18 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 from django.conf.urls import patterns, include, url
-from .views import receive, outbox, delivered, console, relaylog, alert
+from .views import receive, receive_batch, outbox, delivered, delivered_batch, kannel_dlr, metrics, console, relaylog, alert
 from django.contrib.admin.views.decorators import staff_member_required
 
 urlpatterns = patterns("",
+   ("^router/receive_batch", receive_batch),
    ("^router/receive", receive),
    ("^router/outbox", outbox),
    ("^router/relaylog", relaylog),
    ("^router/alert", alert),
+   ("^router/delivered_batch", delivered_batch),
    ("^router/delivered", delivered),
+   ("^router/dlr", kannel_dlr),
+   ("^router/metrics", metrics),
    ("^router/console", staff_member_required(console), {}, 'httprouter-console')
 )
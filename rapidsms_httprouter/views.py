@@ -1,4 +1,5 @@
 import json
+import datetime
 
 from django import forms
 from django.http import HttpResponse
@@ -18,6 +19,8 @@ from django.core.mail import send_mail
 
 from .models import Message
 from .router import get_router
+from .delivery import get_delivery_buffer
+from .metrics import registry
 
 
 class SecureForm(forms.Form):
@@ -60,6 +63,16 @@ def receive(request):
     # otherwise, create the message
     data = form.cleaned_data
     router = get_router()
+
+    # if we are handling messages in the background, just queue it up, unless our caller wants our responses
+    if getattr(settings, "ROUTER_ASYNC_INCOMING", False) and not data['echo']:
+        message = router.queue_incoming(data['backend'], data['sender'], data['message'])
+
+        if getattr(settings, "ROUTER_SILENT", False):
+            return HttpResponse()
+        else:
+            return HttpResponse(json.dumps(dict(message=message.as_json(), status="Message queued.")))
+
     message = router.handle_incoming(data['backend'], data['sender'], data['message'])
 
     response = {}
@@ -74,6 +87,130 @@ def receive(request):
         return HttpResponse(json.dumps(response))
 
 
+class BatchForm(SecureForm):
+    echo = forms.BooleanField(required=False)
+
+class BatchMessageForm(forms.Form):
+    backend = forms.CharField(max_length=32)
+    sender = forms.CharField(max_length=20)
+    message = forms.CharField(max_length=160, required=False)
+    timestamp = forms.CharField(required=False)
+
+def parse_timestamp(timestamp):
+    """
+    Parses the timestamp of a batched message, either seconds since the epoch or a date
+    in the format kannel gives us.
+    """
+    try:
+        return datetime.datetime.fromtimestamp(float(timestamp))
+    except ValueError:
+        pass
+
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(timestamp, format)
+        except ValueError:
+            pass
+
+    raise forms.ValidationError("Invalid timestamp: %s" % timestamp)
+
+def batch_entries(request):
+    """
+    Pulls out the list of messages posted to receive_batch.  These can either be a JSON list
+    of [backend, sender, message, timestamp] lists or of dicts with the same keys, or form
+    encoded lists of each field.
+    """
+    if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+        entries = json.loads(request.body)
+        if isinstance(entries, dict):
+            entries = entries.get('messages', [])
+
+        fields = ('backend', 'sender', 'message', 'timestamp')
+        for entry in entries:
+            if isinstance(entry, dict):
+                yield entry
+            else:
+                yield dict(zip(fields, entry))
+    else:
+        backends = request.POST.getlist('backend')
+        senders = request.POST.getlist('sender')
+        messages = request.POST.getlist('message')
+        timestamps = request.POST.getlist('timestamp')
+
+        if len(backends) > 1 and len(backends) != len(senders):
+            raise ValueError("%d backends given for %d senders, give one backend or one for each sender" %
+                             (len(backends), len(senders)))
+
+        for i in range(len(senders)):
+            # a single backend can be used for all our messages
+            backend = backends[i] if len(backends) > 1 else (backends or [None])[0]
+            yield dict(backend=backend,
+                       sender=senders[i],
+                       message=messages[i] if i < len(messages) else '',
+                       timestamp=timestamps[i] if i < len(timestamps) else None)
+
+@csrf_exempt
+def receive_batch(request):
+    """
+    Takes a POSTed list of messages, creates records for them in bulk, then passes each
+    through all the rapidsms applications for processing.  This lets relayers catch up
+    quickly after an outage.
+    """
+    if request.method != 'POST':
+        return HttpResponse("Must be POST", status=400)
+
+    form = BatchForm(request.REQUEST)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    try:
+        entries = list(batch_entries(request))
+    except (ValueError, TypeError), e:
+        return HttpResponse("Invalid message list: %s" % str(e), status=400)
+
+    max_size = getattr(settings, 'ROUTER_RECEIVE_BATCH_SIZE', 5000)
+    if len(entries) > max_size:
+        return HttpResponse("Too many messages, at most %d can be sent at once" % max_size, status=400)
+
+    # validate each message, keeping track of which are valid
+    results = []
+    valid = []
+    for index, entry in enumerate(entries):
+        entry_form = BatchMessageForm(entry)
+        if entry_form.is_valid():
+            data = entry_form.cleaned_data
+            try:
+                timestamp = parse_timestamp(data['timestamp']) if data['timestamp'] else None
+                valid.append((index, (data['backend'], data['sender'], data['message'], timestamp)))
+                results.append(None)
+                continue
+            except forms.ValidationError, e:
+                error = ' '.join(e.messages)
+        else:
+            error = str(entry_form.errors)
+
+        results.append(dict(index=index, status="error", error=error))
+
+    messages = get_router().handle_incoming_batch([entry for index, entry in valid])
+
+    # look up all our responses at once
+    responses = dict()
+    echo = not getattr(settings, "ROUTER_SILENT", False) or form.cleaned_data.get('echo', False)
+    if echo and messages:
+        for response in Message.objects.filter(in_response_to__in=[m.pk for m in messages]).select_related('connection__backend'):
+            responses.setdefault(response.in_response_to_id, []).append(response.as_json())
+
+    for (index, entry), message in zip(valid, messages):
+        result = dict(index=index, status="handled", id=message.pk)
+        if echo:
+            result['message'] = message.as_json()
+            result['responses'] = responses.get(message.pk, [])
+        results[index] = result
+
+    response = dict(results=results, status="%d of %d messages handled." % (len(messages), len(entries)))
+    return HttpResponse(json.dumps(response))
+
+
 @csrf_exempt
 def relaylog(request):
     """
@@ -156,6 +293,95 @@ def delivered(request):
 
     return HttpResponse(json.dumps(dict(status="Message marked as sent.")))
 
+def delivered_ids(request):
+    """
+    Pulls out the list of message ids posted to delivered_batch.  These can either be a JSON list
+    of ids or of dicts with a message_id (or id) key, or form encoded message_id values, each of
+    which can hold a comma separated list of ids.
+    """
+    if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+        entries = json.loads(request.body)
+        if isinstance(entries, dict):
+            entries = entries.get('message_ids', entries.get('messages', []))
+
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = entry.get('message_id', entry.get('id'))
+            yield int(entry)
+    else:
+        for value in request.POST.getlist('message_id'):
+            for entry in value.split(','):
+                if entry.strip():
+                    yield int(entry)
+
+def delivery_status(marked, reported):
+    if marked < reported and get_delivery_buffer().window > 0:
+        return "%d delivery reports queued." % reported
+    return "%d messages marked as delivered." % marked
+
+@csrf_exempt
+def delivered_batch(request):
+    """
+    Takes a POSTed list of message ids which were delivered by our backend and marks them all
+    as delivered in bulk.
+    """
+    if request.method != 'POST':
+        return HttpResponse("Must be POST", status=400)
+
+    form = SecureForm(request.REQUEST)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    try:
+        message_ids = list(delivered_ids(request))
+    except (ValueError, TypeError), e:
+        return HttpResponse("Invalid message id list: %s" % str(e), status=400)
+
+    max_size = getattr(settings, 'ROUTER_DELIVERED_BATCH_SIZE', 5000)
+    if len(message_ids) > max_size:
+        return HttpResponse("Too many message ids, at most %d can be sent at once" % max_size, status=400)
+
+    marked = get_delivery_buffer().add(message_ids)
+    return HttpResponse(json.dumps(dict(status=delivery_status(marked, len(message_ids)))))
+
+
+# the type kannel gives delivery reports for messages which were delivered
+KANNEL_DLR_DELIVERED = 1
+
+class KannelDlrForm(SecureForm):
+    message_id = forms.IntegerField()
+    type = forms.IntegerField(required=False)
+
+def kannel_dlr(request):
+    """
+    Called by Kannel through the dlr-url of each message we send, which needs the id of its message, so
+    backends whose url has one are sent a message per request rather than in chunks.  Kannel calls us for
+    each of the events in our dlr-mask, only delivery reports with a type of 1 (delivered) mark their
+    message as delivered, others are acknowledged and ignored.
+    """
+    form = KannelDlrForm(request.GET)
+
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    dlr_type = form.cleaned_data['type']
+    if dlr_type is not None and dlr_type != KANNEL_DLR_DELIVERED:
+        return HttpResponse(json.dumps(dict(status="Ignored delivery report of type %d." % dlr_type)))
+
+    marked = get_delivery_buffer().add([form.cleaned_data['message_id']])
+    return HttpResponse(json.dumps(dict(status=delivery_status(marked, 1))))
+
+
+def metrics(request):
+    """
+    Returns our timing metrics and stats in the Prometheus text format
+    """
+    form = SecureForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
+
 
 class MessageTable(Table):
     # this is temporary, until i fix ModelTable!
@@ -207,9 +433,10 @@ def console(request):
         elif request.REQUEST['action'] == 'reply':
             reply_form = ReplyForm(request.POST)
             if reply_form.is_valid():
-                if Connection.objects.filter(identity=reply_form.cleaned_data['recipient']).count():
+                recipient = get_router().normalize_number(reply_form.cleaned_data['recipient'])
+                if Connection.objects.filter(identity=recipient).count():
                     text = reply_form.cleaned_data['message']
-                    conn = Connection.objects.filter(identity=reply_form.cleaned_data['recipient'])[0]
+                    conn = Connection.objects.filter(identity=recipient)[0]
                     outgoing = OutgoingMessage(conn, text)
                     get_router().handle_outgoing(outgoing)
                 else: